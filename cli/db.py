@@ -1,6 +1,7 @@
 import click
 
-from server.models import db
+from server.models import backfill_normalized_tables, build_student_search_index, db, upgrade_tables
+from server.typings.exception import DataValidationError
 from server import app
 from tests.fixtures import seed_db as _seed_db
 
@@ -37,6 +38,28 @@ def seed_db():
     _seed_db()
 
 
+@app.cli.command('backfillnormalized')
+def backfill_normalized():
+    """
+    Fills the attribute vocabulary, attribute link and preference class tables
+    from the comma-joined columns of existing seats and students, and builds the student search index.
+    Creates the new tables, columns and indexes if needed, and is safe to run more than once.
+    """
+    click.echo('Creating missing tables, columns and indexes...')
+    try:
+        with db.engine.begin() as connection:
+            added = upgrade_tables(connection)
+    except DataValidationError as e:
+        raise click.ClickException(str(e))
+    click.echo(f'Added {len(added)} columns{": " + ", ".join(added) if added else ""}.')
+    click.echo('Backfilling attribute links and preference classes...')
+    seat_count, student_count = backfill_normalized_tables(db.session)
+    click.echo(f'Processed {seat_count} seats and {student_count} students.')
+    click.echo('Building student search index...')
+    with db.engine.begin() as connection:
+        build_student_search_index(connection)
+
+
 @app.cli.command('resetdb')
 @click.pass_context
 def reset_db(ctx):
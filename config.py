@@ -56,6 +56,18 @@ class ConfigBase(object):
 
     PHOTO_DIRECTORY = getenv('PHOTO_DIRECTORY', "unset")
 
+    # number of seeded runs the "optimize" assignment mode compares
+    ASSIGNMENT_OPTIMIZE_RUNS = int(getenv('ASSIGNMENT_OPTIMIZE_RUNS', 8))
+    # worker processes for those runs; 1 runs them in the web worker itself,
+    # more forks a process pool inside the request, so only raise it on a host with cores to spare
+    ASSIGNMENT_OPTIMIZE_PROCESSES = int(getenv('ASSIGNMENT_OPTIMIZE_PROCESSES', 1))
+
+    # rows per chunk of a chunked student import
+    STUDENT_IMPORT_CHUNK_SIZE = int(getenv('STUDENT_IMPORT_CHUNK_SIZE', 500))
+
+    # "staging" imports CSV uploads through a COPY staging table on PostgreSQL, see server/services/core/staging.py
+    STUDENT_IMPORT_BACKEND = getenv('STUDENT_IMPORT_BACKEND', 'orm')
+
 
 class ProductionConfig(ConfigBase):
     FLASK_ENV = AppEnvironment.PRODUCTION.value
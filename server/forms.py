@@ -2,12 +2,13 @@ import re
 
 from flask_wtf import FlaskForm
 from wtforms import FieldList, FormField, SelectField, ValidationError, BooleanField, FileField, SelectMultipleField, StringField, \
-    SubmitField, TextAreaField, DateTimeField, IntegerField, widgets
+    SubmitField, TextAreaField, DateTimeField, IntegerField, FloatField, widgets
 from wtforms import Form as NoCsrfForm
 from flask_wtf.file import FileRequired, FileAllowed
 from wtforms.validators import Email, InputRequired, URL, Optional, DataRequired
 from server.controllers import exam_regex
-from server.typings.enum import AssignmentImportStrategy, NewRowImportStrategy, UpdatedRowImportStrategy, MissingRowImportStrategy
+from server.typings.enum import AssignmentImportStrategy, AssignmentMode, FillStrategy, NewRowImportStrategy, \
+    UpdatedRowImportStrategy, MissingRowImportStrategy
 
 
 class MultiCheckboxField(SelectMultipleField):
@@ -130,6 +131,7 @@ class ImportStudentFromCsvUploadForm(ImportStudentFormBase):
         FileRequired(),
         FileAllowed(['csv'], 'CSV files only!')
     ])
+    import_in_chunks = BooleanField('import_in_chunks', default=False)
 
 
 class ImportStudentFromManualInputForm(ImportStudentFormBase):
@@ -174,10 +176,32 @@ class DeleteStudentForm(FlaskForm):
 
 
 class AssignForm(FlaskForm):
+    mode = SelectField('mode', choices=[
+        (e.value, e.name) for e in AssignmentMode],
+        default=AssignmentMode.GREEDY.value,
+        validators=[DataRequired()])
+    fill = SelectField('fill', choices=[
+        (e.value, e.name) for e in FillStrategy],
+        default=FillStrategy.RANDOM.value,
+        validators=[DataRequired()])
+    seed = IntegerField('seed', [Optional()])
+    spacing = FloatField('spacing', [Optional()], default=2.0)
     submit = SubmitField('assign')
     delete_all = SubmitField('delete all assignments')
     reassign_all = SubmitField('reassign all assignments')
 
+    def validate_fill(form, field):
+        if field.data != field.default and form.mode.data in (
+                AssignmentMode.MATCHING.value, AssignmentMode.SOFT_PREFERENCE.value, AssignmentMode.INCREMENTAL.value):
+            raise ValidationError('The fill strategy does not apply to the matching modes')
+
+    def validate_spacing(form, field):
+        if field.data is not None and field.data <= 0:
+            raise ValidationError('Spacing must be greater than 0')
+        if field.data is not None and field.data != field.default \
+                and form.mode.data not in (AssignmentMode.SPACED.value, AssignmentMode.SEPARATE_SECTIONS.value):
+            raise ValidationError('Spacing only applies to the spaced and separate sections modes')
+
 
 class AssignSingleForm(FlaskForm):
     ignore_restrictions = BooleanField('ignore restrictions')
@@ -1,24 +1,31 @@
 
+import hashlib
 import itertools
+import json
 from natsort import natsorted
 import re
 
 from flask_login import UserMixin
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import PrimaryKeyConstraint, types
-from sqlalchemy.orm import backref
-from sqlalchemy import UniqueConstraint, desc, text
+from sqlalchemy import DDL, Index, PrimaryKeyConstraint, event, func, inspect, types
+from sqlalchemy.orm import backref, selectinload
+from sqlalchemy import UniqueConstraint, bindparam, desc, select, text
 from sqlalchemy.ext.associationproxy import association_proxy
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
 
 from server import app
+from server.typings.enum import PreferenceKind
+from server.typings.exception import DataValidationError
 from server.utils.date import parse_ISO8601
-from server.utils.misc import arr_to_dict, set_to_str
+from server.utils.misc import arr_to_dict, chunked, set_to_str
 
 db = SQLAlchemy(app=app)
 
 
 class StringSet(types.TypeDecorator):
     impl = types.Text
+    cache_ok = True
 
     def process_bind_param(self, value, engine):
         return ','.join(set(value))
@@ -100,24 +107,96 @@ class Exam(db.Model):
 
     @property
     def unassigned_seats(self):
-        return [seat for seat in itertools.chain(*self.seats) if seat.assignment == None]  # noqa
+        return self.unassigned_seats_query().all()
 
     @property
     def unassigned_students(self):
-        return [student for student in self.students if student.assignment == None]  # noqa
-
-    def get_assignments(self, emailed=None, limit=None, offset=None):
-        query = SeatAssignment.query.join(SeatAssignment.seat).join(Seat.room).filter(
-            Room.exam_id == self.id,
-        )
+        return self.unassigned_students_query().all()
+
+    def unassigned_seats_query(self, room_ids=None, avoid_room_ids=None, attributes=None, avoid_attributes=None):
+        """
+        Query the seats of this exam without an assignment (an anti-join against seat_assignments),
+        optionally only those in room_ids and not in avoid_room_ids,
+        with all of attributes and none of avoid_attributes (compared case-insensitively).
+        """
+        query = Seat.query.outerjoin(SeatAssignment, SeatAssignment.seat_id == Seat.id) \
+            .filter(Seat.exam_id == self.id, SeatAssignment.seat_id.is_(None))
+        if room_ids is not None:
+            query = query.filter(Seat.room_id.in_([int(room_id) for room_id in room_ids]))
+        if avoid_room_ids:
+            query = query.filter(Seat.room_id.notin_([int(room_id) for room_id in avoid_room_ids]))
+        for attr in attributes or ():
+            query = query.filter(Seat.has_attribute(attr))
+        for attr in avoid_attributes or ():
+            query = query.filter(~Seat.has_attribute(attr))
+        return query
+
+    def unassigned_seat_count(self, **filters):
+        """
+        Count the seats of this exam without an assignment, without loading them.
+        Takes the same filters as unassigned_seats_query.
+        """
+        return self.unassigned_seats_query(**filters).with_entities(func.count(Seat.id)).scalar()
+
+    def unassigned_students_query(self):
+        """
+        Query the students of this exam without an assignment (an anti-join against seat_assignments).
+        """
+        return Student.query.outerjoin(SeatAssignment, SeatAssignment.student_id == Student.id) \
+            .filter(Student.exam_id == self.id, SeatAssignment.student_id.is_(None)).order_by(Student.name)
+
+    def unassigned_student_count(self):
+        """
+        Count the students of this exam without an assignment, without loading them.
+        """
+        return self.unassigned_students_query().with_entities(func.count(Student.id)).scalar()
+
+    def assignments_query(self, emailed=None):
+        """
+        Query the seat assignments of this exam, optionally only those (not) emailed,
+        through the (exam_id, emailed) index of seat_assignments, without joining seats or rooms.
+        """
+        query = SeatAssignment.query.filter(SeatAssignment.exam_id == self.id)
         if emailed is not None:
             query = query.filter(SeatAssignment.emailed == emailed)
+        return query
+
+    def assignment_count(self, emailed=None):
+        """
+        Count the seat assignments of this exam, without loading them.
+        """
+        return self.assignments_query(emailed).with_entities(func.count()).scalar()
+
+    def delete_assignments(self):
+        """
+        Delete every seat assignment of this exam with a single indexed DELETE.
+        Does not synchronize the session; the caller should commit or expire loaded assignments.
+        """
+        return self.assignments_query().delete(synchronize_session=False)
+
+    def get_assignments(self, emailed=None, limit=None, offset=None):
+        query = self.assignments_query(emailed)
         if limit is not None:
             query = query.limit(limit)
         if offset is not None:
             query = query.offset(offset)
         return query.all()
 
+    def students_with_seats_query(self):
+        """
+        Query the students of this exam by name, with their assignment, seat and room loaded eagerly,
+        so listing them takes a constant number of queries.
+        """
+        return Student.query.filter(Student.exam_id == self.id).order_by(Student.name).options(
+            selectinload(Student.assignment).joinedload(SeatAssignment.seat).joinedload(Seat.room))
+
+    @property
+    def rooms_by_id(self):
+        """
+        Rooms of this exam keyed by id as a string, the form room preferences are stored in.
+        """
+        return {str(room.id): room for room in self.rooms}
+
     def get_room(self, room_id):
         return Room.query.filter_by(id=room_id, exam_id=self.id).first()
 
@@ -128,7 +207,7 @@ class Exam(db.Model):
 class Room(db.Model):
     __tablename__ = 'rooms'
     id = db.Column(db.Integer, primary_key=True)
-    exam_id = db.Column(db.ForeignKey('exams.id', ondelete='CASCADE'), index=True, nullable=False)
+    exam_id = db.Column(db.ForeignKey('exams.id', ondelete='CASCADE'), nullable=False)
     name = db.Column(db.String(255), nullable=False, index=True)
     display_name = db.Column(db.String(255), nullable=False)
     start_at = db.Column(db.String(255))
@@ -156,6 +235,7 @@ class Room(db.Model):
 
     __table_args__ = (
         UniqueConstraint('exam_id', 'name', 'start_at', name='uq_exam_id_name_start_at'),
+        Index('ix_rooms_exam_id_id', 'exam_id', 'id'),
     )
 
     @property
@@ -179,16 +259,54 @@ class Room(db.Model):
         ]
 
     def update_movable_seats(self, new_movable_seats):
-        self.seats = self.fixed_seats + new_movable_seats
+        """
+        Replace the movable seats of this room with the given ones.
+        Existing movable seats with the same attributes are kept instead, assigned ones first,
+        so that only the students on removed seats lose their assignment.
+        """
+        new_seats_by_attribute = arr_to_dict(new_movable_seats, key_getter=lambda seat: frozenset(seat.attributes))
+        kept_seats = []
+        for attributes, seats in self.movable_seats_by_attribute.items():
+            new_seats = new_seats_by_attribute.get(attributes, [])
+            seats = sorted(seats, key=lambda seat: seat.assignment is None)
+            kept_seats.extend(seats[:len(new_seats)])
+            new_seats_by_attribute[attributes] = new_seats[len(seats):]
+        self.seats = self.fixed_seats + kept_seats + list(itertools.chain(*new_seats_by_attribute.values()))
 
     def __repr__(self):
         return '<Room {}>'.format(self.name)
 
 
+class Attribute(db.Model):
+    """
+    Vocabulary of seat attributes: every lower-cased attribute name is stored once,
+    and seats and student preferences refer to it through indexed link tables.
+    """
+    __tablename__ = 'attributes'
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(255), nullable=False, unique=True)
+
+    def __repr__(self):
+        return '<Attribute {}>'.format(self.name)
+
+
+seat_attributes = db.Table(
+    'seat_attributes',
+    db.Column('seat_id', db.ForeignKey('seats.id', ondelete='CASCADE'), primary_key=True),
+    db.Column('attribute_id', db.ForeignKey('attributes.id', ondelete='CASCADE'), primary_key=True),
+    Index('ix_seat_attributes_attribute_id_seat_id', 'attribute_id', 'seat_id'),
+)
+
+
 class Seat(db.Model):
     __tablename__ = 'seats'
+    __table_args__ = (
+        Index('ix_seats_room_id_name', 'room_id', 'name'),
+    )
     id = db.Column(db.Integer, primary_key=True)
-    room_id = db.Column(db.ForeignKey('rooms.id', ondelete='CASCADE'), index=True, nullable=False)
+    room_id = db.Column(db.ForeignKey('rooms.id', ondelete='CASCADE'), nullable=False)
+    # copy of room.exam_id, set on flush, so exam-scoped seat queries do not join rooms
+    exam_id = db.Column(db.ForeignKey('exams.id', ondelete='CASCADE'), index=True, nullable=False)
     fixed = db.Column(db.Boolean, default=True, nullable=False)
     name = db.Column(db.String(255))
     row = db.Column(db.String(255))
@@ -199,19 +317,61 @@ class Seat(db.Model):
 
     assignment = db.relationship('SeatAssignment', uselist=False, cascade='all, delete-orphan',
                                  backref=backref('seat', uselist=False, single_parent=True))
+    # kept in sync with attributes on flush, see sync_attribute_links
+    attribute_refs = db.relationship('Attribute', secondary=seat_attributes, uselist=True)
+    exam = db.relationship('Exam', uselist=False)
 
     @property
     def display_name(self):
         return self.name if self.name else f"Movable Seat ({set_to_str(self.attributes)})"
 
+    @property
+    def signature(self):
+        """
+        Lower-cased attributes and room id of this seat, used for preference checks.
+        Cached on the instance until attributes or room change.
+        """
+        signature = self.__dict__.get('_signature')
+        if signature is None:
+            room_id = self.room_id if self.room_id is not None else (self.room.id if self.room else None)
+            signature = (frozenset(attr.lower() for attr in self.attributes), room_id)
+            if room_id is not None:
+                self._signature = signature
+        return signature
+
+    @classmethod
+    def has_attribute(cls, attr: str):
+        """
+        SQL expression checking, case-insensitively, that a seat has the given attribute.
+        It is an EXISTS on the seat_attributes link table, answered from its primary key
+        and the unique index on attribute names.
+        """
+        return cls.attribute_refs.any(Attribute.name == attr.lower())
+
     def __repr__(self):
         return '<Seat {}>'.format(self.display_name)
 
 
+@event.listens_for(Seat.attributes, 'set')
+@event.listens_for(Seat.room_id, 'set')
+def _invalidate_seat_signature(seat, value, oldvalue, initiator):
+    seat.__dict__.pop('_signature', None)
+
+
+@event.listens_for(Room.seats, 'append')
+@event.listens_for(Room.seats, 'remove')
+def _invalidate_room_seat_signature(room, seat, initiator):
+    seat.__dict__.pop('_signature', None)
+
+
 class Student(db.Model):
     __tablename__ = 'students'
+    __table_args__ = (
+        # the key of imported rows, see server/services/core/upsert.py
+        Index('uq_students_exam_id_canvas_id', 'exam_id', 'canvas_id', unique=True),
+    )
     id = db.Column(db.Integer, primary_key=True)
-    exam_id = db.Column(db.ForeignKey('exams.id', ondelete='CASCADE'), index=True, nullable=False)
+    exam_id = db.Column(db.ForeignKey('exams.id', ondelete='CASCADE'), nullable=False)
     canvas_id = db.Column(db.String(255), nullable=False, index=True)
     email = db.Column(db.String(255), index=True, nullable=False)
     name = db.Column(db.String(255), nullable=False)
@@ -220,9 +380,17 @@ class Student(db.Model):
     avoids = db.Column(StringSet, nullable=False)
     room_wants = db.Column(StringSet, nullable=False)
     room_avoids = db.Column(StringSet, nullable=False)
+    prefers = db.Column(StringSet, nullable=False, default=set)
+    section = db.Column(db.String(255))
+    # kept in sync with wants, avoids, room_wants, room_avoids and prefers on flush, see sync_preference_classes
+    preference_class_id = db.Column(db.ForeignKey('preference_classes.id'), index=True)
 
+    preference_class = db.relationship('PreferenceClass', uselist=False)
     assignment = db.relationship('SeatAssignment', uselist=False, cascade='all, delete-orphan',
                                  backref=backref('student', uselist=False, single_parent=True))
+    # kept in sync with wants, avoids and prefers on flush, see sync_attribute_links
+    preference_links = db.relationship('StudentPreference', uselist=True, cascade='all, delete-orphan',
+                                       backref=backref('student', uselist=False))
 
     @property
     def first_name(self):
@@ -232,15 +400,431 @@ class Student(db.Model):
         return '<Student {} ({})>'.format(self.name, self.canvas_id)
 
 
+class code_point_order(FunctionElement):
+    """
+    A text expression compared and sorted by code point, whatever the collation of the database.
+    It is COLLATE "C" on PostgreSQL, whose default collation follows the locale of the cluster;
+    SQLite already compares text by code point (its default BINARY collation), so it is left as is there.
+    """
+    name = 'code_point_order'
+    type = types.String()
+    inherit_cache = True
+
+
+@compiles(code_point_order)
+def _compile_code_point_order(element, compiler, **kwargs):
+    return compiler.process(element.clauses, **kwargs)
+
+
+@compiles(code_point_order, 'postgresql')
+def _compile_code_point_order_postgresql(element, compiler, **kwargs):
+    return f'{compiler.process(element.clauses, **kwargs)} COLLATE "C"'
+
+
+# sort and prefix search keys of the student list, each backed by an (exam_id, key) index below.
+# Keys are in code point order, which the prefix ranges of server/services/core/search.py rely on.
+STUDENT_SORT_KEYS = {
+    'name': code_point_order(func.lower(Student.name)),
+    'email': code_point_order(func.lower(Student.email)),
+    'sid': code_point_order(func.coalesce(Student.sid, '')),
+    'canvas_id': code_point_order(Student.canvas_id),
+}
+Index('ix_students_exam_id_lower_name', Student.exam_id, STUDENT_SORT_KEYS['name'])
+Index('ix_students_exam_id_lower_email', Student.exam_id, STUDENT_SORT_KEYS['email'])
+Index('ix_students_exam_id_sid', Student.exam_id, STUDENT_SORT_KEYS['sid'])
+# the canvas id key is the plain column on SQLite, already covered by uq_students_exam_id_canvas_id
+_POSTGRES_STUDENT_SORT_DDL = [
+    'CREATE INDEX IF NOT EXISTS ix_students_exam_id_canvas_id_c ON students (exam_id, canvas_id COLLATE "C")',
+]
+for statement in _POSTGRES_STUDENT_SORT_DDL:
+    event.listen(Student.__table__, 'after_create', DDL(statement).execute_if(dialect='postgresql'))
+
+# substring search over name, email, student id and canvas id, see server/services/core/search.py:
+# an FTS5 trigram table on SQLite, kept in sync by triggers, and a trigram index on PostgreSQL
+STUDENT_SEARCH_DOCUMENT = func.lower(
+    Student.name + ' ' + Student.email + ' ' + func.coalesce(Student.sid, '') + ' ' + Student.canvas_id)
+_SQLITE_STUDENT_SEARCH_DDL = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS student_search USING fts5("
+    "name, email, sid, canvas_id, content='students', content_rowid='id', tokenize='trigram')",
+    "CREATE TRIGGER IF NOT EXISTS student_search_insert AFTER INSERT ON students BEGIN "
+    "INSERT INTO student_search(rowid, name, email, sid, canvas_id) "
+    "VALUES (new.id, new.name, new.email, new.sid, new.canvas_id); END",
+    "CREATE TRIGGER IF NOT EXISTS student_search_delete AFTER DELETE ON students BEGIN "
+    "INSERT INTO student_search(student_search, rowid, name, email, sid, canvas_id) "
+    "VALUES ('delete', old.id, old.name, old.email, old.sid, old.canvas_id); END",
+    "CREATE TRIGGER IF NOT EXISTS student_search_update AFTER UPDATE OF name, email, sid, canvas_id ON students BEGIN "
+    "INSERT INTO student_search(student_search, rowid, name, email, sid, canvas_id) "
+    "VALUES ('delete', old.id, old.name, old.email, old.sid, old.canvas_id); "
+    "INSERT INTO student_search(rowid, name, email, sid, canvas_id) "
+    "VALUES (new.id, new.name, new.email, new.sid, new.canvas_id); END",
+]
+_POSTGRES_STUDENT_SEARCH_DDL = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX IF NOT EXISTS ix_students_search_trgm ON students USING gin "
+    "((lower(name || ' ' || email || ' ' || coalesce(sid, '') || ' ' || canvas_id)) gin_trgm_ops)",
+]
+for statement in _SQLITE_STUDENT_SEARCH_DDL:
+    event.listen(Student.__table__, 'after_create', DDL(statement).execute_if(dialect='sqlite'))
+for statement in _POSTGRES_STUDENT_SEARCH_DDL:
+    event.listen(Student.__table__, 'after_create', DDL(statement).execute_if(dialect='postgresql'))
+# the FTS5 table outlives the students table otherwise, and would index rows that no longer exist
+event.listen(Student.__table__, 'before_drop', DDL('DROP TABLE IF EXISTS student_search').execute_if(dialect='sqlite'))
+
+
+def build_student_search_index(connection):
+    """
+    Create the student search index if it does not exist, and fill it from the students table.
+    This is the migration path for databases created before the index existed.
+    """
+    if connection.dialect.name == 'sqlite':
+        for statement in _SQLITE_STUDENT_SEARCH_DDL:
+            connection.exec_driver_sql(statement)
+        connection.exec_driver_sql("INSERT INTO student_search(student_search) VALUES ('rebuild')")
+    elif connection.dialect.name == 'postgresql':
+        for statement in _POSTGRES_STUDENT_SEARCH_DDL:
+            connection.exec_driver_sql(statement)
+
+
 class SeatAssignment(db.Model):
     __tablename__ = 'seat_assignments'
     __table_args__ = (
         PrimaryKeyConstraint('student_id', 'seat_id'),
+        Index('ix_seat_assignments_exam_id_emailed', 'exam_id', 'emailed'),
     )
     student_id = db.Column(db.ForeignKey('students.id', ondelete='CASCADE'), index=True, nullable=False)
     seat_id = db.Column(db.ForeignKey('seats.id', ondelete='CASCADE'), index=True, nullable=False)
+    # copy of student.exam_id, set on flush (bulk inserts must pass it), for exam-scoped reads, counts and deletes
+    exam_id = db.Column(db.ForeignKey('exams.id', ondelete='CASCADE'), nullable=False)
     emailed = db.Column(db.Boolean, default=False, index=True, nullable=False)
 
+    exam = db.relationship('Exam', uselist=False)
+
+
+class PreferenceClass(db.Model):
+    """
+    A distinct combination of student constraints, stored once and shared by every student who has it.
+    Rows are found by key, a hash of the canonical (lower-cased, sorted) constraints.
+    """
+    __tablename__ = 'preference_classes'
+    id = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(64), nullable=False, unique=True)
+    wants = db.Column(StringSet, nullable=False)
+    avoids = db.Column(StringSet, nullable=False)
+    room_wants = db.Column(StringSet, nullable=False)
+    room_avoids = db.Column(StringSet, nullable=False)
+    prefers = db.Column(StringSet, nullable=False)
+
+    @staticmethod
+    def canonical(wants, avoids, room_wants, room_avoids, prefers) -> tuple:
+        return (tuple(sorted({attr.lower() for attr in wants or ()})),
+                tuple(sorted({attr.lower() for attr in avoids or ()})),
+                tuple(sorted({str(room_id) for room_id in room_wants or ()})),
+                tuple(sorted({str(room_id) for room_id in room_avoids or ()})),
+                tuple(sorted({attr.lower() for attr in prefers or ()})))
+
+    @staticmethod
+    def key_for(canonical: tuple) -> str:
+        return hashlib.sha256(json.dumps(canonical).encode()).hexdigest()
+
+    def __repr__(self):
+        return '<PreferenceClass {}>'.format(self.id)
+
+
+class StudentPreference(db.Model):
+    """
+    Link between a student and an attribute they want, avoid or prefer (see PreferenceKind).
+    """
+    __tablename__ = 'student_preferences'
+    __table_args__ = (
+        PrimaryKeyConstraint('student_id', 'attribute_id', 'kind'),
+        Index('ix_student_preferences_attribute_id_kind', 'attribute_id', 'kind'),
+    )
+    student_id = db.Column(db.ForeignKey('students.id', ondelete='CASCADE'), nullable=False)
+    attribute_id = db.Column(db.ForeignKey('attributes.id', ondelete='CASCADE'), nullable=False)
+    kind = db.Column(db.String(16), nullable=False)
+
+    attribute = db.relationship('Attribute')
+
+
+_STUDENT_PREFERENCE_COLUMNS = {
+    PreferenceKind.WANT: 'wants',
+    PreferenceKind.AVOID: 'avoids',
+    PreferenceKind.PREFER: 'prefers',
+}
+
+
+_PREFERENCE_CLASS_COLUMNS = ('wants', 'avoids', 'room_wants', 'room_avoids', 'prefers')
+
+
+def student_preference_links(student) -> set[tuple[str, str]]:
+    """
+    The (kind, lower-cased attribute name) pairs of the wants, avoids and prefers of a student.
+    """
+    return {(kind.value, attr.lower()) for kind, column in _STUDENT_PREFERENCE_COLUMNS.items()
+            for attr in getattr(student, column) or ()}
+
+
+def _load_links(session, relationship, instances, target_relationship=None, batch_size=1000):
+    """
+    Load relationship (and target_relationship of what it points to) for the persistent instances
+    that do not have it loaded yet, with one query per batch_size instances instead of one lazy load each.
+    """
+    model, option = relationship.class_, selectinload(relationship)
+    if target_relationship is not None:
+        option = option.joinedload(target_relationship)
+    ids = [inspect(instance).identity[0] for instance in instances
+           if inspect(instance).persistent and relationship.key not in inspect(instance).dict]
+    for batch in chunked(ids, batch_size):
+        session.query(model).filter(model.id.in_(batch)).options(option).all()
+
+
+def sync_attribute_links(session, seats, students):
+    """
+    Rebuild the attribute links of the given seats and students from their comma-joined columns,
+    interning new attribute names. Runs one query for the whole batch.
+    """
+    seat_names = {seat: {attr.lower() for attr in seat.attributes or ()} for seat in seats}
+    student_names = {student: student_preference_links(student) for student in students}
+    names = set().union(*seat_names.values(), *({name for _, name in links} for links in student_names.values()))
+    with session.no_autoflush:
+        _load_links(session, Seat.attribute_refs, seats)
+        _load_links(session, Student.preference_links, students, StudentPreference.attribute)
+        attributes = {attribute.name: attribute
+                      for attribute in session.query(Attribute).filter(Attribute.name.in_(names))} if names else {}
+        for name in names - attributes.keys():
+            attributes[name] = Attribute(name=name)
+            session.add(attributes[name])
+        for seat, names in seat_names.items():
+            seat.attribute_refs = [attributes[name] for name in sorted(names)]
+        for student, links in student_names.items():
+            existing = {(link.kind, link.attribute.name): link for link in student.preference_links}
+            student.preference_links = [
+                existing.get((kind, name)) or StudentPreference(kind=kind, attribute=attributes[name])
+                for kind, name in sorted(links)
+            ]
+
+
+def sync_preference_classes(session, students):
+    """
+    Point each of the given students to the preference class of their constraints,
+    creating the classes not seen before. Runs one query for the whole batch.
+    """
+    canonicals = {student: PreferenceClass.canonical(student.wants, student.avoids, student.room_wants,
+                                                     student.room_avoids, student.prefers)
+                  for student in students}
+    keys = {canonical: PreferenceClass.key_for(canonical) for canonical in set(canonicals.values())}
+    if not keys:
+        return
+    with session.no_autoflush:
+        classes = {preference_class.key: preference_class for preference_class in
+                   session.query(PreferenceClass).filter(PreferenceClass.key.in_(list(keys.values())))}
+        for canonical, key in keys.items():
+            if key not in classes:
+                wants, avoids, room_wants, room_avoids, prefers = (set(values) for values in canonical)
+                classes[key] = PreferenceClass(key=key, wants=wants, avoids=avoids, room_wants=room_wants,
+                                               room_avoids=room_avoids, prefers=prefers)
+                session.add(classes[key])
+        for student, canonical in canonicals.items():
+            student.preference_class = classes[keys[canonical]]
+
+
+def set_exam_id(session, instance):
+    """
+    Copy the exam of a new seat from its room, and of a new seat assignment from its student (or seat).
+    Parents that are not flushed yet are assigned as objects, so the unit of work fills the id after inserting them;
+    parents only referred to by id are looked up.
+    """
+    if instance.exam_id is not None:
+        return
+    if isinstance(instance, Seat):
+        parent, parent_model, parent_id = instance.room, Room, instance.room_id
+    elif instance.student is not None or instance.student_id is not None:
+        parent, parent_model, parent_id = instance.student, Student, instance.student_id
+    else:
+        parent, parent_model, parent_id = instance.seat, Seat, instance.seat_id
+        if parent is not None:
+            set_exam_id(session, parent)
+    if parent is not None and parent.exam_id is None:
+        instance.exam = parent.exam
+    elif parent is not None:
+        instance.exam_id = parent.exam_id
+    elif parent_id is not None:
+        with session.no_autoflush:
+            instance.exam_id = session.query(parent_model.exam_id).filter(parent_model.id == parent_id).scalar()
+
+
+# columns added to tables that existed before, which create_all does not add, with the DDL adding them
+_ADDED_COLUMNS = [
+    ('students', 'prefers', "TEXT NOT NULL DEFAULT ''"),
+    ('students', 'section', 'VARCHAR(255)'),
+    ('students', 'preference_class_id', 'INTEGER REFERENCES preference_classes (id)'),
+    ('seats', 'exam_id', 'INTEGER REFERENCES exams (id) ON DELETE CASCADE'),
+    ('seat_assignments', 'exam_id', 'INTEGER REFERENCES exams (id) ON DELETE CASCADE'),
+]
+# fill the added columns that copy the exam of a parent row
+_BACKFILL_COPIED_COLUMNS = [
+    'UPDATE seats SET exam_id = (SELECT rooms.exam_id FROM rooms WHERE rooms.id = seats.room_id) '
+    'WHERE exam_id IS NULL',
+    'UPDATE seat_assignments SET exam_id = '
+    '(SELECT students.exam_id FROM students WHERE students.id = seat_assignments.student_id) '
+    'WHERE exam_id IS NULL',
+]
+
+
+def upgrade_tables(connection):
+    """
+    Bring the tables of a database created before the normalized tables up to date:
+    create the new tables, add the new columns of existing tables, copy the exam of seats and seat assignments
+    from their room and student, and create the missing indexes.
+    The copied columns are then made NOT NULL on PostgreSQL; SQLite cannot change it on an existing column.
+    On PostgreSQL, student sort key indexes in the order of the locale are replaced by code point ordered ones.
+    If students share an exam and a canvas id, which must be unique now, raise a DataValidationError
+    before changing anything.
+    Safe to run more than once. Return the added columns, as "table.column".
+    """
+    if inspect(connection).has_table('students') and 'uq_students_exam_id_canvas_id' not in _index_names(connection):
+        _check_unique_student_keys(connection)
+    db.metadata.create_all(connection)
+    added = _add_columns(connection)
+    if connection.dialect.name == 'postgresql':
+        _upgrade_student_sort_indexes(connection)
+    _create_indexes(connection)
+    return added
+
+
+def _add_columns(connection) -> list[str]:
+    """
+    Add the missing columns of _ADDED_COLUMNS, fill the ones copied from a parent row,
+    and make those NOT NULL on PostgreSQL. Return the added columns, as "table.column".
+    """
+    existing = {table: {column['name'] for column in inspect(connection).get_columns(table)}
+                for table in {table for table, _, _ in _ADDED_COLUMNS}}
+    added = []
+    for table, column, ddl in _ADDED_COLUMNS:
+        if column not in existing[table]:
+            connection.exec_driver_sql(f'ALTER TABLE {table} ADD COLUMN {column} {ddl}')
+            added.append(f'{table}.{column}')
+    for statement in _BACKFILL_COPIED_COLUMNS:
+        connection.exec_driver_sql(statement)
+    if connection.dialect.name == 'postgresql':
+        for table in ('seats', 'seat_assignments'):
+            connection.exec_driver_sql(f'ALTER TABLE {table} ALTER COLUMN exam_id SET NOT NULL')
+    return added
+
+
+def _upgrade_student_sort_indexes(connection):
+    """
+    On PostgreSQL, replace the student sort and prefix search indexes in the order of the locale
+    by code point ordered ones, and create the PostgreSQL-only ones (see _POSTGRES_STUDENT_SORT_DDL).
+    """
+    _drop_locale_ordered_sort_indexes(connection)
+    for statement in _POSTGRES_STUDENT_SORT_DDL:
+        connection.exec_driver_sql(statement)
+
+
+def _create_indexes(connection):
+    """
+    Create the indexes of the models missing from the database, and drop the ones they replace.
+    """
+    index_names = _index_names(connection)
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name not in index_names:
+                index.create(connection)
+    # the non-unique (exam_id, canvas_id) index of earlier versions, replaced by uq_students_exam_id_canvas_id
+    connection.exec_driver_sql('DROP INDEX IF EXISTS ix_students_exam_id_canvas_id')
+
+
+def _check_unique_student_keys(connection, sample_size=10):
+    """
+    Raise a DataValidationError if students share an exam and a canvas id, which earlier versions allowed,
+    since the unique index on them, the key of imported rows, cannot be created then.
+    """
+    duplicates = connection.execute(
+        select(Student.exam_id, Student.canvas_id, func.count())
+        .group_by(Student.exam_id, Student.canvas_id).having(func.count() > 1)
+        .order_by(Student.exam_id, Student.canvas_id)).all()
+    if duplicates:
+        sample = ', '.join(f'exam {exam_id} canvas id {canvas_id} ({count} rows)'
+                           for exam_id, canvas_id, count in duplicates[:sample_size])
+        raise DataValidationError(
+            f'{len(duplicates)} canvas ids belong to more than one student of the same exam: {sample}'
+            f'{", ..." if len(duplicates) > sample_size else ""}. '
+            'Merge or delete the duplicate students, then run the upgrade again.')
+
+
+def _drop_locale_ordered_sort_indexes(connection):
+    """
+    Drop the student sort key indexes created before the keys were in code point order (see code_point_order),
+    which PostgreSQL cannot use for the keys anymore; they are created again by upgrade_tables.
+    """
+    names = [index.name for index in Student.__table__.indexes
+             if any(isinstance(expression, code_point_order) for expression in index.expressions)]
+    stale = connection.execute(text(
+        "SELECT indexname FROM pg_indexes WHERE tablename = 'students' AND indexname IN :names "
+        "AND indexdef NOT LIKE '%COLLATE \"C\"%'").bindparams(bindparam('names', expanding=True)), {'names': names})
+    for name in stale.scalars():
+        connection.exec_driver_sql(f'DROP INDEX {name}')
+
+
+def _index_names(connection) -> set[str]:
+    """
+    The names of the indexes in the database, from the catalog, since reflection skips expression indexes.
+    """
+    if connection.dialect.name == 'sqlite':
+        return set(connection.exec_driver_sql("SELECT name FROM sqlite_master WHERE type = 'index'").scalars())
+    if connection.dialect.name == 'postgresql':
+        return set(connection.exec_driver_sql('SELECT indexname FROM pg_indexes').scalars())
+    inspector = inspect(connection)
+    return {index['name'] for table in inspector.get_table_names() for index in inspector.get_indexes(table)}
+
+
+def backfill_normalized_tables(session, batch_size=1000):
+    """
+    Build the attribute links of every existing seat and student, and the preference classes of every student,
+    in batches of batch_size rows, committing after each batch.
+    This is the migration path for data stored before these tables existed, run after upgrade_tables.
+    Return the number of seats and students processed.
+    """
+    counts = []
+    for model in (Seat, Student):
+        count, last_id = 0, 0
+        while True:
+            batch = session.query(model).filter(model.id > last_id).order_by(model.id).limit(batch_size).all()
+            if not batch:
+                break
+            sync_attribute_links(session, batch if model is Seat else [], batch if model is Student else [])
+            if model is Student:
+                sync_preference_classes(session, batch)
+            session.commit()
+            count, last_id = count + len(batch), batch[-1].id
+        counts.append(count)
+    return tuple(counts)
+
+
+def _has_changes(instance, *keys):
+    state = inspect(instance)
+    return any(state.attrs[key].history.has_changes() for key in keys)
+
+
+@event.listens_for(db.session, 'before_flush')
+def _sync_normalized_tables_on_flush(session, flush_context, instances):
+    changed = [instance for instance in session.new] + [instance for instance in session.dirty]
+    for instance in session.new:
+        if isinstance(instance, (Seat, SeatAssignment)):
+            set_exam_id(session, instance)
+
+    def new_or_changed(model, *keys):
+        return [instance for instance in changed
+                if isinstance(instance, model) and (instance in session.new or _has_changes(instance, *keys))]
+    seats = new_or_changed(Seat, 'attributes')
+    students = new_or_changed(Student, *_STUDENT_PREFERENCE_COLUMNS.values())
+    if seats or students:
+        sync_attribute_links(session, seats, students)
+    students = new_or_changed(Student, *_PREFERENCE_CLASS_COLUMNS)
+    if students:
+        sync_preference_classes(session, students)
+
 
 def slug(display_name):
     return re.sub(r'[^A-Za-z0-9._-]', '', display_name.lower())
@@ -1,31 +1,68 @@
+import heapq
 import random
+from collections import Counter, defaultdict
+
+from natsort import natsorted
+from sqlalchemy import func
 
 from server.models import Seat, SeatAssignment, Student
+from server.typings.enum import AssignmentMode, FillStrategy
 from server.typings.exception import NotEnoughSeatError, SeatOverrideError
+from server.utils.flow import FlowNetwork
 from server.utils.misc import arr_to_dict
+from server.utils.spatial import SeatGrid
 
 
 class Preference:
-    def __init__(self, wants: set[str], avoids: set[str], room_wants: set[str], room_avoids: set[str]):
-        self.wants = wants
-        self.avoids = avoids
-        self.room_wants = room_wants
-        self.room_avoids = room_avoids
+    """
+    Seating constraints of a student, compiled for fast repeated checks.
+    Attributes are lower-cased and room ids are converted to integers once, on construction.
+    wants, avoids, room_wants and room_avoids are hard constraints; prefers are soft wants,
+    only considered by the soft preference assignment mode.
+    """
+    __slots__ = ('wants', 'avoids', 'room_wants', 'room_avoids', 'prefers', '_hash')
+
+    def __init__(self, wants: set[str], avoids: set[str], room_wants: set[str], room_avoids: set[str],
+                 prefers: set[str] = frozenset()):
+        self.wants = frozenset(want.lower() for want in wants)
+        self.avoids = frozenset(avoid.lower() for avoid in avoids)
+        self.room_wants = frozenset(int(room_id) for room_id in room_wants)
+        self.room_avoids = frozenset(int(room_id) for room_id in room_avoids)
+        self.prefers = frozenset(prefer.lower() for prefer in prefers)
+        self._hash = hash((self.wants, self.avoids, self.room_wants, self.room_avoids, self.prefers))
+
+    def is_satisfied_by(self, signature: tuple[frozenset[str], int]):
+        """
+        Check if a seat signature (see Seat.signature) meets this preference.
+        """
+        attributes, room_id = signature
+        return self.wants <= attributes and self.avoids.isdisjoint(attributes) \
+            and (not self.room_wants or room_id in self.room_wants) and room_id not in self.room_avoids
+
+    def satisfaction(self, signature: tuple[frozenset[str], int]) -> int:
+        """
+        Return how many soft wants a seat signature meets.
+        """
+        return len(self.prefers & signature[0])
 
     def __hash__(self):
-        return hash((frozenset(self.wants), frozenset(self.avoids), frozenset(self.room_wants), frozenset(self.room_avoids)))
+        return self._hash
+
+    def __reduce__(self):
+        # the cached hash must not be pickled: string hashes differ between processes
+        return Preference, (self.wants, self.avoids, self.room_wants, self.room_avoids, self.prefers)
 
     def __eq__(self, other):
-        return (self.wants, self.avoids, self.room_wants, self.room_avoids) == (other.wants, other.avoids, other.room_wants, other.room_avoids)  # noqa
+        return (self.wants, self.avoids, self.room_wants, self.room_avoids, self.prefers) == (other.wants, other.avoids, other.room_wants, other.room_avoids, other.prefers)  # noqa
 
     def __ne__(self, other):
         return not (self == other)
 
     def __repr__(self):
-        return f'Preference(wants={self.wants}, avoids={self.avoids}, room_wants={self.room_wants}, room_avoids={self.room_avoids})'  # noqa
+        return f'Preference(wants={set(self.wants)}, avoids={set(self.avoids)}, room_wants={set(self.room_wants)}, room_avoids={set(self.room_avoids)}, prefers={set(self.prefers)})'  # noqa
 
     def __str__(self):
-        return f'Preference(wants={self.wants}, avoids={self.avoids}, room_wants={self.room_wants}, room_avoids={self.room_avoids})'  # noqa
+        return self.__repr__()
 
 
 def is_seat_valid_for_preference(seat: Seat, preference: Preference):
@@ -33,12 +70,7 @@ def is_seat_valid_for_preference(seat: Seat, preference: Preference):
     Check if a seat is valid for a given preference.
     Comparison of attributes is case-insensitive.
     """
-    wants, avoids, room_wants, room_avoids = preference.wants, preference.avoids, preference.room_wants, preference.room_avoids
-    return (all(want.lower() in {attr.lower() for attr in seat.attributes} for want in wants) and  # noqa
-            all(avoid.lower() not in {attr.lower() for attr in seat.attributes} for avoid in avoids) and  # noqa
-            (not room_wants or any(int(a) == seat.room.id for a in room_wants)) and  # noqa
-            all(int(a) != seat.room.id for a in room_avoids)  # noqa
-            )
+    return preference.is_satisfied_by(seat.signature)
 
 
 def filter_seats_by_preference(seats, preference: Preference):
@@ -46,14 +78,309 @@ def filter_seats_by_preference(seats, preference: Preference):
     Return seats available for a given preference.
     Comparison of attributes is case-insensitive.
     """
-    return [seat for seat in seats if is_seat_valid_for_preference(seat, preference)]
+    return [seat for seat in seats if preference.is_satisfied_by(seat.signature)]
 
 
 def get_preference_from_student(student):
-    return Preference(student.wants, student.avoids, student.room_wants, student.room_avoids)
+    return Preference(student.wants, student.avoids, student.room_wants, student.room_avoids, student.prefers or set())
+
+
+class FeasibilityMatrix:
+    """
+    Boolean matrix of preference classes x seat signatures.
+
+    Each signature is a column. Attributes and room ids are encoded as bit columns
+    (an integer whose j-th bit is set if signature j has that attribute / room),
+    so the row of a preference class is computed with a few bitwise operations
+    instead of checking every seat one by one.
+    """
+
+    def __init__(self, preferences, signatures):
+        self.signatures: list[tuple] = list(signatures)
+        self._all = (1 << len(self.signatures)) - 1
+        self._attribute_columns: dict[str, int] = defaultdict(int)
+        self._room_columns: dict[int, int] = defaultdict(int)
+        for j, (attributes, room_id) in enumerate(self.signatures):
+            bit = 1 << j
+            for attribute in attributes:
+                self._attribute_columns[attribute] |= bit
+            self._room_columns[room_id] |= bit
+        self.rows: dict[Preference, int] = {preference: self._compute_row(preference) for preference in preferences}
+
+    def _compute_row(self, preference: Preference) -> int:
+        row = self._all
+        for want in preference.wants:
+            row &= self._attribute_columns.get(want, 0)
+        for avoid in preference.avoids:
+            row &= ~self._attribute_columns.get(avoid, 0)
+        if preference.room_wants:
+            wanted_rooms = 0
+            for room_id in preference.room_wants:
+                wanted_rooms |= self._room_columns.get(room_id, 0)
+            row &= wanted_rooms
+        for room_id in preference.room_avoids:
+            row &= ~self._room_columns.get(room_id, 0)
+        return row & self._all
+
+    def row(self, preference: Preference) -> int:
+        if preference not in self.rows:
+            self.rows[preference] = self._compute_row(preference)
+        return self.rows[preference]
+
+    def feasible_signatures(self, preference: Preference) -> list[tuple]:
+        """
+        Return the signatures (columns) that satisfy the given preference (row).
+        """
+        row, signatures = self.row(preference), []
+        while row:
+            lowest = row & -row
+            signatures.append(self.signatures[lowest.bit_length() - 1])
+            row ^= lowest
+        return signatures
+
+    def count(self, preference: Preference, free_columns: int = -1) -> int:
+        """
+        Return the number of feasible columns for the given preference,
+        optionally restricted to the columns set in free_columns.
+        """
+        return (self.row(preference) & free_columns).bit_count()
+
+
+class SeatAvailabilityIndex:
+    """
+    Availability index used by assign_students.
 
+    Seats are bucketed by signature, and every preference class keeps track of
+    the buckets it may use (from a FeasibilityMatrix) and of its remaining capacity (the number of free seats
+    it could still take). A heap ordered by remaining capacity gives the most
+    constrained preference class, and taking a seat only updates the classes
+    that may use the seat's bucket.
 
-def assign_students(exam):
+    The fill strategy decides which valid seat is taken. Per-room counters of taken seats
+    are kept as seats are taken, for the strategies that look at rooms.
+    """
+
+    def __init__(self, students, seats, rng: random.Random = None, fill: FillStrategy = FillStrategy.RANDOM,
+                 room_order: list[int] = None):
+        """
+        students and seats are StudentRecord and SeatRecord instances (see ExamSnapshot).
+        rng is the source of randomness for picking students and seats (seed it for reproducible runs).
+        room_order lists room ids by priority, for FillStrategy.PACK; the rooms it leaves out come after it,
+        by id. By default, rooms are ordered by id, which is the order they were added to the exam:
+        assign_students does not pass an order, as rooms have no priority of their own.
+        """
+        self.rng = rng or random.Random()
+        self.fill = fill
+        self.students_by_preference: dict[Preference, list] = \
+            arr_to_dict(students, key_getter=lambda student: student.preference)
+        self.seats_by_signature: dict[tuple, list] = arr_to_dict(seats, key_getter=lambda seat: seat.signature)
+        # position of every available seat in its signature bucket, so any seat can be removed in O(1)
+        self._positions: dict[int, int] = {
+            seat.id: i for bucket in self.seats_by_signature.values() for i, seat in enumerate(bucket)}
+        self.matrix = FeasibilityMatrix(self.students_by_preference, self.seats_by_signature)
+        self.signatures_by_preference: dict[Preference, list[tuple]] = {
+            preference: self.matrix.feasible_signatures(preference)
+            for preference in self.students_by_preference
+        }
+        self.preferences_by_signature: dict[tuple, list[Preference]] = defaultdict(list)
+        for preference, signatures in self.signatures_by_preference.items():
+            for signature in signatures:
+                self.preferences_by_signature[signature].append(preference)
+        self.capacity: dict[Preference, int] = {
+            preference: sum(len(self.seats_by_signature[signature]) for signature in signatures)
+            for preference, signatures in self.signatures_by_preference.items()
+        }
+        # heap entries are (capacity, insertion order, preference); stale entries are skipped lazily
+        self._order = {preference: i for i, preference in enumerate(self.students_by_preference)}
+        self._heap = [(self.capacity[preference], i, preference) for preference, i in self._order.items()]
+        heapq.heapify(self._heap)
+
+        # seats free at the start and seats taken so far, per room
+        self.room_sizes: Counter = Counter()
+        for signature, bucket in self.seats_by_signature.items():
+            self.room_sizes[signature[1]] += len(bucket)
+        self.room_taken: Counter = Counter()
+        room_order = list(room_order or []) + sorted(set(self.room_sizes).difference(room_order or []))
+        self._room_rank = {room_id: i for i, room_id in enumerate(room_order)}
+        if fill == FillStrategy.FRONT_FIRST:
+            self._front_heaps = self._build_front_heaps()
+
+    def __bool__(self):
+        return bool(self.students_by_preference)
+
+    def most_constrained_preference(self) -> Preference:
+        """
+        Return the preference class with students left and the fewest available seats.
+        """
+        while True:
+            capacity, _, preference = self._heap[0]
+            if preference in self.students_by_preference and self.capacity[preference] == capacity:
+                return preference
+            heapq.heappop(self._heap)
+
+    def pop_student(self, preference: Preference):
+        """
+        Remove and return a random student of the given preference class.
+        """
+        students = self.students_by_preference[preference]
+        i = self.rng.randrange(len(students))
+        students[i], students[-1] = students[-1], students[i]
+        student = students.pop()
+        if not students:
+            del self.students_by_preference[preference]
+        return student
+
+    def pop_seat(self, preference: Preference, exclude: set[int] = None, cost=None, attempts: int = 8):
+        """
+        Remove and return an available seat valid for the given preference class, picked by the fill strategy
+        (see _pick); with FillStrategy.RANDOM, every valid seat is equally likely to be chosen.
+
+        With exclude or cost, up to attempts candidates are picked instead of one. Picking does not remove a seat,
+        so candidates that are not chosen stay available, and a seat may be picked more than once.
+        Candidates whose ids are in exclude are skipped. Without cost, the first candidate not skipped is taken;
+        with cost (a function of a seat), the cheapest one is taken, the first picked on ties.
+        If every candidate was skipped, one of the valid seats not in exclude is taken uniformly at random,
+        whatever the fill strategy and cost. Return None if there is none.
+        With FillStrategy.FRONT_FIRST, a signature's candidate is the top of its front heap, whose unavailable
+        seats are only dropped when they reach the top, so it is the same seat until that seat is taken.
+        """
+        picks = []
+        for _ in range(attempts if exclude or cost else 1):
+            signature, i = self._pick(preference)
+            if not exclude or self.seats_by_signature[signature][i].id not in exclude:
+                if not cost:
+                    return self._take(signature, i)
+                picks.append((signature, i))
+        if not picks:
+            picks = [(signature, i) for signature in self.signatures_by_preference[preference]
+                     for i, seat in enumerate(self.seats_by_signature[signature]) if seat.id not in exclude]
+            if not picks:
+                return None
+            picks = [self.rng.choice(picks)]
+        if cost and len(picks) > 1:
+            picks.sort(key=lambda pick: cost(self.seats_by_signature[pick[0]][pick[1]]))
+        return self._take(*picks[0])
+
+    def is_available(self, seat) -> bool:
+        return seat.id in self._positions
+
+    def remove_seat(self, seat):
+        """
+        Make the given seat unavailable (without counting it as taken), if it still is.
+        """
+        if seat.id in self._positions:
+            self._take(seat.signature, self._positions[seat.id], taken=False)
+
+    def _pick(self, preference: Preference) -> tuple[tuple, int]:
+        """
+        Return the (signature, position) of the available seat to take next for the given preference class,
+        according to the fill strategy.
+        """
+        if self.fill == FillStrategy.RANDOM:
+            return self._locate(self.signatures_by_preference[preference],
+                                self.rng.randrange(self.capacity[preference]))
+        if self.fill == FillStrategy.FRONT_FIRST:
+            signature, _ = self._locate(self.signatures_by_preference[preference],
+                                        self.rng.randrange(self.capacity[preference]))
+            return signature, self._front_position(signature)
+        # PACK and BALANCE: a random seat of the best room
+        room_key = self._room_rank.get if self.fill == FillStrategy.PACK \
+            else lambda room_id: self.room_taken[room_id] / self.room_sizes[room_id]
+        signatures = [signature for signature in self.signatures_by_preference[preference]
+                      if self.seats_by_signature[signature]]
+        best = min(room_key(signature[1]) for signature in signatures)
+        signatures = [signature for signature in signatures if room_key(signature[1]) == best]
+        return self._locate(signatures,
+                            self.rng.randrange(sum(len(self.seats_by_signature[s]) for s in signatures)))
+
+    def _locate(self, signatures: list[tuple], i: int) -> tuple[tuple, int]:
+        """
+        Return the (signature, position) of the i-th available seat of the given signatures.
+        """
+        for signature in signatures:
+            seats = self.seats_by_signature[signature]
+            if i < len(seats):
+                return signature, i
+            i -= len(seats)
+        raise IndexError(i)
+
+    def _build_front_heaps(self) -> dict[tuple, list]:
+        """
+        Build, for every signature, a heap of its seats ordered by row (as in Room.rows), then randomly.
+        Movable seats come after every row.
+        """
+        rows_by_room = defaultdict(set)
+        for signature, seats in self.seats_by_signature.items():
+            rows_by_room[signature[1]].update(seat.row for seat in seats if seat.row is not None)
+        row_ranks = {room_id: {row: i for i, row in enumerate(natsorted(rows))}
+                     for room_id, rows in rows_by_room.items()}
+        heaps = {}
+        for signature, seats in self.seats_by_signature.items():
+            ranks = row_ranks[signature[1]]
+            heaps[signature] = [(ranks.get(seat.row, len(ranks)), self.rng.random(), seat.id) for seat in seats]
+            heapq.heapify(heaps[signature])
+        return heaps
+
+    def _front_position(self, signature: tuple) -> int:
+        """
+        Return the position of the front-most available seat of the signature.
+        Seats no longer available are dropped from the heap lazily.
+        """
+        heap = self._front_heaps[signature]
+        while heap[0][2] not in self._positions:
+            heapq.heappop(heap)
+        return self._positions[heap[0][2]]
+
+    def _take(self, signature: tuple, i: int, taken=True):
+        seats = self.seats_by_signature[signature]
+        seats[i], seats[-1] = seats[-1], seats[i]
+        self._positions[seats[i].id] = i
+        seat = seats.pop()
+        del self._positions[seat.id]
+        if taken:
+            self.room_taken[signature[1]] += 1
+        for affected in self.preferences_by_signature[signature]:
+            self.capacity[affected] -= 1
+            if affected in self.students_by_preference:
+                heapq.heappush(self._heap, (self.capacity[affected], self._order[affected], affected))
+        return seat
+
+
+def assign_students(exam, mode: AssignmentMode = AssignmentMode.GREEDY, snapshot=None,
+                    seed: int = None, spacing: float = 2.0,
+                    fill: FillStrategy = FillStrategy.RANDOM) -> list[tuple[int, int]]:
+    """
+    Assign seats to all unassigned students of the exam, using the given mode.
+    See assign_students_greedily, assign_students_by_matching, assign_students_optimized
+    and assign_students_with_spacing (which uses spacing, in seat coordinate units).
+    The fill strategy applies to the greedy, optimize and spacing modes, which pick seats one by one.
+    The incremental mode ignores the snapshot (see assign_students_incrementally).
+
+    The algorithm runs on a detached ExamSnapshot (loaded from the exam if not given),
+    and returns (student id, seat id) pairs, to be inserted by the caller.
+    Runs with the same seed on the same snapshot give the same result.
+    """
+    if mode == AssignmentMode.INCREMENTAL:
+        from server.services.core.incremental import assign_students_incrementally
+        return assign_students_incrementally(exam, seed=seed)
+    if snapshot is None:
+        from server.services.core.snapshot import ExamSnapshot
+        snapshot = ExamSnapshot.load(exam)
+    if mode == AssignmentMode.OPTIMIZE:
+        from server.services.core.optimize import assign_students_optimized
+        return assign_students_optimized(exam, snapshot, seed=seed, fill=fill)
+    index = SeatAvailabilityIndex(snapshot.students, snapshot.seats, random.Random(seed), fill=fill)
+    if mode == AssignmentMode.MATCHING:
+        return assign_students_by_matching(exam, index)
+    if mode == AssignmentMode.SOFT_PREFERENCE:
+        return assign_students_by_matching(exam, index, use_soft_preferences=True)
+    if mode in (AssignmentMode.SPACED, AssignmentMode.SEPARATE_SECTIONS):
+        return assign_students_with_spacing(exam, index, snapshot, spacing,
+                                            separate_sections=mode == AssignmentMode.SEPARATE_SECTIONS)
+    return assign_students_greedily(exam, index)
+
+
+def assign_students_greedily(exam, index: SeatAvailabilityIndex):
     """
     The strategy:
     Look for students whose requirements are the most restrictive
@@ -61,60 +388,208 @@ def assign_students(exam):
     Randomly assign them a seat.
     Repeat.
     """
-    students = set(exam.unassigned_students)
-    seats = set(exam.unassigned_seats)
+    assignments = []
+    while index:
+        min_preference: Preference = index.most_constrained_preference()
+        if not index.capacity[min_preference]:
+            raise NotEnoughSeatError(exam, index.students_by_preference[min_preference], min_preference)
+
+        student = index.pop_student(min_preference)
+        seat = index.pop_seat(min_preference)
+
+        assignments.append((student.id, seat.id))
+    return assignments
+
+
+def assign_students_with_spacing(exam, index: SeatAvailabilityIndex, snapshot, spacing: float,
+                                 separate_sections=False):
+    """
+    The strategy:
+    Same as assign_students_greedily, but every taken seat also blocks the fixed seats
+        of its room closer to it than spacing: for every student, or, with separate_sections,
+        only for students of the same section (students without a section are never blocked).
+    Seats already occupied in the snapshot block their neighbours the same way.
+    Neighbours come from a SeatGrid built once, so blocking costs O(1) per seat taken.
+    Of a few random valid seats, the one with the fewest available neighbours is taken,
+        which wastes fewer seats than a uniform pick (seats next to blocked ones go first).
+    There is no backtracking: a run can fail even when a spaced assignment exists.
+    """
+    grid = SeatGrid(snapshot.seats, spacing)
+    blocked_by_section: dict[str, set[int]] = defaultdict(set)
+
+    def available_neighbors(seat):
+        return sum(1 for neighbor in grid.neighbors(seat) if index.is_available(neighbor))
+
+    def block_around(seat, section):
+        if separate_sections:
+            if section is not None:
+                blocked_by_section[section].update(neighbor.id for neighbor in grid.neighbors(seat))
+        else:
+            for neighbor in grid.neighbors(seat):
+                index.remove_seat(neighbor)
+
+    for seat, section in snapshot.occupied_seats:
+        block_around(seat, section)
 
     assignments = []
-    while students:
-        students_by_preference: dict[Preference, list[Student]] = \
-            arr_to_dict(students, key_getter=get_preference_from_student)
-        seats_by_preference: dict[Preference, list[Seat]] = {
-            preference: filter_seats_by_preference(seats, preference)
-            for preference in students_by_preference.keys()
-        }
-        min_preference: Preference = min(seats_by_preference,
-                                         key=lambda k: len(seats_by_preference[k]))
-        min_students: list[Student] = students_by_preference[min_preference]
-        min_seats: list[Seat] = seats_by_preference[min_preference]
+    while index:
+        min_preference: Preference = index.most_constrained_preference()
+        if not index.capacity[min_preference]:
+            raise NotEnoughSeatError(exam, index.students_by_preference[min_preference], min_preference)
 
-        if not min_seats:
-            raise NotEnoughSeatError(exam, min_students, min_preference)
+        student = index.pop_student(min_preference)
+        blocked = blocked_by_section.get(student.section) if separate_sections else None
+        seat = index.pop_seat(min_preference, exclude=blocked, cost=available_neighbors)
+        if seat is None:
+            raise NotEnoughSeatError(exam, [student] + index.students_by_preference.get(min_preference, []),
+                                     min_preference)
+        block_around(seat, student.section)
 
-        student = random.choice(min_students)
-        seat = random.choice(min_seats)
+        assignments.append((student.id, seat.id))
+    return assignments
+
+
+class AssignmentNetwork:
+    """
+    Flow network source -> preference class -> seat signature -> sink, built from counts only.
+    A class can take as many seats as it has students, a signature can give as many seats as it
+    has free seats, and a class may only use the signatures that satisfy its preference.
+    The maximum flow is computed on construction. With use_soft_preferences, it is a maximum flow
+    of minimum cost, where seating a student costs less the more of their soft wants the seat meets.
+    """
+
+    def __init__(self, student_counts: dict[Preference, int], seat_counts: dict[tuple, int],
+                 matrix: FeasibilityMatrix = None, use_soft_preferences=False):
+        self.student_counts = student_counts
+        self.seat_counts = seat_counts
+        self.preferences = list(student_counts)
+        self.signatures = list(seat_counts)
+        matrix = matrix or FeasibilityMatrix(self.preferences, self.signatures)
+        self._preference_nodes = {preference: i for i, preference in enumerate(self.preferences, start=1)}
+        self._signature_nodes = {signature: len(self.preferences) + 1 + j for j, signature in enumerate(self.signatures)}
+        self.source, self.sink = 0, len(self.preferences) + len(self.signatures) + 1
+        self.network = FlowNetwork(self.sink + 1)
+        self._source_edges, self._pair_edges = {}, {}
+        # costs must be non-negative: cost = (most soft wants any class has) - (soft wants met)
+        max_satisfaction = max((len(p.prefers) for p in self.preferences), default=0) if use_soft_preferences else 0
+        for preference, node in self._preference_nodes.items():
+            count = student_counts[preference]
+            self._source_edges[preference] = self.network.add_edge(self.source, node, count)
+            for signature in matrix.feasible_signatures(preference):
+                cost = max_satisfaction - preference.satisfaction(signature) if use_soft_preferences else 0
+                self._pair_edges[preference, signature] = \
+                    self.network.add_edge(node, self._signature_nodes[signature], count, cost)
+        for signature, node in self._signature_nodes.items():
+            self.network.add_edge(node, self.sink, seat_counts[signature])
+        if use_soft_preferences:
+            self.max_flow, _ = self.network.min_cost_flow(self.source, self.sink)
+        else:
+            self.max_flow = self.network.max_flow(self.source, self.sink)
+
+    @property
+    def is_complete(self):
+        return self.max_flow == sum(self.student_counts.values())
+
+    def matched(self, preference: Preference) -> int:
+        """
+        Return how many students of the given class the maximum flow seats.
+        """
+        return self.network.flow(self._source_edges[preference])
+
+    def pair_flows(self):
+        """
+        Yield (preference, signature, number of students) for every pair used by the maximum flow.
+        """
+        for (preference, signature), edge in self._pair_edges.items():
+            flow = self.network.flow(edge)
+            if flow:
+                yield preference, signature, flow
 
-        students.remove(student)
-        seats.remove(seat)
+    def hall_violations(self) -> list[tuple[frozenset, frozenset]]:
+        """
+        Return sets of preference classes that together want more seats than they can use,
+        each as (classes, signatures usable by any of them).
 
-        assignments.append(SeatAssignment(student=student, seat=seat))
+        For each class left short by the maximum flow, the classes and signatures reachable from it in
+        the residual network form such a set: every reachable signature is saturated by reachable classes,
+        so their students outnumber the seats of their signatures (Hall's condition fails).
+        """
+        violations = []
+        for preference in self.preferences:
+            if self.matched(preference) == self.student_counts[preference]:
+                continue
+            reached = self.network.reachable(self._preference_nodes[preference], blocked=(self.source,))
+            violation = (frozenset(p for p, node in self._preference_nodes.items() if node in reached),
+                         frozenset(s for s, node in self._signature_nodes.items() if node in reached))
+            if violation not in violations:
+                violations.append(violation)
+        return violations
+
+
+def assign_students_by_matching(exam, index: SeatAvailabilityIndex, use_soft_preferences=False):
+    """
+    The strategy:
+    Build an AssignmentNetwork from the preference classes and seat signatures.
+    A maximum flow tells how many students of each class go to each signature,
+        and it covers every student whenever a complete assignment exists.
+        With use_soft_preferences, the flow also meets as many soft wants as possible.
+    Within each (class, signature) pair, students and seats are paired randomly.
+    """
+    network = AssignmentNetwork(
+        {preference: len(students) for preference, students in index.students_by_preference.items()},
+        {signature: len(seats) for signature, seats in index.seats_by_signature.items()},
+        index.matrix, use_soft_preferences=use_soft_preferences)
+
+    for preference, students in index.students_by_preference.items():
+        matched = network.matched(preference)
+        if matched < len(students):
+            raise NotEnoughSeatError(exam, students[matched:], preference)
+
+    for students in index.students_by_preference.values():
+        index.rng.shuffle(students)
+    for seats in index.seats_by_signature.values():
+        index.rng.shuffle(seats)
+    assignments = []
+    for preference, signature, flow in network.pair_flows():
+        students = index.students_by_preference[preference]
+        seats = index.seats_by_signature[signature]
+        for _ in range(flow):
+            assignments.append((students.pop().id, seats.pop().id))
     return assignments
 
 
 def assign_single_student(exam, student, seat=None, ignore_restrictions=False):
     """
     Assign a single student to a seat.
-    If a seat is not provided, try to find a seat that meets the student's requirements (if ignore_restrictions is False),
-    or just any seat that is available (if ignore_restrictions is True).
-    If a seat is provided, check if the seat is available and meets the student's requirements (if ignore_restrictions is False),
-    or only check if the seat is available (if ignore_restrictions is True).
+    If a seat is not provided, try to find a seat that meets the student's requirements
+    (if ignore_restrictions is False), or just any seat that is available (if ignore_restrictions is True).
+    If a seat is provided, check if the seat is available and meets the student's requirements
+    (if ignore_restrictions is False), or only check if the seat is available (if ignore_restrictions is True).
     Then, the chosen seat is assigned to the student.
 
-    The original assignment will NOT be removed! It is the caller's responsibility to remove the original assignment if needed.
+    The original assignment will NOT be removed!
+    It is the caller's responsibility to remove the original assignment if needed.
+
+    The candidate seats are resolved in a single query: free seats (anti-join), room and attribute constraints
+    are all filtered in SQL. A provided seat is checked by primary key within the candidates,
+    otherwise a random candidate is picked by the database.
     """
     preference: Preference = get_preference_from_student(student)
-    seats: list[Seat] = filter_seats_by_preference(exam.unassigned_seats, preference) \
-        if not ignore_restrictions else exam.unassigned_seats
+    candidates = exam.unassigned_seats_query() if ignore_restrictions else exam.unassigned_seats_query(
+        room_ids=preference.room_wants or None, avoid_room_ids=preference.room_avoids,
+        attributes=preference.wants, avoid_attributes=preference.avoids)
 
     # if a seat is provided, check it
-    if seat and seat not in seats:
-        raise SeatOverrideError(student, seat,
-                                "Seat is already taken or does exist in the exam, or does not meet the student's requirements.")
+    if seat:
+        if candidates.filter(Seat.id == seat.id).with_entities(Seat.id).first() is None:
+            raise SeatOverrideError(student, seat, "Seat is already taken or does exist in the exam, "
+                                                   "or does not meet the student's requirements.")
 
     # if seat is not provided, try getting a seat that meets the student's requirements
     if not seat:
-        if not seats:
+        seat = candidates.order_by(func.random()).first()
+        if not seat:
             raise NotEnoughSeatError(exam, [student], preference)
-        seat = random.choice(seats)
 
     # create and return a new assignment
     return SeatAssignment(student=student, seat=seat)
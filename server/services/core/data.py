@@ -1,10 +1,12 @@
 from server.forms import ImportStudentFormBase
 from server.services.canvas import get_student_roster_for_offering
-from server.services.csv import parse_csv, parse_csv_str
+from server.services.csv import iter_csv, parse_csv, parse_csv_str
 from server.services.google import get_spreadsheet_tab_content
 
 from server.services.core.room import prepare_room, prepare_seat
-from server.services.core.student import StudentImportConfig, prepare_students
+from server.models import Student
+from server.services.core.student import StudentImportConfig, import_students, prepare_students
+from server.services.core.upsert import upsert_students
 from server.typings.enum import AssignmentImportStrategy
 
 
@@ -65,15 +67,30 @@ def _get_config_from_form(student_form: ImportStudentFormBase):
     )
 
 
+def save_imported_students(session, exam, student_form, new_students, updated_students, students_ids_to_remove):
+    """
+    Write the students prepared by one of the get_students_from_* functions, and commit.
+    """
+    upsert_students(session, exam, new_students, updated_students, config=_get_config_from_form(student_form))
+    if students_ids_to_remove:
+        Student.query.filter(Student.id.in_(students_ids_to_remove)).delete(synchronize_session=False)
+    session.commit()
+
+
 def get_students_from_google_spreadsheet(exam, student_form):
     headers, rows = get_spreadsheet_tab_content(student_form.sheet_url.data,
                                                 student_form.sheet_range.data)
     return prepare_students(exam, headers, rows, config=_get_config_from_form(student_form))
 
 
-def get_students_from_csv(exam, student_form):
-    headers, rows = parse_csv(student_form.file.data)
-    return prepare_students(exam, headers, rows, config=_get_config_from_form(student_form))
+def import_students_from_csv(session, exam, student_form, *, backend, chunk_size):
+    """
+    Import the students of an uploaded CSV, and commit; chunk_size is only used if the form asks for chunks.
+    See import_students for the backends.
+    """
+    headers, rows = iter_csv(student_form.file.data)
+    return import_students(session, exam, headers, rows, config=_get_config_from_form(student_form), backend=backend,
+                           chunk_size=chunk_size if student_form.import_in_chunks.data else None)
 
 
 def get_students_from_manual_input(exam, student_form):
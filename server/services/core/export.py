@@ -9,7 +9,7 @@ def export_exam_student_info(exam) -> str:
     Export exam student info to a CSV file.
     """
     headers = set(['name', 'email', 'student id', 'canvas id', 'session name',
-                  'seat name', 'emailed', 'room id', 'seat id', 'public seat url'])
+                  'seat name', 'emailed', 'room id', 'seat id', 'public seat url', 'section'])
     rows = []
     for student in exam.students:
         row_dict = {
@@ -17,6 +17,7 @@ def export_exam_student_info(exam) -> str:
             'email': student.email,
             'student id': student.sid,
             'canvas id': student.canvas_id,
+            'section': student.section,
             'session name': student.assignment.seat.room.name_and_start_at_time_display() if student.assignment else None,
             'seat name': student.assignment.seat.display_name if student.assignment else None,
             'room id': student.assignment.seat.room.id if student.assignment else None,
@@ -31,6 +32,9 @@ def export_exam_student_info(exam) -> str:
         for attr in prefs.avoids:
             row_dict[attr] = 'false'
             headers.add(attr)
+        for attr in prefs.prefers:
+            row_dict[attr] = 'prefer'
+            headers.add(attr)
         for room_id_str in prefs.room_wants:
             attr = room_id_to_attr(room_id_str)
             row_dict[attr] = 'true'
@@ -0,0 +1,67 @@
+from collections import Counter
+
+from server.services.core.assign import AssignmentNetwork, Preference
+from server.services.core.snapshot import ExamSnapshot
+
+
+class OverSubscription:
+    """
+    A combination of preference classes whose students outnumber the seats any of them can use.
+    """
+
+    def __init__(self, preferences: list[Preference], student_count: int, seat_count: int):
+        self.preferences = preferences
+        self.student_count = student_count
+        self.seat_count = seat_count
+
+    @property
+    def shortfall(self):
+        return self.student_count - self.seat_count
+
+    def __repr__(self):
+        return f'<OverSubscription {self.student_count} students for {self.seat_count} seats>'
+
+
+class FeasibilityReport:
+    def __init__(self, student_count: int, seat_count: int, assignable_count: int,
+                 over_subscriptions: list[OverSubscription]):
+        self.student_count = student_count
+        self.seat_count = seat_count
+        self.assignable_count = assignable_count
+        self.over_subscriptions = over_subscriptions
+
+    @property
+    def is_feasible(self):
+        return self.assignable_count == self.student_count
+
+    def __str__(self):
+        if self.is_feasible:
+            return f"All {self.student_count} students can be seated in the {self.seat_count} available seats."
+        return (f"At most {self.assignable_count} of {self.student_count} students can be seated. "
+                f"{len(self.over_subscriptions)} combination(s) of preferences are over-subscribed, "
+                f"short of {max(o.shortfall for o in self.over_subscriptions)} seat(s) at worst.")
+
+
+def analyze_feasibility(exam, snapshot: ExamSnapshot = None) -> FeasibilityReport:
+    """
+    Check, before running an assignment, whether every student can get a seat meeting their preference.
+    Only counts are used: students are aggregated by preference class, and seats by signature.
+    The unassigned students and seats of the snapshot (loaded from the exam if not given) are analyzed.
+
+    A complete assignment exists iff Hall's condition holds: every combination of preference classes
+    has at least as many usable seats as students. The report lists the combinations that fail it.
+    """
+    snapshot = ExamSnapshot.load(exam) if snapshot is None else snapshot
+    student_counts = Counter(student.preference for student in snapshot.students)
+    seat_counts = Counter(seat.signature for seat in snapshot.seats)
+
+    network = AssignmentNetwork(student_counts, seat_counts)
+    over_subscriptions = [
+        OverSubscription(sorted(preferences, key=lambda p: -student_counts[p]),
+                         sum(student_counts[p] for p in preferences),
+                         sum(seat_counts[s] for s in signatures))
+        for preferences, signatures in network.hall_violations()
+    ]
+    over_subscriptions.sort(key=lambda o: -o.shortfall)
+    return FeasibilityReport(sum(student_counts.values()), sum(seat_counts.values()),
+                             network.max_flow, over_subscriptions)
@@ -0,0 +1,96 @@
+import random
+from collections import Counter, defaultdict
+
+from sqlalchemy import BigInteger, Text, cast, func, type_coerce
+
+from server.models import Seat
+from server.services.core.assign import AssignmentNetwork
+from server.services.core.snapshot import ExamSnapshot
+from server.typings.exception import NotEnoughSeatError
+
+# multiplier and modulus of the seeded pseudo-random order of seats, computed by the database
+_ORDER_MULTIPLIER = 1103515245
+_ORDER_MODULUS = 2147483647
+
+
+class FreeSeatIndex:
+    """
+    Free seats of an exam, aggregated by signature in the database.
+    Only counts are loaded; seat ids are fetched on demand, for the signatures actually used.
+    """
+
+    def __init__(self, exam):
+        self.exam = exam
+        self.counts: Counter = Counter()
+        # attributes are stored as unordered comma-joined text, so a signature may have several raw spellings
+        self._raw_attributes: dict[tuple, list[str]] = defaultdict(list)
+
+    @classmethod
+    def load(cls, exam):
+        """
+        Load the number of free seats per signature of the exam, with one aggregate query.
+        """
+        index = cls(exam)
+        raw_attributes = type_coerce(Seat.attributes, Text)
+        rows = exam.unassigned_seats_query().with_entities(
+            Seat.room_id, raw_attributes, func.count(Seat.id)
+        ).group_by(Seat.room_id, raw_attributes)
+        for room_id, raw, count in rows:
+            signature = (frozenset(attr.lower() for attr in raw.split(',') if attr) if raw else frozenset(), room_id)
+            index.counts[signature] += count
+            index._raw_attributes[signature].append(raw)
+        return index
+
+    def take(self, signature: tuple, count: int, seed: int) -> list[int]:
+        """
+        Return the ids of count free seats of the signature, in a pseudo-random order derived from the seed.
+        """
+        raw_attributes = type_coerce(Seat.attributes, Text)
+        # in 64 bits, since the product overflows a 32-bit integer column on PostgreSQL
+        order = (cast(Seat.id, BigInteger) * _ORDER_MULTIPLIER + seed) % _ORDER_MODULUS
+        rows = self.exam.unassigned_seats_query(room_ids=[signature[1]]).with_entities(Seat.id).filter(
+            raw_attributes.in_(self._raw_attributes[signature])
+        ).order_by(order).limit(count)
+        return [seat_id for seat_id, in rows]
+
+
+def assign_students_incrementally(exam, student_ids=None, seed: int = None) -> list[tuple[int, int]]:
+    """
+    Assign seats to the unassigned students of the exam (only those in student_ids, if given),
+    keeping every existing assignment.
+
+    The strategy:
+    Load only those students, and the number of free seats per signature (see FreeSeatIndex).
+    Solve an AssignmentNetwork on the counts, as assign_students_by_matching does.
+    Fetch only as many seat ids as the flow uses from each signature, and pair them with students randomly.
+    Cost grows with the number of students to seat and of signatures, not with the size of the exam.
+    """
+    rng = random.Random(seed)
+    snapshot = ExamSnapshot.load_students(exam, student_ids)
+    students_by_preference = defaultdict(list)
+    for student in snapshot.students:
+        students_by_preference[student.preference].append(student)
+    if not students_by_preference:
+        return []
+    free_seats = FreeSeatIndex.load(exam)
+
+    network = AssignmentNetwork({preference: len(students) for preference, students in students_by_preference.items()},
+                                free_seats.counts)
+    for preference, students in students_by_preference.items():
+        matched = network.matched(preference)
+        if matched < len(students):
+            raise NotEnoughSeatError(exam, students[matched:], preference)
+
+    pair_flows = list(network.pair_flows())
+    needed = Counter()
+    for _, signature, flow in pair_flows:
+        needed[signature] += flow
+    seat_ids = {signature: free_seats.take(signature, count, rng.randrange(_ORDER_MODULUS))
+                for signature, count in needed.items()}
+    for students in students_by_preference.values():
+        rng.shuffle(students)
+    assignments = []
+    for preference, signature, flow in pair_flows:
+        for _ in range(flow):
+            assignments.append((students_by_preference[preference].pop().id, seat_ids[signature].pop()))
+    return assignments
@@ -0,0 +1,85 @@
+import random
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from server import app
+from server.services.core.assign import SeatAvailabilityIndex, assign_students_greedily
+from server.typings.enum import FillStrategy
+from server.typings.exception import NotEnoughSeatError
+
+
+def score_assignment(snapshot, assignments) -> tuple:
+    """
+    Score an assignment of the snapshot; higher is better.
+    Only successful runs are scored, and those seat every student, so scores compare lexicographically on:
+    - soft preferences: the number of soft wants ("prefer") met,
+    - room balance: the negated variance of the fill ratio of each room.
+    """
+    preferences = {student.id: student.preference for student in snapshot.students}
+    signatures = {seat.id: seat.signature for seat in snapshot.seats}
+    satisfaction = sum(preferences[student_id].satisfaction(signatures[seat_id])
+                       for student_id, seat_id in assignments)
+    room_ids = {seat.id: seat.room_id for seat in snapshot.seats}
+    seats_per_room = Counter(room_ids.values())
+    assigned_per_room = Counter(room_ids[seat_id] for _, seat_id in assignments)
+    ratios = [assigned_per_room[room_id] / count for room_id, count in seats_per_room.items()]
+    mean = sum(ratios) / len(ratios) if ratios else 0
+    variance = sum((ratio - mean) ** 2 for ratio in ratios) / len(ratios) if ratios else 0
+    return satisfaction, -variance
+
+
+# the snapshot is sent once to each worker process, rather than once per run
+_worker_snapshot = None
+_worker_fill = None
+
+
+def _init_worker(snapshot, fill):
+    global _worker_snapshot, _worker_fill
+    _worker_snapshot, _worker_fill = snapshot, fill
+
+
+def _worker_run(seed):
+    return _seeded_run(_worker_snapshot, _worker_fill, seed)
+
+
+def _seeded_run(snapshot, fill, seed):
+    """
+    Run the greedy assignment once with the given seed and fill strategy on the snapshot.
+    Return the assignments and their score, or None if the run failed.
+    """
+    index = SeatAvailabilityIndex(snapshot.students, snapshot.seats, random.Random(seed), fill=fill)
+    try:
+        assignments = assign_students_greedily(None, index)
+    except NotEnoughSeatError:
+        return None
+    return assignments, score_assignment(snapshot, assignments)
+
+
+def assign_students_optimized(exam, snapshot, seed: int = None, runs: int = None,
+                              fill: FillStrategy = FillStrategy.RANDOM, processes: int = None):
+    """
+    The strategy:
+    Derive one seed per run from the given seed.
+    Run the greedy assignment, with the fill strategy, once per seed: in this process if processes is 1,
+    else in parallel on a pool of that many worker processes (see ASSIGNMENT_OPTIMIZE_PROCESSES).
+    Keep the successful run with the best score (see score_assignment).
+    The same seed, snapshot, fill strategy and number of runs always give the same result.
+    """
+    runs = runs or app.config.get('ASSIGNMENT_OPTIMIZE_RUNS')
+    processes = min(runs, processes or app.config.get('ASSIGNMENT_OPTIMIZE_PROCESSES') or 1)
+    seed_generator = random.Random(seed)
+    seeds = [seed_generator.randrange(2 ** 32) for _ in range(runs)]
+    if processes == 1:
+        results = [_seeded_run(snapshot, fill, run_seed) for run_seed in seeds]
+    else:
+        with ProcessPoolExecutor(max_workers=processes, initializer=_init_worker, initargs=(snapshot, fill)) as executor:
+            results = list(executor.map(_worker_run, seeds))
+
+    successful = [(result, run_seed) for result, run_seed in zip(results, seeds) if result is not None]
+    if not successful:
+        # every run failed; repeat the first one here to raise its error with the exam attached
+        return assign_students_greedily(exam, SeatAvailabilityIndex(
+            snapshot.students, snapshot.seats, random.Random(seeds[0]), fill=fill))
+    (assignments, score), run_seed = max(successful, key=lambda s: s[0][1])
+    app.logger.info(f"Optimized assignment: best of {runs} runs is seed {run_seed} with score {score}")
+    return assignments
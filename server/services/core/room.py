@@ -1,6 +1,7 @@
 from server.typings.exception import DataValidationError
 from server.models import Room, Seat, Student, slug
 from server.utils.date import to_ISO8601
+from server.utils.headers import HeaderSchema
 
 
 def prepare_room(exam, room_form):
@@ -33,6 +34,26 @@ def prepare_room(exam, room_form):
     return room
 
 
+SEAT_SPECIAL_HEADERS = ['row', 'seat', 'x', 'y', 'count']
+
+
+class SeatHeaderSchema(HeaderSchema):
+    """
+    The columns of a seat import: special columns get a position,
+    the others become (position, lower-cased attribute) slots.
+    """
+    special_headers = SEAT_SPECIAL_HEADERS
+
+    def __init__(self, headers):
+        super().__init__(headers)
+        self.row, self.seat, self.x, self.y, self.count = (self.position[header] for header in SEAT_SPECIAL_HEADERS)
+        self.attributes = [(i, header.lower()) for i, header in enumerate(self.columns)
+                           if header not in SEAT_SPECIAL_HEADERS]
+
+    def attributes_of(self, values: tuple) -> set[str]:
+        return {attr for i, attr in self.attributes if values[i] and values[i].lower() == 'true'}
+
+
 def prepare_seat(headers, rows):  # noqa: C901
     """
     Prepare a list of seats from the spreadsheet data.
@@ -44,9 +65,12 @@ def prepare_seat(headers, rows):  # noqa: C901
     x, y = 0, -1
     last_row = None
     valid_seats, seat_names, seat_coords = [], set(), set()
+    schemas: dict[tuple, SeatHeaderSchema] = {}
     for row in rows:
+        schema = SeatHeaderSchema.for_row(schemas, row)
+        values = schema.values(row)
         seat = Seat()
-        seat.row, seat.seat = row.pop('row', None), row.pop('seat', None)
+        seat.row, seat.seat = values[schema.row], values[schema.seat]
         seat.fixed = bool(seat.row and seat.seat)
 
         # if we leave either row or seat blank, we regard it as a movable seat
@@ -61,7 +85,7 @@ def prepare_seat(headers, rows):  # noqa: C901
             else:
                 x += 1
             last_row = seat.row
-            x_override, y_override = row.pop('x', None), row.pop('y', None)
+            x_override, y_override = values[schema.x], values[schema.y]
             try:
                 if x_override:
                     x = float(x_override)
@@ -74,13 +98,12 @@ def prepare_seat(headers, rows):  # noqa: C901
                 raise DataValidationError(f'Fixed seat coordinates repeated: {coords}')
             seat_coords.add(coords)
             seat.x, seat.y = coords
-            _ = row.pop('count', 1)  # discard count column if it exists
-            seat.attributes = {k.lower() for k, v in row.items() if v.lower() == 'true'}
+            seat.attributes = schema.attributes_of(values)
             valid_seats.append(seat)
         else:
             # allows count column so we can define multiple movable seats in one row
-            count = row.pop('count', 1)
-            attributes = {k.lower() for k, v in row.items() if v.lower() == 'true'}
+            count = values[schema.count] or 1
+            attributes = schema.attributes_of(values)
             for _ in range(int(count)):
                 seat = Seat()
                 seat.fixed = False
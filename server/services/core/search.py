@@ -0,0 +1,160 @@
+import base64
+import json
+
+from flask import url_for
+from sqlalchemy import and_, func, or_, text
+
+from server.models import STUDENT_SEARCH_DOCUMENT, STUDENT_SORT_KEYS, Student, db
+from server.typings.exception import DataValidationError
+
+# sorts past the end of any prefix (the largest code point), for index range scans;
+# the sort keys are in code point order on every database, see server.models.code_point_order
+_PREFIX_END = '\U0010ffff'
+MAX_PAGE_SIZE = 500
+MAX_TYPEAHEAD_SIZE = 50
+# trigram indexes can only match terms of at least this many characters
+_MIN_TRIGRAM_LENGTH = 3
+
+
+def encode_cursor(value, student_id: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps([value, student_id]).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[str, int]:
+    try:
+        value, student_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return str(value), int(student_id)
+    except (ValueError, TypeError):
+        raise DataValidationError('Invalid cursor')
+
+
+def prefix_filter(prefix: str):
+    """
+    Match students with a name, email, student id or canvas id starting with prefix (case-insensitive).
+    Each match is a range on an indexed key, rather than a LIKE, so it can use the (exam_id, key) indexes.
+    The range is only exact in code point order, which is why the keys are wrapped in code_point_order.
+    """
+    prefix = prefix.strip().lower()
+    return or_(*[and_(key >= prefix, key < prefix + _PREFIX_END) for key in STUDENT_SORT_KEYS.values()])
+
+
+def search_students(exam, prefix: str = None, sort: str = 'name', descending: bool = False,
+                    after: str = None, limit: int = 100):
+    """
+    Return one page of the students of the exam, as (students, cursor of the next page or None, total),
+    sorted by sort (a key of STUDENT_SORT_KEYS) then id, optionally only those matching prefix.
+    Pages use keyset pagination: after is the cursor returned with the previous page.
+    """
+    if sort not in STUDENT_SORT_KEYS:
+        raise DataValidationError(f'Cannot sort by "{sort}"')
+    if not 0 < limit <= MAX_PAGE_SIZE:
+        raise DataValidationError(f'Page size should be between 1 and {MAX_PAGE_SIZE}')
+    key = STUDENT_SORT_KEYS[sort]
+    query = exam.students_with_seats_query().order_by(None)
+    if prefix and prefix.strip():
+        query = query.filter(prefix_filter(prefix))
+    total = query.with_entities(Student.id).order_by(None).count()
+
+    if after:
+        value, student_id = decode_cursor(after)
+        if descending:
+            query = query.filter(or_(key < value, and_(key == value, Student.id < student_id)))
+        else:
+            query = query.filter(or_(key > value, and_(key == value, Student.id > student_id)))
+    order = [key.desc(), Student.id.desc()] if descending else [key, Student.id]
+    rows = query.add_columns(key).order_by(*order).limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last, last_key = rows[-1]
+        next_cursor = encode_cursor(last_key, last.id)
+    return [student for student, _ in rows], next_cursor, total
+
+
+def _sqlite_search_ids(exam, terms: list[str], limit: int) -> list[int]:
+    """
+    Ids of the best matches in the FTS5 student_search table, each term matching a substring of any column.
+    """
+    match = ' '.join('"{}"'.format(term.replace('"', '""')) for term in terms)
+    rows = db.session.execute(text(
+        'SELECT students.id FROM student_search JOIN students ON students.id = student_search.rowid '
+        'WHERE student_search MATCH :match AND students.exam_id = :exam_id ORDER BY student_search.rank LIMIT :limit'
+    ), {'match': match, 'exam_id': exam.id, 'limit': limit})
+    return [student_id for student_id, in rows]
+
+
+def _postgres_search_ids(exam, terms: list[str], limit: int) -> list[int]:
+    """
+    Ids of the best matches by trigram similarity, each term matching a substring of the search document.
+    """
+    query = Student.query.with_entities(Student.id).filter(Student.exam_id == exam.id)
+    for term in terms:
+        query = query.filter(STUDENT_SEARCH_DOCUMENT.contains(term, autoescape=True))
+    query = query.order_by(func.similarity(STUDENT_SEARCH_DOCUMENT, ' '.join(terms)).desc(), Student.id)
+    return [student_id for student_id, in query.limit(limit)]
+
+
+def _has_sqlite_search_table() -> bool:
+    return db.session.execute(text(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'student_search'")).first() is not None
+
+
+def typeahead_students(exam, query: str, limit: int = 10) -> list:
+    """
+    Return the students of the exam best matching query, with their seat loaded, for exam-day lookup.
+    Each word of the query matches anywhere in a name, email, student id or canvas id, through the
+    student search index (FTS5 on SQLite, pg_trgm on PostgreSQL). Queries shorter than 3 characters,
+    and other databases, fall back to the indexed prefix search of search_students.
+    """
+    if not 0 < limit <= MAX_TYPEAHEAD_SIZE:
+        raise DataValidationError(f'Result size should be between 1 and {MAX_TYPEAHEAD_SIZE}')
+    query = (query or '').strip().lower()
+    if not query:
+        return []
+    # words are matched separately, unless some are too short, then the whole query is matched as one substring
+    terms = query.split()
+    if any(len(term) < _MIN_TRIGRAM_LENGTH for term in terms):
+        terms = [query] if len(query) >= _MIN_TRIGRAM_LENGTH else []
+    dialect = db.engine.dialect.name
+    if terms and dialect == 'sqlite' and _has_sqlite_search_table():
+        student_ids = _sqlite_search_ids(exam, terms, limit)
+    elif terms and dialect == 'postgresql':
+        student_ids = _postgres_search_ids(exam, terms, limit)
+    else:
+        return exam.students_with_seats_query().order_by(None).filter(prefix_filter(query)) \
+            .order_by(STUDENT_SORT_KEYS['name'], Student.id).limit(limit).all()
+    students = {student.id: student
+                for student in exam.students_with_seats_query().filter(Student.id.in_(student_ids))}
+    return [students[student_id] for student_id in student_ids if student_id in students]
+
+
+def student_to_json(exam, student, rooms_by_id) -> dict:
+    """
+    Serialize a student for the student list, with the labels and links of its row.
+    rooms_by_id is Exam.rooms_by_id, used to label room preferences.
+    """
+    def room_label(room_id):
+        room = rooms_by_id.get(str(room_id))
+        return room.name_and_start_at_time_display(short=True) if room else str(room_id)
+    assignment = student.assignment
+    return {
+        'id': student.id,
+        'name': student.name,
+        'email': student.email,
+        'sid': student.sid,
+        'canvas_id': student.canvas_id,
+        'wants': sorted(student.wants) + [room_label(room_id) for room_id in sorted(student.room_wants)],
+        'avoids': sorted(student.avoids) + [room_label(room_id) for room_id in sorted(student.room_avoids)],
+        'prefers': sorted(student.prefers or ()),
+        'seat': f'{assignment.seat.room.display_name} {assignment.seat.display_name}' if assignment else None,
+        'emailed': assignment.emailed if assignment else None,
+        'urls': {
+            'student': url_for('student', exam_student=(exam, student)),
+            'seat': url_for('room', exam=exam, id=assignment.seat.room.id, seat=assignment.seat.id)
+            if assignment else None,
+            'email': url_for('email_single_student', exam=exam, student_id=student.id),
+            'assign': url_for('assign_student', exam_student=(exam, student)),
+            'edit': url_for('edit_student', exam_student=(exam, student)),
+            'delete': url_for('delete_student', exam_student=(exam, student)),
+        },
+    }
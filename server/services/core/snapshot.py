@@ -0,0 +1,136 @@
+from server.models import PreferenceClass, Seat, SeatAssignment, Student
+from server.services.core.assign import Preference
+
+
+class StudentRecord:
+    """
+    A detached, read-only view of a student, holding only what assignment needs.
+    """
+    __slots__ = ('id', 'name', 'preference', 'section')
+
+    def __init__(self, id: int, name: str, preference: Preference, section: str = None):
+        self.id = id
+        self.name = name
+        self.preference = preference
+        self.section = section
+
+    def __repr__(self):
+        return f'<StudentRecord {self.id}>'
+
+
+class SeatRecord:
+    """
+    A detached, read-only view of a seat, holding only what assignment needs.
+    """
+    __slots__ = ('id', 'signature', 'x', 'y', 'row')
+
+    def __init__(self, id: int, signature: tuple[frozenset[str], int], x: float = None, y: float = None,
+                 row: str = None):
+        self.id = id
+        self.signature = signature
+        self.x = x
+        self.y = y
+        self.row = row
+
+    @property
+    def room_id(self):
+        return self.signature[1]
+
+    def __repr__(self):
+        return f'<SeatRecord {self.id}>'
+
+
+class ExamSnapshot:
+    """
+    Unassigned students and seats of an exam, detached from the ORM session.
+    Equal preferences and signatures are interned, so records share them.
+    occupied_seats holds the assigned fixed seats, with the section of their student,
+    for assignment modes that keep students apart.
+    """
+
+    def __init__(self):
+        self.students: list[StudentRecord] = []
+        self.seats: list[SeatRecord] = []
+        self.occupied_seats: list[tuple[SeatRecord, str]] = []
+        self._preferences: dict[Preference, Preference] = {}
+        self._signatures: dict[tuple, tuple] = {}
+
+    def intern_preference(self, preference: Preference) -> Preference:
+        return self._preferences.setdefault(preference, preference)
+
+    def add_student(self, id, name, wants, avoids, room_wants, room_avoids, prefers=(), section=None):
+        preference = self.intern_preference(Preference(wants, avoids, room_wants, room_avoids, prefers or ()))
+        self.students.append(StudentRecord(id, name, preference, section))
+
+    def add_seat(self, id, room_id, attributes, x=None, y=None, row=None):
+        signature = (frozenset(attr.lower() for attr in attributes), room_id)
+        signature = self._signatures.setdefault(signature, signature)
+        self.seats.append(SeatRecord(id, signature, x, y, row))
+
+    def add_occupied_seat(self, id, room_id, x, y, section=None):
+        self.occupied_seats.append((SeatRecord(id, (frozenset(), room_id), x, y), section))
+
+    @classmethod
+    def load_students(cls, exam, student_ids=None):
+        """
+        Load only the unassigned students of the exam (restricted to student_ids if given).
+        Preferences are read once per preference class, not once per student.
+        """
+        snapshot = cls()
+        students = exam.unassigned_students_query()
+        if student_ids is not None:
+            students = students.filter(Student.id.in_(student_ids))
+        classes = students.join(PreferenceClass, Student.preference_class_id == PreferenceClass.id).with_entities(
+            PreferenceClass.id, PreferenceClass.wants, PreferenceClass.avoids, PreferenceClass.room_wants,
+            PreferenceClass.room_avoids, PreferenceClass.prefers
+        ).group_by(PreferenceClass.id).order_by(None)
+        preferences = {class_id: snapshot.intern_preference(Preference(*columns)) for class_id, *columns in classes}
+        rows = students.with_entities(Student.id, Student.name, Student.section, Student.preference_class_id)
+        unclassified = []
+        for id, name, section, class_id in rows:
+            if class_id is None:
+                unclassified.append(id)
+            else:
+                snapshot.students.append(StudentRecord(id, name, preferences[class_id], section))
+        if unclassified:
+            # students stored before preference classes existed, until backfill_normalized_tables is run
+            legacy = Student.query.filter(Student.id.in_(unclassified)).order_by(Student.name).with_entities(
+                Student.id, Student.name, Student.wants, Student.avoids, Student.room_wants, Student.room_avoids,
+                Student.prefers, Student.section
+            )
+            for row in legacy:
+                snapshot.add_student(*row)
+        return snapshot
+
+    @classmethod
+    def load(cls, exam):
+        """
+        Load the unassigned students and seats, and the occupied fixed seats of the exam, with one query each.
+        """
+        snapshot = cls.load_students(exam)
+        seats = exam.unassigned_seats_query().with_entities(
+            Seat.id, Seat.room_id, Seat.attributes, Seat.x, Seat.y, Seat.row
+        )
+        for row in seats:
+            snapshot.add_seat(*row)
+        occupied_seats = Seat.query.join(SeatAssignment, SeatAssignment.seat_id == Seat.id) \
+            .join(Student, SeatAssignment.student_id == Student.id) \
+            .with_entities(Seat.id, Seat.room_id, Seat.x, Seat.y, Student.section) \
+            .filter(SeatAssignment.exam_id == exam.id, Seat.x.isnot(None), Seat.y.isnot(None))
+        for row in occupied_seats:
+            snapshot.add_occupied_seat(*row)
+        return snapshot
+
+    @classmethod
+    def from_objects(cls, students, seats):
+        """
+        Build a snapshot from Student and Seat instances, which do not need to be persisted.
+        """
+        snapshot = cls()
+        for student in students:
+            snapshot.add_student(student.id, student.name, student.wants, student.avoids,
+                                 student.room_wants, student.room_avoids, student.prefers, student.section)
+        for seat in seats:
+            attributes, room_id = seat.signature
+            snapshot.add_seat(seat.id, room_id, attributes, seat.x, seat.y, seat.row)
+        return snapshot
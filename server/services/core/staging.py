@@ -0,0 +1,345 @@
+import csv
+import io
+import json
+from collections import defaultdict, namedtuple
+
+from sqlalchemy import text
+
+from server.models import PreferenceClass, Student
+from server.services.core.assign import Preference
+from server.services.core.student import StudentHeaderSchema, StudentImportConfig, prepare_students, \
+    validate_student_headers
+from server.services.core.upsert import ids_by_key, upsert_students
+from server.typings.enum import AssignmentImportStrategy, MissingRowImportStrategy, NewRowImportStrategy, \
+    UpdatedRowImportStrategy
+from server.utils.misc import chunked
+
+# a student written by an import, as reported back
+ImportedStudent = namedtuple('ImportedStudent', ['canvas_id', 'name'])
+
+# rows per COPY, so the CSV buffer stays small
+_COPY_CHUNK_SIZE = 5000
+_STAGING_COLUMNS = ('line', 'raw', 'canvas_id', 'email', 'name', 'sid', 'section', 'emailed', 'seat_id', 'room_id',
+                    'seat_name', 'wants', 'avoids', 'prefers', 'room_wants', 'room_avoids')
+_INFO_COLUMNS = ('name', 'email', 'sid', 'section')
+_PREFERENCE_COLUMNS = ('wants', 'avoids', 'prefers', 'room_wants', 'room_avoids')
+
+_CREATE_STAGING = """
+CREATE TEMPORARY TABLE student_import_staging (
+    line integer PRIMARY KEY, raw text NOT NULL, canvas_id text, email text, name text, sid text, section text,
+    emailed boolean NOT NULL, seat_id integer, room_id integer, seat_name text,
+    wants text, avoids text, prefers text, room_wants text, room_avoids text
+) ON COMMIT DROP
+"""
+
+
+def _string_set(values) -> str:
+    return ','.join(sorted(values)) or None
+
+
+def _staging_rows(exam, headers, rows):
+    """
+    Yield the rows as tuples of _STAGING_COLUMNS: special columns are read and preferences parsed
+    as prepare_students does; room names are resolved to room ids.
+    """
+    schemas: dict[tuple, StudentHeaderSchema] = {}
+    room_ids = {}
+    for room in exam.rooms:
+        # the first room with a display name wins, as rooms are listed newest first
+        room_ids.setdefault(room.name_and_start_at_time_display(), room.id)
+    for line, row in enumerate(rows):
+        schema = StudentHeaderSchema.for_row(schemas, row)
+        values = schema.values(row)
+        wants, avoids, prefers, room_wants, room_avoids = schema.preferences(values)
+        seat_id = values[schema.seat_id]
+        yield (line, json.dumps(row), values[schema.canvas_id], values[schema.email], values[schema.name],
+               values[schema.sid], values[schema.section], (values[schema.emailed] or 'false') == 'true',
+               int(seat_id) if seat_id else None, room_ids.get(values[schema.room_name]), values[schema.seat_name],
+               _string_set(wants), _string_set(avoids), _string_set(prefers), _string_set(room_wants),
+               _string_set(room_avoids))
+
+
+def _copy_to_staging(session, exam, headers, rows):
+    cursor = session.connection().connection.cursor()
+    try:
+        cursor.execute(_CREATE_STAGING)
+        for chunk in chunked(_staging_rows(exam, headers, rows), _COPY_CHUNK_SIZE):
+            buffer = io.StringIO()
+            csv.writer(buffer).writerows(chunk)
+            buffer.seek(0)
+            cursor.copy_expert(f"COPY student_import_staging ({', '.join(_STAGING_COLUMNS)}) FROM STDIN WITH (FORMAT csv)",
+                               buffer)
+        # temporary tables have no statistics until analyzed, which the merge joins need
+        cursor.execute('ANALYZE student_import_staging')
+    finally:
+        cursor.close()
+
+
+def _merged_column(column: str, config: StudentImportConfig) -> str:
+    """
+    SQL of the value of a student column after the import of a staged row s, into the existing student st, if any.
+    """
+    if column in _INFO_COLUMNS:
+        strategy = config.updated_student_info_import_strategy
+        if strategy == UpdatedRowImportStrategy.MERGE:
+            return f'coalesce(s.{column}, st.{column})'
+    else:
+        strategy = config.updated_preference_import_strategy
+        if strategy == UpdatedRowImportStrategy.MERGE:
+            return (f"CASE WHEN st.id IS NULL THEN coalesce(s.{column}, '') ELSE array_to_string(ARRAY("
+                    f"SELECT DISTINCT v FROM unnest(string_to_array(st.{column}, ',') || string_to_array(s.{column}, ','))"
+                    f" AS u(v) WHERE v <> ''), ',') END")
+        if strategy == UpdatedRowImportStrategy.IGNORE:
+            return f"CASE WHEN st.id IS NULL THEN coalesce(s.{column}, '') ELSE st.{column} END"
+        return f"coalesce(s.{column}, '')"
+    if strategy == UpdatedRowImportStrategy.IGNORE:
+        return f'CASE WHEN st.id IS NULL THEN s.{column} ELSE st.{column} END'
+    return f's.{column}'
+
+
+def _seat_fits(student: str, seat: str) -> str:
+    """
+    SQL of whether the seat meets the hard constraints of the student (see Preference.is_satisfied_by).
+    """
+    attributes = f"string_to_array(lower(coalesce({seat}.attributes, '')), ',')"
+    return (f"string_to_array(lower({student}.wants), ',') <@ {attributes}"
+            f" AND NOT string_to_array(lower({student}.avoids), ',') && {attributes}"
+            f" AND ({student}.room_wants = '' OR {seat}.room_id::text = ANY(string_to_array({student}.room_wants, ',')))"
+            f" AND NOT {seat}.room_id::text = ANY(string_to_array({student}.room_avoids, ','))")
+
+
+def _merge(session, exam, config: StudentImportConfig):
+    """
+    Merge the staged rows with the existing students into student_import_merged, one row per staged row,
+    with the student's values after the import, and whether the row is valid, as prepare_students would check.
+    Of several rows with one canvas id, only the last one is merged (see import_students_with_staging).
+    """
+    invalid = ['s.canvas_id IS NULL', f"coalesce({_merged_column('name', config)}, '') = ''",
+               f"coalesce({_merged_column('email', config)}, '') = ''"]
+    if config.new_student_import_strategy == NewRowImportStrategy.IGNORE:
+        invalid.append('st.id IS NULL')
+    columns = ', '.join(f'{_merged_column(column, config)} AS {column}' for column in _INFO_COLUMNS + _PREFERENCE_COLUMNS)
+    session.execute(text(f"""
+        CREATE TEMPORARY TABLE student_import_merged ON COMMIT DROP AS
+        SELECT s.line, s.raw, s.canvas_id, st.id AS student_id, st.id IS NULL AS is_new, s.emailed, s.seat_id,
+               s.room_id, s.seat_name, {columns}, NOT ({' OR '.join(invalid)}) AS valid
+        FROM (SELECT *, max(line) OVER (PARTITION BY canvas_id) AS last_line FROM student_import_staging) s
+        LEFT JOIN students st ON st.exam_id = :exam_id AND st.canvas_id = s.canvas_id
+        WHERE s.canvas_id IS NULL OR s.line = s.last_line
+    """), {'exam_id': exam.id})
+    if config.updated_preference_import_strategy != UpdatedRowImportStrategy.IGNORE:
+        session.execute(text("""
+            UPDATE student_import_merged SET valid = false
+            WHERE valid AND (string_to_array(wants, ',') && string_to_array(avoids, ',')
+                             OR string_to_array(prefers, ',') && string_to_array(avoids, ',')
+                             OR string_to_array(room_wants, ',') && string_to_array(room_avoids, ','))
+        """))
+
+
+def _pick_seats(session, exam, config: StudentImportConfig):
+    """
+    Pick the seats named by the valid merged rows into student_import_seats, as (line, seat_id).
+    A seat is picked only if it has no assignment and, unless assignments are forced, meets the student's constraints.
+    A row names a seat by id, or by room and name, which several seats may share: as in prepare_students,
+    each row gets its first such seat that no earlier row got (see _pick_named_seats).
+    Rows naming a movable seat (see Seat.display_name) then get the first free fitting movable seat of their room,
+    in order, as prepare_students does; only those rows and seats are read back for this.
+    """
+    force = config.assignment_import_strategy == AssignmentImportStrategy.FORCE
+    fits = 'true' if force else _seat_fits('m', 'se')
+    free = 'NOT EXISTS (SELECT 1 FROM seat_assignments sa WHERE sa.seat_id = se.id)'
+    params = {'exam_id': exam.id}
+    session.execute(text(f"""
+        CREATE TEMPORARY TABLE student_import_candidates ON COMMIT DROP AS
+        SELECT m.line, se.id AS seat_id FROM student_import_merged m
+        JOIN seats se ON se.exam_id = :exam_id AND se.id = m.seat_id
+        WHERE m.valid AND {free} AND {fits}
+        UNION
+        SELECT m.line, se.id AS seat_id FROM student_import_merged m
+        JOIN seats se ON se.room_id = m.room_id AND se.name = m.seat_name
+        WHERE m.valid AND m.seat_id IS NULL AND {free} AND {fits}
+    """), params)
+    _pick_named_seats(session)
+
+    requests = session.execute(text("""
+        SELECT m.line, m.room_id, m.wants, m.avoids, m.room_wants, m.room_avoids FROM student_import_merged m
+        WHERE m.valid AND m.seat_id IS NULL AND strpos(m.seat_name, 'Movable Seat') > 0
+          AND NOT EXISTS (SELECT 1 FROM seats se WHERE se.room_id = m.room_id AND se.name = m.seat_name)
+        ORDER BY m.line
+    """)).all()
+    if not requests:
+        return
+    free_seats = defaultdict(list)
+    for seat_id, room_id, attributes in session.execute(text(f"""
+        SELECT se.id, se.room_id, se.attributes FROM seats se
+        WHERE se.exam_id = :exam_id AND se.name IS NULL AND {free}
+          AND NOT EXISTS (SELECT 1 FROM student_import_seats p WHERE p.seat_id = se.id)
+        ORDER BY se.id
+    """), params):
+        attributes = frozenset(attr.lower() for attr in attributes.split(',') if attr) if attributes else frozenset()
+        free_seats[room_id].append((seat_id, (attributes, room_id)))
+    picks = []
+    for line, room_id, *constraints in requests:
+        preference = Preference(*(set(value.split(',')) if value else set() for value in constraints))
+        seats = free_seats[room_id]
+        for i, (seat_id, signature) in enumerate(seats):
+            if force or preference.is_satisfied_by(signature):
+                picks.append({'line': line, 'seat_id': seat_id})
+                del seats[i]
+                break
+    if picks:
+        session.execute(text('INSERT INTO student_import_seats (line, seat_id) VALUES (:line, :seat_id)'), picks)
+
+
+def _pick_named_seats(session):
+    """
+    Pick the seats of student_import_candidates into student_import_seats, in rounds, as if the rows were served
+    one by one in order. In each round, every row proposes its first candidate, and the proposal is taken
+    unless an earlier row still has that seat among its candidates: that row may yet need it.
+    The first row left always gets its seat, and a row whose seat went to an earlier row tries its next one.
+    Rows picked, and seats taken, are then dropped from the candidates; rows left without candidates get no seat.
+    Most imports name each seat once, and take one round.
+    """
+    session.execute(text('CREATE INDEX ON student_import_candidates (seat_id, line)'))
+    session.execute(text('ANALYZE student_import_candidates'))
+    session.execute(text('CREATE TEMPORARY TABLE student_import_seats (line integer, seat_id integer) ON COMMIT DROP'))
+    while True:
+        picked = session.execute(text("""
+            INSERT INTO student_import_seats (line, seat_id)
+            SELECT p.line, p.seat_id
+            FROM (SELECT DISTINCT ON (line) line, seat_id FROM student_import_candidates ORDER BY line, seat_id) p
+            WHERE NOT EXISTS (SELECT 1 FROM student_import_candidates c WHERE c.seat_id = p.seat_id AND c.line < p.line)
+        """)).rowcount
+        if not picked:
+            return
+        session.execute(text("""
+            DELETE FROM student_import_candidates c USING student_import_seats p
+            WHERE c.line = p.line OR c.seat_id = p.seat_id
+        """))
+
+
+def _sync_preference_classes(session, exam):
+    """
+    Point the written students to the preference classes of their constraints, creating the missing ones.
+    """
+    rows = session.execute(text(f"""
+        SELECT st.id, {', '.join(f'st.{column}' for column in _PREFERENCE_COLUMNS)}
+        FROM students st JOIN student_import_merged m ON m.student_id = st.id WHERE m.valid
+    """))
+    student_ids = defaultdict(list)
+    for student_id, wants, avoids, prefers, room_wants, room_avoids in rows:
+        split = [set(value.split(',')) if value else set() for value in (wants, avoids, room_wants, room_avoids, prefers)]
+        student_ids[PreferenceClass.canonical(*split)].append(student_id)
+    if not student_ids:
+        return
+    classes = {}
+    for canonical in student_ids:
+        key = PreferenceClass.key_for(canonical)
+        classes[key] = {'key': key, **{column: set(values) for column, values in
+                                       zip(('wants', 'avoids', 'room_wants', 'room_avoids', 'prefers'), canonical)}}
+    class_ids = ids_by_key(session, PreferenceClass.__table__, 'key', classes)
+    session.execute(text('UPDATE students SET preference_class_id = :class_id WHERE id = ANY(:student_ids)'),
+                    [{'class_id': class_ids[PreferenceClass.key_for(canonical)], 'student_ids': ids}
+                     for canonical, ids in student_ids.items()])
+
+
+def _import_with_staging(session, exam, headers, rows, config: StudentImportConfig):
+    _copy_to_staging(session, exam, headers, rows)
+    _merge(session, exam, config)
+    _pick_seats(session, exam, config)
+    params = {'exam_id': exam.id}
+    columns = _INFO_COLUMNS + _PREFERENCE_COLUMNS
+
+    new_students = [ImportedStudent(*row) for row in session.execute(text(f"""
+        INSERT INTO students (exam_id, canvas_id, {', '.join(columns)})
+        SELECT :exam_id, canvas_id, {', '.join(columns)} FROM student_import_merged WHERE valid AND is_new ORDER BY line
+        RETURNING canvas_id, name
+    """), params)]
+    session.execute(text("""
+        UPDATE student_import_merged m SET student_id = st.id FROM students st
+        WHERE m.valid AND m.is_new AND st.exam_id = :exam_id AND st.canvas_id = m.canvas_id
+    """), params)
+    updated_students = [ImportedStudent(*row) for row in session.execute(text(f"""
+        UPDATE students st SET {', '.join(f'{column} = m.{column}' for column in columns)}
+        FROM student_import_merged m WHERE m.valid AND NOT m.is_new AND st.id = m.student_id
+        RETURNING st.canvas_id, st.name
+    """))]
+
+    if config.revalidate_existing_assignments:
+        session.execute(text(f"""
+            DELETE FROM seat_assignments sa USING student_import_merged m, seats se
+            WHERE m.valid AND NOT m.is_new AND sa.student_id = m.student_id AND se.id = sa.seat_id
+              AND NOT ({_seat_fits('m', 'se')})
+        """))
+    if config.assignment_import_strategy != AssignmentImportStrategy.IGNORE:
+        session.execute(text("""
+            DELETE FROM seat_assignments sa USING student_import_seats p, student_import_merged m
+            WHERE m.line = p.line AND sa.student_id = m.student_id
+        """))
+        session.execute(text("""
+            INSERT INTO seat_assignments (student_id, seat_id, exam_id, emailed)
+            SELECT m.student_id, p.seat_id, :exam_id, m.emailed
+            FROM student_import_seats p JOIN student_import_merged m ON m.line = p.line
+        """), params)
+
+    _sync_preference_classes(session, exam)
+    session.execute(text("""
+        DELETE FROM student_preferences sp USING student_import_merged m
+        WHERE m.valid AND NOT m.is_new AND sp.student_id = m.student_id
+    """))
+    links = """
+        SELECT m.student_id, k.kind, lower(v) AS name FROM student_import_merged m
+        CROSS JOIN LATERAL (VALUES ('want', m.wants), ('avoid', m.avoids), ('prefer', m.prefers)) AS k(kind, names)
+        CROSS JOIN LATERAL unnest(string_to_array(k.names, ',')) AS u(v)
+        WHERE m.valid AND v <> ''
+    """
+    session.execute(text(f'INSERT INTO attributes (name) SELECT DISTINCT name FROM ({links}) l '
+                         'ON CONFLICT (name) DO NOTHING'))
+    session.execute(text(f'INSERT INTO student_preferences (student_id, attribute_id, kind) '
+                         f'SELECT DISTINCT l.student_id, a.id, l.kind FROM ({links}) l JOIN attributes a ON a.name = l.name'))
+
+    removed_ids = []
+    if config.missing_student_import_strategy == MissingRowImportStrategy.DELETE:
+        removed_ids = [student_id for student_id, in session.execute(text("""
+            DELETE FROM students st WHERE st.exam_id = :exam_id
+              AND NOT EXISTS (SELECT 1 FROM student_import_merged m WHERE m.valid AND m.student_id = st.id)
+            RETURNING st.id
+        """), params)]
+    invalid_rows = [json.loads(raw) for raw, in session.execute(
+        text('SELECT raw FROM student_import_merged WHERE NOT valid ORDER BY line'))]
+    return new_students, updated_students, invalid_rows, removed_ids
+
+
+def import_students_with_staging(session, exam, headers, rows, *,
+                                 config: StudentImportConfig = StudentImportConfig()):
+    """
+    Import students from rows, any iterable, with set-based SQL on PostgreSQL, and commit.
+    Return (new students, updated students, invalid rows, ids of removed students), as prepare_students does,
+    with the students as ImportedStudent tuples.
+
+    The strategy:
+    COPY the rows, with their preferences parsed, into a temporary staging table.
+    Merge them with the existing students, by canvas id, following the strategies of config, and validate them.
+    Pick the seats named by the rows, then write the students, assignments, preference classes and links,
+    and delete the missing students, with a few statements over the whole table.
+    The results match prepare_students, except for two cases.
+    Of several rows with one canvas id, the last one is imported and the earlier ones are dropped,
+    where prepare_students merges the later rows into the first, following the update strategies.
+    Rows naming seats by id or name are served before rows naming movable seats, where prepare_students
+    serves all rows in order.
+
+    Other databases fall back to prepare_students and upsert_students.
+    """
+    validate_student_headers(headers)
+    if session.connection().dialect.name == 'postgresql':
+        result = _import_with_staging(session, exam, headers, rows, config)
+        session.commit()
+        return result
+    new_students, updated_students, invalid_rows, removed_ids = prepare_students(exam, headers, rows, config=config)
+    new, updated = ([ImportedStudent(student.canvas_id, student.name) for student in students]
+                    for students in (new_students, updated_students))
+    upsert_students(session, exam, new_students, updated_students, config=config)
+    if removed_ids:
+        Student.query.filter(Student.id.in_(removed_ids)).delete(synchronize_session=False)
+    session.commit()
+    return new, updated, invalid_rows, removed_ids
@@ -1,12 +1,21 @@
-from server.services.core.assign import get_preference_from_student, is_seat_valid_for_preference
+import copy
+from collections import defaultdict
+
+from sqlalchemy import inspect
+from sqlalchemy.orm import selectinload
+
+from server.services.core.assign import Preference, get_preference_from_student, is_seat_valid_for_preference
 from server.typings.enum import AssignmentImportStrategy, \
     MissingRowImportStrategy, NewRowImportStrategy, UpdatedRowImportStrategy
 from server.typings.exception import DataValidationError
 from server.models import Room, Seat, SeatAssignment, Student
+from server.services.core.upsert import upsert_students
+from server.utils.headers import HeaderSchema
+from server.utils.misc import chunked
 
 
 SPECIAL_HEADERS = ['email', 'name', 'bcourses id', 'canvas id', 'student id', 'emailed', 'seat id', 'assignment',
-                   'session name', 'room name', 'seat name', 'public seat url']
+                   'session name', 'room name', 'seat name', 'public seat url', 'section']
 
 
 class StudentImportConfig:
@@ -17,12 +26,13 @@ class StudentImportConfig:
                  new_student_import_strategy: NewRowImportStrategy = NewRowImportStrategy.APPEND,
                  missing_student_import_strategy: MissingRowImportStrategy = MissingRowImportStrategy.IGNORE
                  ):
+        # forms pass the strategies by value
         self.revalidate_existing_assignments = revalidate_existing_assignments
-        self.assignment_import_strategy = assignment_import_strategy
-        self.updated_preference_import_strategy = updated_preference_import_strategy
-        self.updated_student_info_import_strategy = updated_student_info_import_strategy
-        self.new_student_import_strategy = new_student_import_strategy
-        self.missing_student_import_strategy = missing_student_import_strategy
+        self.assignment_import_strategy = AssignmentImportStrategy(assignment_import_strategy)
+        self.updated_preference_import_strategy = UpdatedRowImportStrategy(updated_preference_import_strategy)
+        self.updated_student_info_import_strategy = UpdatedRowImportStrategy(updated_student_info_import_strategy)
+        self.new_student_import_strategy = NewRowImportStrategy(new_student_import_strategy)
+        self.missing_student_import_strategy = MissingRowImportStrategy(missing_student_import_strategy)
 
 
 def room_to_attr(room: Room):
@@ -52,10 +62,115 @@ def is_room_attr(attr: str):
     return attr.startswith('room:') and attr not in SPECIAL_HEADERS
 
 
-def prepare_students(exam, headers, rows, *, config: StudentImportConfig = StudentImportConfig()):
+class StudentHeaderSchema(HeaderSchema):
     """
-    Prepare a list of students from the spreadsheet data, for the given exam.
+    The columns of a student import: special columns get a position,
+    the others become (position, attribute) or (position, room id) slots.
     """
+    special_headers = SPECIAL_HEADERS
+
+    def __init__(self, headers):
+        super().__init__(headers)
+        position = self.position
+        # of alternative names, the first one that appears in the headers wins
+        self.canvas_id = position['bcourses id'] if 'bcourses id' in headers else position['canvas id']
+        self.seat_id = position['seat id'] if 'seat id' in headers else position['assignment']
+        self.room_name = position['session name'] if 'session name' in headers else position['room name']
+        self.email, self.name, self.sid = position['email'], position['name'], position['student id']
+        self.section, self.emailed, self.seat_name = position['section'], position['emailed'], position['seat name']
+        self.attributes = [(i, header.lower()) for i, header in enumerate(self.columns) if is_normal_attr(header)]
+        self.rooms = [(i, attr_to_room_id(header)) for i, header in enumerate(self.columns) if is_room_attr(header)]
+
+    def preferences(self, values: tuple) -> tuple[set, set, set, set, set]:
+        """
+        Return the wants, avoids, prefers, room wants and room avoids of a row.
+        """
+        wants, avoids, prefers, room_wants, room_avoids = set(), set(), set(), set(), set()
+        for i, attr in self.attributes:
+            value = values[i]
+            if value:
+                value = value.lower()
+                if value == 'true':
+                    wants.add(attr)
+                elif value == 'false':
+                    avoids.add(attr)
+                elif value == 'prefer':
+                    # soft wants: met when possible, never required
+                    prefers.add(attr)
+        for i, room_id in self.rooms:
+            value = values[i]
+            if value:
+                value = value.lower()
+                if value == 'true':
+                    room_wants.add(room_id)
+                elif value == 'false':
+                    room_avoids.add(room_id)
+        return wants, avoids, prefers, room_wants, room_avoids
+
+
+class ExamImportIndex:
+    """
+    Existing students, seats and rooms of an exam, prefetched with one query each,
+    so that matching imported rows against them needs no further queries.
+    """
+
+    def __init__(self):
+        self.students: list[Student] = []
+        self.students_by_canvas_id: dict[str, Student] = {}
+        self.seats_by_id: dict[int, Seat] = {}
+        self.seats_by_room_and_name: dict[tuple[int, str | None], list[Seat]] = defaultdict(list)
+        self.rooms_by_display_name: dict[str, Room] = {}
+
+    @classmethod
+    def load(cls, exam, canvas_ids=None):
+        """
+        Load the index of the exam. If canvas_ids is given, only the students with those canvas ids are loaded.
+        """
+        index = cls()
+        index.load_seats(exam)
+        index.load_students(exam, canvas_ids)
+        return index
+
+    def load_seats(self, exam):
+        """
+        Load the seats of the exam, with their assignment, and its rooms.
+        """
+        seats = Seat.query.filter(Seat.exam_id == exam.id).order_by(Seat.id).options(selectinload(Seat.assignment))
+        for seat in seats:
+            self.seats_by_id[seat.id] = seat
+            self.seats_by_room_and_name[(seat.room_id, seat.name)].append(seat)
+        for room in exam.rooms:
+            # the first room with a display name wins, as rooms are listed newest first
+            self.rooms_by_display_name.setdefault(room.name_and_start_at_time_display(), room)
+
+    def load_students(self, exam, canvas_ids=None):
+        """
+        Replace the students of the index with those of the exam, or only those with the given canvas ids.
+        """
+        self.students, self.students_by_canvas_id = [], {}
+        students = Student.query.filter(Student.exam_id == exam.id).order_by(Student.id) \
+            .options(selectinload(Student.assignment).joinedload(SeatAssignment.seat))
+        if canvas_ids is not None:
+            students = students.filter(Student.canvas_id.in_(canvas_ids))
+        for student in students:
+            self.students.append(student)
+            self.students_by_canvas_id.setdefault(student.canvas_id, student)
+
+    def infer_seats(self, room_name: str, seat_name: str) -> list[Seat]:
+        """
+        Seats named seat_name in the room displayed as room_name,
+        or all its movable seats for a movable seat name (see Seat.display_name).
+        """
+        room = self.rooms_by_display_name.get(room_name)
+        if not room:
+            return []
+        seats = self.seats_by_room_and_name.get((room.id, seat_name), [])
+        if not seats and 'Movable Seat' in seat_name:
+            seats = self.seats_by_room_and_name.get((room.id, None), [])
+        return seats
+
+
+def validate_student_headers(headers):
     if 'email' not in headers:
         raise DataValidationError('Missing "email" column')
     elif 'name' not in headers:
@@ -63,24 +178,45 @@ def prepare_students(exam, headers, rows, *, config: StudentImportConfig = Stude
     elif 'bcourses id' not in headers and 'canvas id' not in headers:
         raise DataValidationError('Missing "canvas id" column')
 
+
+def prepare_students(exam, headers, rows, *, config: StudentImportConfig = StudentImportConfig(),
+                     existing: ExamImportIndex = None):
+    """
+    Prepare a list of students from the spreadsheet data, for the given exam.
+    existing is the ExamImportIndex to match rows against, loaded for the whole exam if not given.
+    """
+    validate_student_headers(headers)
+
     new_students = []
     updated_students = []
     invalid_students = []
     students_ids_to_remove = []
     new_assignment_ids = set()
+    prepared_students = set()
+    schemas: dict[tuple, StudentHeaderSchema] = {}
+    if existing is None:
+        existing = ExamImportIndex.load(exam)
+    # students with equal constraints share one preference, so each seat signature is checked once per class
+    preferences: dict[Preference, Preference] = {}
+    validity: dict[tuple[Preference, tuple], bool] = {}
+
+    def is_valid(seat, preference):
+        key = (preference, seat.signature)
+        if key not in validity:
+            validity[key] = is_seat_valid_for_preference(seat, preference)
+        return validity[key]
 
     for row in rows:
-        # get canvas id
-        canvas_id = row.pop(
-            'bcourses id', row.pop('canvas id', None))
-        email = row.pop('email', None)
-        name = row.pop('name', None)
+        schema = StudentHeaderSchema.for_row(schemas, row)
+        values = schema.values(row)
+        canvas_id, email, name = values[schema.canvas_id], values[schema.email], values[schema.name]
+        emailed = values[schema.emailed] or 'false'
         if not canvas_id:
             invalid_students.append(row)
             continue
 
         # try matching existing student (by canvas id)
-        student = Student.query.filter_by(exam_id=int(exam.id), canvas_id=str(canvas_id)).first()
+        student = existing.students_by_canvas_id.get(str(canvas_id))
         is_new = not student
         if is_new:
             student = Student(exam_id=exam.id, canvas_id=canvas_id)
@@ -96,75 +232,188 @@ def prepare_students(exam, headers, rows, *, config: StudentImportConfig = Stude
             if not student.name or not student.email:
                 invalid_students.append(row)
                 continue
-            sid = row.pop('student id', None)
+            sid = values[schema.sid]
             student.sid = sid if overwrite else (sid or student.sid)
-            emailed = row.pop('emailed', 'false')
+            section = values[schema.section]
+            student.section = section if overwrite else (section or student.section)
 
         # parse out preferences: wants and avoids should be mutually exclusive
         if not config.updated_preference_import_strategy == UpdatedRowImportStrategy.IGNORE:
             overwrite_pref = not is_new and config.updated_preference_import_strategy == UpdatedRowImportStrategy.OVERWRITE
-            wants = {k.lower() for k, v in row.items() if is_normal_attr(k) and v.lower() == 'true'}
+            wants, avoids, prefers, room_wants, room_avoids = schema.preferences(values)
             student.wants = wants if (is_new or overwrite_pref) else student.wants.union(wants)
-            avoids = {k.lower() for k, v in row.items() if is_normal_attr(k) and v.lower() == 'false'}
             student.avoids = avoids if (is_new or overwrite_pref) else student.avoids.union(avoids)
-            room_wants = {attr_to_room_id(k) for k, v in row.items() if is_room_attr(k) and v.lower() == 'true'}
             student.room_wants = room_wants if (is_new or overwrite_pref) else student.room_wants.union(room_wants)
-            room_avoids = {attr_to_room_id(k) for k, v in row.items() if is_room_attr(k) and v.lower() == 'false'}
             student.room_avoids = room_avoids if (is_new or overwrite_pref) else student.room_avoids.union(room_avoids)
+            student.prefers = prefers if (is_new or overwrite_pref) else (student.prefers or set()).union(prefers)
             if not student.wants.isdisjoint(student.avoids) \
+                    or not student.prefers.isdisjoint(student.avoids) \
                     or not student.room_wants.isdisjoint(student.room_avoids):
                 invalid_students.append(row)
                 continue
 
+        new_preference = get_preference_from_student(student)
+        new_preference = preferences.setdefault(new_preference, new_preference)
+
         # revalidate existing assignments
         if config.revalidate_existing_assignments:
-            new_preference = get_preference_from_student(student)
-            if student.assignment and not is_seat_valid_for_preference(student.assignment.seat, new_preference):
+            if student.assignment and not is_valid(student.assignment.seat, new_preference):
                 student.assignment = None
 
         # some rows have already have a prev seat, or have seat assignment specified, try use that if that is valid
         # try to match id first, then match name
         if config.assignment_import_strategy != AssignmentImportStrategy.IGNORE:
             ignore_restrictions_for_new = config.assignment_import_strategy == AssignmentImportStrategy.FORCE
-            seat_id = row.pop('seat id', row.pop('assignment', None))
+            seat_id = values[schema.seat_id]
             if seat_id:
-                seat = Seat.query.get(int(seat_id))
-                if seat and not seat.assignment and seat.room.exam_id == exam.id \
-                        and (ignore_restrictions_for_new or is_seat_valid_for_preference(seat, new_preference)) \
-                        and seat_id not in new_assignment_ids:
-                    new_assignment_ids.add(seat_id)
+                seat = existing.seats_by_id.get(int(seat_id))
+                if seat and not seat.assignment \
+                        and (ignore_restrictions_for_new or is_valid(seat, new_preference)) \
+                        and seat.id not in new_assignment_ids:
+                    new_assignment_ids.add(seat.id)
                     student.assignment = SeatAssignment(student=student, seat=seat, emailed=emailed == 'true')
             else:
-                room_name = row.pop('session name', row.pop('room name', None))
-                seat_name = row.pop('seat name', None)
+                room_name, seat_name = values[schema.room_name], values[schema.seat_name]
                 if room_name and seat_name:
-                    room_inferred = None
-                    for room in exam.rooms:
-                        if room.name_and_start_at_time_display() == room_name:
-                            room_inferred = room
-                            break
-                    seats_inferred: list[Seat] = []
-                    if room_inferred:
-                        seats_inferred.extend(Seat.query.filter_by(room_id=room_inferred.id, name=seat_name).all())
-                        if not seats_inferred and 'Movable Seat' in seat_name:
-                            seats_inferred.extend(Seat.query.filter_by(room_id=room_inferred.id, name=None).all())
-                    for seat in seats_inferred:
+                    for seat in existing.infer_seats(room_name, seat_name):
                         if not seat.assignment \
-                                and (ignore_restrictions_for_new or is_seat_valid_for_preference(seat, new_preference))\
+                                and (ignore_restrictions_for_new or is_valid(seat, new_preference))\
                                 and seat.id not in new_assignment_ids:
                             new_assignment_ids.add(seat.id)
                             student.assignment = SeatAssignment(student=student, seat=seat, emailed=emailed == 'true')
                             break
 
+        # a canvas id repeated in the file is one student: later rows merge into it, as into an existing student
+        if student in prepared_students:
+            continue
+        prepared_students.add(student)
         if is_new:
             new_students.append(student)
+            existing.students_by_canvas_id[student.canvas_id] = student
         else:
             updated_students.append(student)
 
     if config.missing_student_import_strategy == MissingRowImportStrategy.DELETE:
         imported_canvas_ids = {student.canvas_id for student in new_students + updated_students}
-        for student in exam.students:
+        for student in existing.students:
             if student.canvas_id not in imported_canvas_ids:
                 students_ids_to_remove.append(student.id)
 
     return new_students, updated_students, invalid_students, students_ids_to_remove
+
+
+class StudentImportReport:
+    """
+    The outcome of a student import, as counts.
+    Only the first SAMPLE_SIZE updated names and invalid rows are kept, for display,
+    so the report does not grow with the file.
+    """
+    SAMPLE_SIZE = 100
+
+    def __init__(self):
+        self.new = 0
+        self.updated = 0
+        self.invalid = 0
+        self.removed = 0
+        self.updated_names: list[str] = []
+        self.invalid_rows: list[dict] = []
+
+    def add_chunk(self, new_students, updated_students, invalid_students):
+        self.new += len(new_students)
+        self.updated += len(updated_students)
+        self.invalid += len(invalid_students)
+        self.updated_names.extend(student.name for student in updated_students[:self.SAMPLE_SIZE - len(self.updated_names)])
+        self.invalid_rows.extend(invalid_students[:self.SAMPLE_SIZE - len(self.invalid_rows)])
+
+
+def import_students_in_chunks(session, exam, headers, rows, *, config: StudentImportConfig = StudentImportConfig(),
+                              chunk_size: int = 500) -> StudentImportReport:
+    """
+    Import students from rows, any iterable (such as the iterator of iter_csv), without holding it all in memory.
+
+    The strategy:
+    Load the seats and rooms of the exam once (see ExamImportIndex.load_seats).
+    Take chunk_size rows at a time, and prepare them as prepare_students does, against only the existing
+    students they name (see ExamImportIndex.load_students), then write them with upsert_students.
+    Expunge the students of the chunk from the session; the seats the chunk changed were expired by upsert_students.
+    Missing students are deleted last, if the strategy says so, by the canvas ids seen across all chunks.
+    Memory is bounded by the chunk size and the size of the exam, not by the number of rows,
+    and the seats are read once, not once per chunk.
+    Like the other imports, it is all or nothing: the chunks are written in one transaction, committed at the end,
+    so that on an error the caller's rollback discards every chunk.
+    """
+    validate_student_headers(headers)
+    delete_missing = config.missing_student_import_strategy == MissingRowImportStrategy.DELETE
+    # a chunk only sees part of the file, so it cannot tell which students are missing
+    chunk_config = copy.copy(config)
+    chunk_config.missing_student_import_strategy = MissingRowImportStrategy.IGNORE
+    report = StudentImportReport()
+    imported_canvas_ids = set()
+    schemas: dict[tuple, StudentHeaderSchema] = {}
+    existing = ExamImportIndex()
+    existing.load_seats(exam)
+
+    for chunk in chunked(rows, chunk_size):
+        canvas_ids = set()
+        for row in chunk:
+            schema = StudentHeaderSchema.for_row(schemas, row)
+            canvas_id = schema.values(row)[schema.canvas_id]
+            if canvas_id:
+                canvas_ids.add(str(canvas_id))
+        existing.load_students(exam, canvas_ids)
+        new_students, updated_students, invalid_students, _ = prepare_students(
+            exam, headers, chunk, config=chunk_config, existing=existing)
+        report.add_chunk(new_students, updated_students, invalid_students)
+        if delete_missing:
+            imported_canvas_ids.update(student.canvas_id for student in new_students + updated_students)
+        upsert_students(session, exam, new_students, updated_students, config=chunk_config)
+        for instance in list(session):
+            # expunging a student also expunges its assignment, so its seat reloads the assignment when next read;
+            # the seats and rooms are kept for the next chunk
+            if isinstance(instance, Student) and instance in session:
+                # an assignment upsert_students changed was expired with its seat, and is not loaded here
+                assignment = inspect(instance).attrs.assignment.loaded_value
+                if isinstance(assignment, SeatAssignment) and assignment.seat in session:
+                    session.expire(assignment.seat, ['assignment'])
+                session.expunge(instance)
+
+    if delete_missing:
+        students = session.query(Student.id, Student.canvas_id).filter(Student.exam_id == exam.id)
+        ids_to_remove = [student_id for student_id, canvas_id in students if canvas_id not in imported_canvas_ids]
+        for ids in chunked(ids_to_remove, chunk_size):
+            Student.query.filter(Student.id.in_(ids)).delete(synchronize_session=False)
+        report.removed = len(ids_to_remove)
+    session.commit()
+    return report
+
+
+def import_students(session, exam, headers, rows, *, config: StudentImportConfig = StudentImportConfig(),
+                    backend: str = 'orm', chunk_size: int = None) -> StudentImportReport:
+    """
+    Import students from rows, any iterable, by the import path chosen by backend and chunk_size, and commit.
+    With a chunk_size, the rows are imported in chunks of that many rows (see import_students_in_chunks).
+    Otherwise, the "staging" backend imports them with set-based SQL on PostgreSQL
+    (see server/services/core/staging.py), and the "orm" backend prepares them all with prepare_students,
+    then writes them with upsert_students.
+    Every path is all or nothing, and reports its outcome as a StudentImportReport.
+    """
+    if chunk_size:
+        return import_students_in_chunks(session, exam, headers, rows, config=config, chunk_size=chunk_size)
+    report = StudentImportReport()
+    if backend == 'staging':
+        # the staging import builds on this module
+        from server.services.core.staging import import_students_with_staging
+        new_students, updated_students, invalid_students, removed_ids = import_students_with_staging(
+            session, exam, headers, rows, config=config)
+        report.add_chunk(new_students, updated_students, invalid_students)
+    else:
+        new_students, updated_students, invalid_students, removed_ids = prepare_students(
+            exam, headers, rows, config=config)
+        # names are read before the write, which detaches the students
+        report.add_chunk(new_students, updated_students, invalid_students)
+        upsert_students(session, exam, new_students, updated_students, config=config)
+        if removed_ids:
+            Student.query.filter(Student.id.in_(removed_ids)).delete(synchronize_session=False)
+        session.commit()
+    report.removed = len(removed_ids)
+    return report
@@ -0,0 +1,231 @@
+from sqlalchemy import bindparam, inspect, select
+from sqlalchemy.dialects import postgresql, sqlite
+
+from server.models import Attribute, PreferenceClass, SeatAssignment, Student, StudentPreference, \
+    student_preference_links
+from server.typings.enum import NewRowImportStrategy, UpdatedRowImportStrategy
+from server.utils.misc import chunked
+
+_INFO_COLUMNS = ('name', 'email', 'sid', 'section')
+_PREFERENCE_COLUMNS = ('wants', 'avoids', 'room_wants', 'room_avoids', 'prefers')
+_LINK_COLUMNS = ('wants', 'avoids', 'prefers')
+# keys per IN list, below the bound parameter limit of every supported database
+_BATCH_SIZE = 1000
+_UPSERT_INSERTS = {'sqlite': sqlite.insert, 'postgresql': postgresql.insert}
+
+
+def ids_by_key(session, table, key_column: str, rows_by_key: dict) -> dict:
+    """
+    Return the ids of the rows of table by their unique key_column,
+    inserting the rows of rows_by_key whose key is not found, with one executemany.
+    """
+    key = table.c[key_column]
+
+    def select_ids(keys):
+        return {value: id for batch in chunked(keys, _BATCH_SIZE)
+                for id, value in session.execute(select(table.c.id, key).where(key.in_(batch)))}
+    ids = select_ids(list(rows_by_key))
+    missing = [row for value, row in rows_by_key.items() if value not in ids]
+    if missing:
+        session.execute(table.insert(), missing)
+        ids.update(select_ids([row[key_column] for row in missing]))
+    return ids
+
+
+def _write_student_rows(session, exam_id: int, rows: list[dict], update_columns: list[str]):
+    """
+    Insert or update the student rows, matched by (exam_id, canvas_id): update_columns are overwritten on match.
+    Uses the native upsert of SQLite and PostgreSQL, otherwise one executemany insert and one executemany update.
+    """
+    table = Student.__table__
+    make_insert = _UPSERT_INSERTS.get(session.connection().dialect.name)
+    if make_insert:
+        insert = make_insert(table)
+        if update_columns:
+            insert = insert.on_conflict_do_update(index_elements=['exam_id', 'canvas_id'],
+                                                  set_={column: insert.excluded[column] for column in update_columns})
+        else:
+            insert = insert.on_conflict_do_nothing(index_elements=['exam_id', 'canvas_id'])
+        session.execute(insert, rows)
+        return
+    existing = set(session.execute(select(table.c.canvas_id).where(table.c.exam_id == exam_id)).scalars())
+    inserts = [row for row in rows if row['canvas_id'] not in existing]
+    updates = [{'b_canvas_id': row['canvas_id'], **{f'b_{column}': row[column] for column in update_columns}}
+               for row in rows if row['canvas_id'] in existing]
+    if inserts:
+        session.execute(table.insert(), inserts)
+    if updates and update_columns:
+        session.execute(
+            table.update().where(table.c.exam_id == exam_id, table.c.canvas_id == bindparam('b_canvas_id'))
+            .values({column: bindparam(f'b_{column}') for column in update_columns}),
+            updates)
+
+
+def _final_values(exam_id: int, students) -> tuple[dict, dict, dict]:
+    """
+    Read the columns, preference links and assignment of the prepared students, by canvas id.
+    """
+    rows, links, assignments = {}, {}, {}
+    for student in students:
+        canvas_id = student.canvas_id
+        rows[canvas_id] = {'exam_id': exam_id, 'canvas_id': canvas_id,
+                           **{column: getattr(student, column) for column in _INFO_COLUMNS},
+                           **{column: set(getattr(student, column) or ()) for column in _PREFERENCE_COLUMNS}}
+        links[canvas_id] = student_preference_links(student)
+        assignment = student.assignment
+        assignments[canvas_id] = None if assignment is None else \
+            {'seat_id': assignment.seat.id, 'exam_id': exam_id, 'emailed': bool(assignment.emailed)}
+    return rows, links, assignments
+
+
+def _detach(session, students):
+    """
+    Take the prepared students, their old and new assignments and the seats of those out of the unit of work,
+    so that the session does not write them: pending ones are expunged, persistent ones are expired,
+    which discards their unflushed changes and leaves any other change of the session alone.
+    """
+    instances = []
+    for student in students:
+        instances.append(student)
+        for assignment in [student.assignment, *(inspect(student).attrs.assignment.history.deleted or ())]:
+            if assignment is not None:
+                instances += [assignment, assignment.seat]
+    for instance in instances:
+        if instance is None or instance not in session:
+            continue
+        if inspect(instance).pending:
+            session.expunge(instance)
+        else:
+            session.expire(instance)
+
+
+def _stored_values(session, exam_id: int, canvas_ids) -> tuple[dict, dict]:
+    """
+    Read the columns and assignment of the students of the exam with the given canvas ids, as stored in the database,
+    including whatever an autoflush wrote while they were prepared.
+    """
+    student_table, assignment_table = Student.__table__, SeatAssignment.__table__
+    columns = [student_table.c[column] for column in ('canvas_id',) + _INFO_COLUMNS + _PREFERENCE_COLUMNS]
+    query = select(*columns, assignment_table.c.seat_id, assignment_table.c.emailed) \
+        .outerjoin(assignment_table, assignment_table.c.student_id == student_table.c.id)
+    rows, assignments = {}, {}
+    for batch in chunked(canvas_ids, _BATCH_SIZE):
+        for row in session.execute(query.where(student_table.c.exam_id == exam_id,
+                                               student_table.c.canvas_id.in_(batch))).mappings():
+            canvas_id = row['canvas_id']
+            rows[canvas_id] = {column: row[column] for column in _INFO_COLUMNS + _PREFERENCE_COLUMNS}
+            assignments[canvas_id] = None if row['seat_id'] is None else \
+                {'seat_id': row['seat_id'], 'exam_id': exam_id, 'emailed': row['emailed']}
+    return rows, assignments
+
+
+def _student_ids(session, exam_id: int, canvas_ids) -> dict:
+    student_table = Student.__table__
+    return {canvas_id: id for batch in chunked(canvas_ids, _BATCH_SIZE)
+            for canvas_id, id in session.execute(
+                select(student_table.c.canvas_id, student_table.c.id).where(
+                    student_table.c.exam_id == exam_id, student_table.c.canvas_id.in_(batch)))}
+
+
+def _delete_by_student_ids(session, table, student_ids: list[int]):
+    for batch in chunked(student_ids, _BATCH_SIZE):
+        session.execute(table.delete().where(table.c.student_id.in_(batch)))
+
+
+def _set_preference_class_ids(session, rows: list[dict]):
+    """
+    Intern the preference classes of the rows, and set their preference_class_id.
+    """
+    canonicals = [PreferenceClass.canonical(*(row[column] for column in _PREFERENCE_COLUMNS)) for row in rows]
+    classes = {}
+    for canonical in set(canonicals):
+        key = PreferenceClass.key_for(canonical)
+        classes[key] = {'key': key, **{column: set(values) for column, values in zip(_PREFERENCE_COLUMNS, canonical)}}
+    class_ids = ids_by_key(session, PreferenceClass.__table__, 'key', classes)
+    for row, canonical in zip(rows, canonicals):
+        row['preference_class_id'] = class_ids[PreferenceClass.key_for(canonical)]
+
+
+def _write_links(session, links: dict, student_ids: dict):
+    """
+    Replace the preference links of the students, given as {canvas id: (kind, attribute name) pairs}.
+    """
+    link_table = StudentPreference.__table__
+    _delete_by_student_ids(session, link_table, [student_ids[canvas_id] for canvas_id in links])
+    names = {name for pairs in links.values() for _, name in pairs}
+    attribute_ids = ids_by_key(session, Attribute.__table__, 'name', {name: {'name': name} for name in names})
+    link_rows = [{'student_id': student_ids[canvas_id], 'attribute_id': attribute_ids[name], 'kind': kind}
+                 for canvas_id, pairs in links.items() for kind, name in sorted(pairs)]
+    if link_rows:
+        session.execute(link_table.insert(), link_rows)
+
+
+def _write_assignments(session, assignments: dict, student_ids: dict):
+    """
+    Replace the assignments of the students, given as {canvas id: assignment row, or None to clear it}.
+    """
+    assignment_table = SeatAssignment.__table__
+    _delete_by_student_ids(session, assignment_table, [student_ids[canvas_id] for canvas_id in assignments])
+    rows = [{'student_id': student_ids[canvas_id], **assignment}
+            for canvas_id, assignment in assignments.items() if assignment is not None]
+    if rows:
+        session.execute(assignment_table.insert(), rows)
+
+
+def _has_changes(row: dict, stored_row: dict | None, columns) -> bool:
+    return stored_row is None or any(row[column] != stored_row[column] for column in columns)
+
+
+def _update_columns(config) -> list[str]:
+    """
+    The columns the strategies of config overwrite on a key conflict.
+    """
+    update_columns = []
+    if config.updated_student_info_import_strategy != UpdatedRowImportStrategy.IGNORE:
+        update_columns += _INFO_COLUMNS
+    if config.updated_preference_import_strategy != UpdatedRowImportStrategy.IGNORE:
+        update_columns += _PREFERENCE_COLUMNS + ('preference_class_id',)
+    return update_columns
+
+
+def upsert_students(session, exam, new_students, updated_students, *, config):
+    """
+    Write the students prepared by prepare_students, with the same StudentImportConfig,
+    with set-based statements instead of the unit of work.
+
+    The strategy:
+    Read the final values off the prepared students: their columns, preference links and assignment.
+    Detach the prepared objects from the session (see _detach), so the session can hold other pending changes.
+    Compare the final values with the stored rows, read in batches by canvas id, and keep only the changes:
+    this also sees what an autoflush already wrote while the students were prepared.
+    Write the changed students with one upsert keyed on (exam_id, canvas_id), then the preference classes,
+    attributes, preference links and assignments with a few batched statements each.
+    On a key conflict, the columns the strategies would keep (UpdatedRowImportStrategy.IGNORE) are kept;
+    merging was done by prepare_students. New rows are only written with NewRowImportStrategy.APPEND.
+    The caller commits.
+    """
+    exam_id = exam.id
+    if config.new_student_import_strategy == NewRowImportStrategy.IGNORE:
+        new_students = []
+    students = new_students + updated_students
+    rows, links, assignments = _final_values(exam_id, students)
+    _detach(session, students)
+    stored_rows, stored_assignments = _stored_values(session, exam_id, list(rows))
+
+    changed_rows = [row for canvas_id, row in rows.items()
+                    if _has_changes(row, stored_rows.get(canvas_id), _INFO_COLUMNS + _PREFERENCE_COLUMNS)]
+    links = {canvas_id: pairs for canvas_id, pairs in links.items()
+             if _has_changes(rows[canvas_id], stored_rows.get(canvas_id), _LINK_COLUMNS)}
+    assignments = {canvas_id: assignment for canvas_id, assignment in assignments.items()
+                   if assignment != stored_assignments.get(canvas_id)}
+    if not changed_rows and not assignments:
+        return
+
+    if changed_rows:
+        _set_preference_class_ids(session, changed_rows)
+        _write_student_rows(session, exam_id, changed_rows, _update_columns(config))
+    student_ids = _student_ids(session, exam_id, set(links) | set(assignments))
+    if links:
+        _write_links(session, links, student_ids)
+    if assignments:
+        _write_assignments(session, assignments, student_ids)
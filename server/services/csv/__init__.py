@@ -19,6 +19,15 @@ def parse_csv(file):
     return parse_csv_str(file.read().decode('utf-8'))
 
 
+def iter_csv(file):
+    """
+    Parse a CSV file as it is read: return a list of headers and an iterator of rows.
+    The binary stream is decoded incrementally, so only the current row is held in memory.
+    """
+    reader = LowerCaseDictReader(io.TextIOWrapper(file, encoding='utf-8', newline=''))
+    return list(reader.fieldnames), iter(reader)
+
+
 def parse_csv_str(csv_str):
     """
     Parse a CSV string and return a list of headers and rows.
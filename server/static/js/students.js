@@ -0,0 +1,208 @@
+// Virtualized student table: rows are fetched page by page from the students JSON endpoint
+// (keyset pagination), and only the rows in view, plus a margin, are in the DOM.
+// The search box filters the table by prefix, and suggests the best matches anywhere in a name, email or id
+// from the typeahead endpoint, to find a student and their seat during check-in.
+(function () {
+  var ROW_HEIGHT = 56;
+  var OVERSCAN = 10;
+  var PAGE_SIZE = 200;
+
+  var viewport = document.getElementById('student-viewport');
+  var body = document.getElementById('student-rows');
+  var count = document.getElementById('student-count');
+  var search = document.getElementById('search');
+  var suggestions = document.getElementById('search-suggestions');
+  var columns = viewport.querySelectorAll('thead th').length;
+  var SUGGESTION_COUNT = 8;
+
+  var state = { rows: [], next: null, total: 0, loading: false, done: false, q: '', sort: 'name', order: 'asc', generation: 0 };
+
+  function escapeHtml(value) {
+    return String(value === null || value === undefined ? '' : value)
+      .replace(/&/g, '&amp;').replace(/</g, '&lt;').replace(/>/g, '&gt;')
+      .replace(/"/g, '&quot;').replace(/'/g, '&#39;');
+  }
+
+  function cards(values, className, title) {
+    return values.map(function (value) {
+      return '<div class="' + className + '"' + (title ? ' title="' + title + '"' : '') + '>' + escapeHtml(value) + '</div>';
+    }).join('');
+  }
+
+  function icon(name, onclick) {
+    return '<div class="material-icons" style="text-align: center; margin: 0; cursor: pointer;" onclick="' +
+      escapeHtml(onclick) + '">' + name + '</div>';
+  }
+
+  function cell(content, className) {
+    return '<td class="' + (className ? className + ' ' : '') + 'mdl-data-table__cell--non-numeric" style="text-align: center;">' +
+      content + '</td>';
+  }
+
+  function renderRow(student) {
+    var urls = student.urls;
+    var seat = urls.seat ? '<a class="assignment" href="' + escapeHtml(urls.seat) + '">' + escapeHtml(student.seat) + '</a>' : '<div>NO SEAT</div>';
+    var emailed = student.seat === null ? '<div>NO SEAT</div>'
+      : '<div>' + (student.emailed ? 'EMAILED' : 'NOT EMAILED') + '</div>' +
+        icon('email', "location.href = '" + urls.email + "';");
+    return '<tr>' +
+      cell('<a class="name" href="' + escapeHtml(urls.student) + '">' + escapeHtml(student.name) + '</a>') +
+      cell(escapeHtml(student.email.replace('@berkeley.edu', '@')), 'email') +
+      cell(escapeHtml(student.sid), 'sid') +
+      cell(escapeHtml(student.canvas_id), 'canvas_id') +
+      cell('<small>' + cards(student.wants, 'pref-card') + cards(student.prefers, 'pref-card soft', 'preferred, not required') + '</small>', 'wants') +
+      cell('<small>' + cards(student.avoids, 'pref-card') + '</small>', 'avoids') +
+      cell(seat) +
+      cell(emailed) +
+      cell(icon('assignment', "location.href = '" + urls.assign + "';")) +
+      cell(icon('edit', "location.href = '" + urls.edit + "';")) +
+      cell(icon('clear', "confirmAction('Are you sure you want to delete this student?', '" + urls.delete + "');")) +
+      '</tr>';
+  }
+
+  function spacer(rows) {
+    return rows > 0 ? '<tr style="height: ' + rows * ROW_HEIGHT + 'px;"><td colspan="' + columns + '"></td></tr>' : '';
+  }
+
+  function render() {
+    var first = Math.max(0, Math.floor(viewport.scrollTop / ROW_HEIGHT) - OVERSCAN);
+    var last = Math.min(state.rows.length, Math.ceil((viewport.scrollTop + viewport.clientHeight) / ROW_HEIGHT) + OVERSCAN);
+    var html = spacer(first);
+    for (var i = first; i < last; i++) {
+      html += renderRow(state.rows[i]);
+    }
+    body.innerHTML = html + spacer(state.total - Math.max(first, last));
+    count.textContent = state.total + ' students' + (state.q ? ' matching "' + state.q + '"' : '');
+    if (last >= state.rows.length - OVERSCAN) {
+      load();
+    }
+  }
+
+  function load() {
+    if (state.loading || state.done) {
+      return;
+    }
+    state.loading = true;
+    var generation = state.generation;
+    var params = new URLSearchParams({ q: state.q, sort: state.sort, order: state.order, limit: PAGE_SIZE });
+    if (state.next) {
+      params.set('after', state.next);
+    }
+    fetch(viewport.dataset.url + '?' + params.toString(), { credentials: 'same-origin' })
+      .then(function (response) { return response.json(); })
+      .then(function (page) {
+        if (generation !== state.generation) {
+          return;
+        }
+        state.rows = state.rows.concat(page.students);
+        state.next = page.next;
+        state.total = page.total;
+        state.done = !page.next;
+        state.loading = false;
+        render();
+      })
+      .catch(function () {
+        state.loading = false;
+      });
+  }
+
+  function reset() {
+    state.generation++;
+    state.rows = [];
+    state.next = null;
+    state.total = 0;
+    state.loading = false;
+    state.done = false;
+    viewport.scrollTop = 0;
+    load();
+  }
+
+  var scheduled = false;
+  viewport.addEventListener('scroll', function () {
+    if (!scheduled) {
+      scheduled = true;
+      window.requestAnimationFrame(function () {
+        scheduled = false;
+        render();
+      });
+    }
+  });
+
+  viewport.querySelectorAll('th[data-sort]').forEach(function (th) {
+    th.addEventListener('click', function () {
+      var sort = th.dataset.sort;
+      state.order = state.sort === sort && state.order === 'asc' ? 'desc' : 'asc';
+      state.sort = sort;
+      reset();
+    });
+  });
+
+  var suggestionGeneration = 0;
+
+  function suggest(q) {
+    var generation = ++suggestionGeneration;
+    if (!q) {
+      suggestions.hidden = true;
+      return;
+    }
+    var params = new URLSearchParams({ q: q, limit: SUGGESTION_COUNT });
+    fetch(search.dataset.typeaheadUrl + '?' + params.toString(), { credentials: 'same-origin' })
+      .then(function (response) { return response.json(); })
+      .then(function (page) {
+        if (generation !== suggestionGeneration) {
+          return;
+        }
+        suggestions.innerHTML = page.students.map(function (student) {
+          return '<li><a href="' + escapeHtml(student.urls.student) + '">' + escapeHtml(student.name) +
+            ' <small>' + escapeHtml(student.email) + ' &middot; ' + escapeHtml(student.seat || 'NO SEAT') + '</small></a></li>';
+        }).join('');
+        suggestions.hidden = !page.students.length;
+      })
+      .catch(function () {
+        suggestions.hidden = true;
+      });
+  }
+
+  var debounce = null;
+  search.addEventListener('input', function () {
+    clearTimeout(debounce);
+    debounce = setTimeout(function () {
+      state.q = search.value.trim();
+      reset();
+      suggest(state.q);
+    }, 200);
+  });
+
+  search.addEventListener('keydown', function (event) {
+    var first = suggestions.querySelector('a');
+    if (event.key === 'Enter' && first && !suggestions.hidden) {
+      location.href = first.href;
+    } else if (event.key === 'ArrowDown' && first && !suggestions.hidden) {
+      event.preventDefault();
+      first.focus();
+    } else if (event.key === 'Escape') {
+      suggestions.hidden = true;
+    }
+  });
+
+  suggestions.addEventListener('keydown', function (event) {
+    var item = document.activeElement.parentElement;
+    var next = event.key === 'ArrowDown' ? item.nextElementSibling : event.key === 'ArrowUp' ? item.previousElementSibling : null;
+    if (event.key === 'ArrowDown' || event.key === 'ArrowUp') {
+      event.preventDefault();
+      (next ? next.querySelector('a') : search).focus();
+    } else if (event.key === 'Escape') {
+      suggestions.hidden = true;
+      search.focus();
+    }
+  });
+
+  document.addEventListener('click', function (event) {
+    if (!suggestions.contains(event.target) && event.target !== search) {
+      suggestions.hidden = true;
+    }
+  });
+
+  search.focus();
+  load();
+})();
@@ -37,3 +37,26 @@ class UpdatedRowImportStrategy(Enum):
 class MissingRowImportStrategy(Enum):
     IGNORE = 'ignore'  # ignore missing rows (seen canvas id)
     DELETE = 'delete'  # remove missing rows
+
+
+class AssignmentMode(Enum):
+    GREEDY = 'greedy'  # most constrained students first, random seat among valid ones
+    MATCHING = 'matching'  # max flow between preference classes and seat signatures; never fails if possible
+    OPTIMIZE = 'optimize'  # best of several seeded greedy runs
+    SOFT_PREFERENCE = 'soft_preference'  # like matching, also meeting as many soft wants ("prefer") as possible
+    SPACED = 'spaced'  # like greedy, leaving seats closer than the spacing to any student empty
+    SEPARATE_SECTIONS = 'separate_sections'  # like greedy, never seating students of a section closer than the spacing
+    INCREMENTAL = 'incremental'  # like matching, loading only the unassigned students and free seat counts
+
+
+class PreferenceKind(Enum):
+    WANT = 'want'
+    AVOID = 'avoid'
+    PREFER = 'prefer'
+
+
+class FillStrategy(Enum):
+    RANDOM = 'random'  # any valid seat, uniformly
+    PACK = 'pack'  # fill rooms one after another, by room id, which is the order they were added
+    BALANCE = 'balance'  # keep the fill ratio of rooms even
+    FRONT_FIRST = 'front_first'  # fill the front rows of each room first
@@ -17,6 +17,14 @@ class SeatAssignmentError(Exception):
 
 class NotEnoughSeatError(SeatAssignmentError):
     def __init__(self, exam, students, preference):
+        super().__init__(exam, students, preference)
+        self.exam = exam
+        self.students = students
+        self.preference = preference
+
+    def __str__(self):
+        # formatted lazily, as room names need a database lookup
+        exam, preference = self.exam, self.preference
         pref_str = """\
         wants: {}
         avoids: {}
@@ -28,14 +36,11 @@ class NotEnoughSeatError(SeatAssignmentError):
             ', '.join([exam.get_room(id).name_and_start_at_time_display(short=True) for id in preference.room_wants]),
             ', '.join([exam.get_room(id).name_and_start_at_time_display(short=True) for id in preference.room_avoids]),
         )
-        students_str = ', '.join([s.name for s in students])
-        super().__init__(self, "Assignment failed on:\n"
-                         f"- Student:\n{students_str}\n"
-                         f"- Preference:\n{pref_str}\n"
-                         "Seat with such preference does not exist or runs out.")
-
-    def __str__(self):
-        return self.args[1]
+        students_str = ', '.join([s.name for s in self.students])
+        return ("Assignment failed on:\n"
+                f"- Student:\n{students_str}\n"
+                f"- Preference:\n{pref_str}\n"
+                "Seat with such preference does not exist or runs out.")
 
 
 class SeatOverrideError(SeatAssignmentError):
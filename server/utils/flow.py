@@ -0,0 +1,166 @@
+import heapq
+from collections import deque
+
+
+class FlowNetwork:
+    """
+    A directed flow network on integer nodes 0..n-1, stored as an adjacency list of edge ids.
+    Edge i and edge i ^ 1 are each other's residual edge.
+    Edges may carry a non-negative cost per unit of flow, used by min_cost_flow.
+    """
+
+    def __init__(self, n: int):
+        self.n = n
+        self.graph: list[list[int]] = [[] for _ in range(n)]
+        self.to: list[int] = []
+        self.capacity: list[int] = []
+        self.cost: list[int] = []
+
+    def add_edge(self, u: int, v: int, capacity: int, cost: int = 0) -> int:
+        """
+        Add an edge u -> v and return its id, which can be passed to flow().
+        """
+        self.graph[u].append(len(self.to))
+        self.to.append(v)
+        self.capacity.append(capacity)
+        self.cost.append(cost)
+        self.graph[v].append(len(self.to))
+        self.to.append(u)
+        self.capacity.append(0)
+        self.cost.append(-cost)
+        return len(self.to) - 2
+
+    def flow(self, edge: int) -> int:
+        """
+        Return the flow currently pushed through the given edge.
+        """
+        return self.capacity[edge ^ 1]
+
+    def reachable(self, start: int, blocked=()) -> set[int]:
+        """
+        Return the nodes reachable from start through edges with residual capacity,
+        without passing through any of the blocked nodes.
+        """
+        seen = {start} | set(blocked)
+        queue = deque([start])
+        while queue:
+            u = queue.popleft()
+            for e in self.graph[u]:
+                if self.capacity[e] > 0 and self.to[e] not in seen:
+                    seen.add(self.to[e])
+                    queue.append(self.to[e])
+        return seen - set(blocked)
+
+    def max_flow(self, source: int, sink: int) -> int:
+        """
+        Push as much flow as possible from source to sink (Dinic's algorithm) and return its value.
+        """
+        total = 0
+        while True:
+            level = self._levels(source)
+            if level[sink] < 0:
+                return total
+            pointer = [0] * self.n
+            pushed = self._augment(source, sink, level, pointer)
+            while pushed:
+                total += pushed
+                pushed = self._augment(source, sink, level, pointer)
+
+    def min_cost_flow(self, source: int, sink: int) -> tuple[int, int]:
+        """
+        Push as much flow as possible from source to sink at the lowest total cost, and return (flow, cost).
+        Uses successive shortest paths, with Dijkstra on reduced costs (all edge costs must be non-negative).
+        """
+        total_flow, total_cost = 0, 0
+        potential = [0] * self.n
+        while True:
+            distance, previous_edge = self._shortest_paths(source, potential)
+            if distance[sink] is None:
+                return total_flow, total_cost
+            for v in range(self.n):
+                if distance[v] is not None:
+                    potential[v] += distance[v]
+            pushed, cost = self._augment_path(source, sink, previous_edge)
+            total_flow += pushed
+            total_cost += cost
+
+    def _shortest_paths(self, source: int, potential: list[int]) -> tuple[list, list[int]]:
+        """
+        Dijkstra from source over edges with residual capacity, on costs reduced by potential.
+        Return the distance to each node (None if unreachable) and the edge each node is reached through.
+        """
+        distance = [None] * self.n
+        distance[source] = 0
+        previous_edge = [-1] * self.n
+        queue = [(0, source)]
+        while queue:
+            d, u = heapq.heappop(queue)
+            if d > distance[u]:
+                continue
+            for e in self.graph[u]:
+                v = self.to[e]
+                if self.capacity[e] <= 0:
+                    continue
+                reduced = d + self.cost[e] + potential[u] - potential[v]
+                if distance[v] is None or reduced < distance[v]:
+                    distance[v] = reduced
+                    previous_edge[v] = e
+                    heapq.heappush(queue, (reduced, v))
+        return distance, previous_edge
+
+    def _augment_path(self, source: int, sink: int, previous_edge: list[int]) -> tuple[int, int]:
+        """
+        Push the bottleneck capacity along the path from source to sink given by previous_edge,
+        and return (flow pushed, its cost).
+        """
+        path, v = [], sink
+        while v != source:
+            path.append(previous_edge[v])
+            v = self.to[previous_edge[v] ^ 1]
+        pushed = min(self.capacity[e] for e in path)
+        for e in path:
+            self.capacity[e] -= pushed
+            self.capacity[e ^ 1] += pushed
+        return pushed, pushed * sum(self.cost[e] for e in path)
+
+    def _levels(self, source: int) -> list[int]:
+        level = [-1] * self.n
+        level[source] = 0
+        queue = deque([source])
+        while queue:
+            u = queue.popleft()
+            for e in self.graph[u]:
+                if self.capacity[e] > 0 and level[self.to[e]] < 0:
+                    level[self.to[e]] = level[u] + 1
+                    queue.append(self.to[e])
+        return level
+
+    def _augment(self, source: int, sink: int, level: list[int], pointer: list[int]) -> int:
+        """
+        Find one blocking-flow path in the level graph (iteratively, to avoid deep recursion)
+        and push its bottleneck capacity along it.
+        """
+        path: list[int] = []
+        u = source
+        while u != sink:
+            edges = self.graph[u]
+            while pointer[u] < len(edges):
+                e = edges[pointer[u]]
+                if self.capacity[e] > 0 and level[self.to[e]] == level[u] + 1:
+                    break
+                pointer[u] += 1
+            else:
+                # dead end: retreat one step
+                if not path:
+                    return 0
+                level[u] = -1
+                u = self.to[path.pop() ^ 1]
+                pointer[u] += 1
+                continue
+            path.append(e)
+            u = self.to[e]
+        pushed = min(self.capacity[e] for e in path)
+        for e in path:
+            self.capacity[e] -= pushed
+            self.capacity[e ^ 1] += pushed
+        return pushed
@@ -0,0 +1,27 @@
+class HeaderSchema:
+    """
+    The columns of a spreadsheet import, classified once instead of once per cell.
+    Rows are read as positional tuples (see values) in the order of columns:
+    the row's own columns, then any of special_headers it lacks, which read as None, as dict.get would.
+    Subclasses classify columns in __init__, after calling it.
+    """
+    special_headers: list[str] = []
+
+    def __init__(self, headers):
+        self.columns = tuple(dict.fromkeys(list(headers) + self.special_headers))
+        self.position = {header: i for i, header in enumerate(self.columns)}
+
+    @classmethod
+    def for_row(cls, schemas: dict, row: dict):
+        """
+        Return the schema of the row's columns, compiling it the first time a column layout is seen.
+        Rows of one spreadsheet share a layout, so this compiles once per import in practice.
+        """
+        keys = tuple(row)
+        schema = schemas.get(keys)
+        if schema is None:
+            schema = schemas[keys] = cls(keys)
+        return schema
+
+    def values(self, row: dict) -> tuple:
+        return tuple(map(row.get, self.columns))
@@ -21,3 +21,13 @@ def str_set_to_set(s, force_lower=True, ignore_empty=True):
 
 def set_to_str(s):
     return ','.join(s)
+
+
+def chunked(iterable, size):
+    """
+    Yield lists of up to size consecutive items of iterable, consuming it lazily.
+    """
+    from itertools import islice
+    iterator = iter(iterable)
+    while chunk := list(islice(iterator, size)):
+        yield chunk
@@ -0,0 +1,43 @@
+import math
+from collections import defaultdict
+
+
+class SeatGrid:
+    """
+    A grid hash of seats by room and coordinates, for neighbour queries.
+    Cells are as large as the query radius, so the neighbours of a point are all in the 3x3 cells around it,
+    and a query costs O(1) for bounded seat density, however large the room.
+    Seats without coordinates (movable seats) are not indexed.
+    A radius of 0 or less means no spacing constraint: no seat has neighbours.
+    """
+
+    def __init__(self, seats, radius: float):
+        """
+        seats have id, room_id, x and y attributes (see SeatRecord).
+        """
+        self.radius = radius
+        self._cells: dict[tuple[int, int, int], list] = defaultdict(list)
+        if radius <= 0:
+            return
+        for seat in seats:
+            if seat.x is not None and seat.y is not None:
+                self._cells[self._cell(seat.room_id, seat.x, seat.y)].append(seat)
+
+    def _cell(self, room_id, x, y) -> tuple[int, int, int]:
+        return room_id, math.floor(x / self.radius), math.floor(y / self.radius)
+
+    def neighbors(self, seat) -> list:
+        """
+        Return the other indexed seats of the seat's room closer to it than the radius.
+        The seat itself does not need to be indexed.
+        """
+        if seat.x is None or seat.y is None or self.radius <= 0:
+            return []
+        room_id, cx, cy = self._cell(seat.room_id, seat.x, seat.y)
+        found = []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                for other in self._cells.get((room_id, cx + dx, cy + dy), ()):
+                    if other.id != seat.id and math.hypot(other.x - seat.x, other.y - seat.y) < self.radius:
+                        found.append(other)
+        return found
@@ -1,7 +1,10 @@
+import random
 import re
 from flask import abort, redirect, render_template, request, send_file, url_for, flash, Response
 from flask.json import jsonify
 from flask_login import current_user, login_required
+from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.orm import selectinload
 
 from server import app
 from server.models import SeatAssignment, db, Exam, Room, Seat, Student
@@ -15,11 +18,15 @@ from server.services.google import get_spreadsheet_tabs
 import server.services.canvas as canvas_client
 from server.services.email import email_about_assignment, substitute_about_assignment
 from server.services.core.data import get_room_from_csv, get_room_from_google_spreadsheet, get_room_from_manual_input, \
-    get_students_from_canvas, get_students_from_csv, get_students_from_google_spreadsheet, update_room_from_manual_input, \
-    get_students_from_manual_input
+    get_students_from_canvas, get_students_from_google_spreadsheet, update_room_from_manual_input, \
+    get_students_from_manual_input, import_students_from_csv, save_imported_students
 from server.services.core.assign import assign_single_student, assign_students
-from server.typings.exception import NotEnoughSeatError, SeatAssignmentError
-from server.typings.enum import EmailTemplate
+from server.services.core.feasibility import analyze_feasibility
+from server.services.core.incremental import assign_students_incrementally
+from server.services.core.search import search_students, student_to_json, typeahead_students
+from server.services.core.snapshot import ExamSnapshot
+from server.typings.exception import DataValidationError, NotEnoughSeatError, SeatAssignmentError
+from server.typings.enum import AssignmentMode, EmailTemplate, FillStrategy
 from server.utils.date import to_ISO8601
 from server.utils.misc import set_to_str, str_set_to_set
 
@@ -437,6 +444,7 @@ def delete_room(exam, id):
     """
     room = Room.query.filter_by(exam_id=exam.id, id=id).first_or_404()
     if room:
+        displaced_student_ids = [seat.assignment.student_id for seat in room.seats if seat.assignment]
         try:
             db.session.delete(room)
             db.session.commit()
@@ -444,9 +452,34 @@ def delete_room(exam, id):
         except Exception as e:
             db.session.rollback()
             flash(f"Failed to delete room {room.display_name} (ID: {room.id}) due to an error:\n{e}", 'error')
+        else:
+            _reassign_displaced_students(exam, displaced_student_ids)
     return render_template('exam.html.j2', exam=exam)
 
 
+def _reassign_displaced_students(exam, student_ids):
+    """
+    Give a new seat to the students who lost theirs when a room was edited or deleted,
+    keeping every other assignment. Flash the outcome.
+    The room change is already committed, so errors leave the students unassigned and are only reported.
+    """
+    if not student_ids:
+        return
+    try:
+        assignments = assign_students_incrementally(exam, student_ids)
+        db.session.bulk_insert_mappings(SeatAssignment, [
+            {'student_id': student_id, 'seat_id': seat_id, 'exam_id': exam.id} for student_id, seat_id in assignments])
+        db.session.commit()
+        flash(f"Reassigned {len(assignments)} students who lost their seat.", 'success')
+    except SeatAssignmentError as e:
+        db.session.rollback()
+        flash(f"{len(student_ids)} students lost their seat and could not be reassigned: {e}", 'warning')
+    except SQLAlchemyError as e:
+        db.session.rollback()
+        flash(f"{len(student_ids)} students lost their seat and are now unassigned,"
+              f" since reassigning them failed due to a db error: {e}", 'warning')
+
+
 @app.route('/<exam:exam>/rooms/<int:id>/edit', methods=['GET', 'POST'])
 def edit_room(exam, id):
     """
@@ -486,6 +519,7 @@ def edit_room(exam, id):
         seats_to_add = defaultdict(int)
         for seat_form in form.movable_seats.data:
             seats_to_add[frozenset(str_set_to_set(seat_form['attributes']))] += max(0, seat_form['count'])
+        assigned_student_ids = {seat.assignment.student_id for seat in room.movable_seats if seat.assignment}
         try:
             update_room_from_manual_input(room, seats_to_add)
         except Exception as e:
@@ -494,6 +528,9 @@ def edit_room(exam, id):
             db.session.commit()
         except Exception as e:
             flash(f"Failed to edit room due to a db error: {e}", 'error')
+        else:
+            still_assigned_student_ids = {seat.assignment.student_id for seat in room.movable_seats if seat.assignment}
+            _reassign_displaced_students(exam, list(assigned_student_ids - still_assigned_student_ids))
         return redirect(url_for('exam', exam=exam))
     return render_template('upsert_room.html.j2', exam=exam, form=form, room=room)
 
@@ -540,19 +577,14 @@ def import_students_from_custom_sheet(exam):
         try:
             new_students, updated_students, invalid_students, students_ids_to_remove = get_students_from_google_spreadsheet(
                 exam, from_sheet_form)
-            to_commit = new_students + updated_students
-            if students_ids_to_remove:
-                Student.query.filter(Student.id.in_(students_ids_to_remove)).delete(synchronize_session=False)
-            if to_commit:
-                db.session.add_all(to_commit)
-            if students_ids_to_remove or to_commit:
-                db.session.commit()
+            updated_names = [s.name for s in updated_students]
+            save_imported_students(db.session, exam, from_sheet_form, new_students, updated_students, students_ids_to_remove)
             flash(
                 f"Import done. {len(new_students)} new students, {len(updated_students)} updated students"
                 f" {len(invalid_students)} invalid students. {len(students_ids_to_remove)} students removed.", 'success')
             if updated_students:
                 flash(
-                    f"Updated students: {set_to_str([s.name for s in updated_students])}", 'warning')
+                    f"Updated students: {set_to_str(updated_names)}", 'warning')
             if invalid_students:
                 flash(
                     f"Invalid students: {invalid_students}", 'error')
@@ -579,19 +611,14 @@ def import_students_from_canvas_roster(exam):
         try:
             new_students, updated_students, invalid_students, students_ids_to_remove = get_students_from_canvas(
                 exam, from_canvas_form)
-            to_commit = new_students + updated_students
-            if students_ids_to_remove:
-                Student.query.filter(Student.id.in_(students_ids_to_remove)).delete(synchronize_session=False)
-            if to_commit:
-                db.session.add_all(to_commit)
-            if students_ids_to_remove or to_commit:
-                db.session.commit()
+            updated_names = [s.name for s in updated_students]
+            save_imported_students(db.session, exam, from_canvas_form, new_students, updated_students, students_ids_to_remove)
             flash(
                 f"Import done. {len(new_students)} new students, {len(updated_students)} updated students"
                 f" {len(invalid_students)} invalid students. {len(students_ids_to_remove)} students removed.", 'success')
             if updated_students:
                 flash(
-                    f"Updated students: {set_to_str([s.name for s in updated_students])}", 'warning')
+                    f"Updated students: {set_to_str(updated_names)}", 'warning')
             if invalid_students:
                 flash(
                     f"Invalid students: {invalid_students}", 'error')
@@ -617,26 +644,22 @@ def import_students_from_csv_upload(exam):
     if from_csv_form.validate_on_submit():
         if from_csv_form.file.data:
             try:
-                new_students, updated_students, invalid_students, students_ids_to_remove = get_students_from_csv(
-                    exam, from_csv_form)
-                to_commit = new_students + updated_students
-                if students_ids_to_remove:
-                    Student.query.filter(Student.id.in_(students_ids_to_remove)).delete(synchronize_session=False)
-                if to_commit:
-                    db.session.add_all(to_commit)
-                if students_ids_to_remove or to_commit:
-                    db.session.commit()
+                report = import_students_from_csv(db.session, exam, from_csv_form,
+                                                  backend=app.config.get('STUDENT_IMPORT_BACKEND'),
+                                                  chunk_size=app.config.get('STUDENT_IMPORT_CHUNK_SIZE'))
                 flash(
-                    f"Import done. {len(new_students)} new students, {len(updated_students)} updated students"
-                    f" {len(invalid_students)} invalid students. {len(students_ids_to_remove)} students removed.", 'success')
-                if updated_students:
+                    f"Import done. {report.new} new students, {report.updated} updated students"
+                    f" {report.invalid} invalid students. {report.removed} students removed.", 'success')
+                if report.updated_names:
                     flash(
-                        f"Updated students: {set_to_str([s.name for s in updated_students])}", 'warning')
-                if invalid_students:
+                        f"Updated students: {set_to_str(report.updated_names)}", 'warning')
+                if report.invalid_rows:
                     flash(
-                        f"Invalid students: {invalid_students}", 'error')
+                        f"Invalid students: {report.invalid_rows}", 'error')
             except Exception as e:
-                flash(f"Failed to import students due to an unexpected error: {str(e)}", 'error')
+                db.session.rollback()
+                flash(f"Failed to import students due to an unexpected error: {str(e)}."
+                      " No student was imported.", 'error')
         else:
             flash("No file uploaded!", 'error')
         return redirect(url_for('students', exam=exam))
@@ -660,19 +683,15 @@ def import_students_from_manual_input(exam):
         try:
             new_students, updated_students, invalid_students, students_ids_to_remove = get_students_from_manual_input(
                 exam, from_manual_input_form)
-            to_commit = new_students + updated_students
-            if students_ids_to_remove:
-                Student.query.filter(Student.id.in_(students_ids_to_remove)).delete(synchronize_session=False)
-            if to_commit:
-                db.session.add_all(to_commit)
-            if students_ids_to_remove or to_commit:
-                db.session.commit()
+            updated_names = [s.name for s in updated_students]
+            save_imported_students(db.session, exam, from_manual_input_form, new_students, updated_students,
+                                   students_ids_to_remove)
             flash(
                 f"Import done. {len(new_students)} new students, {len(updated_students)} updated students"
                 f" {len(invalid_students)} invalid students. {len(students_ids_to_remove)} students removed.", 'success')
             if updated_students:
                 flash(
-                    f"Updated students: {set_to_str([s.name for s in updated_students])}", 'warning')
+                    f"Updated students: {set_to_str(updated_names)}", 'warning')
             if invalid_students:
                 flash(
                     f"Invalid students: {invalid_students}", 'error')
@@ -714,8 +733,44 @@ def delete_students(exam):
 
 @app.route('/<exam:exam>/students/')
 def students(exam):
-    # TODO load assignment and seat at the same time?
-    return render_template('students.html.j2', exam=exam, students=exam.students)
+    # rows are fetched page by page from students_json
+    return render_template('students.html.j2', exam=exam)
+
+
+@app.route('/<exam:exam>/students/json/')
+def students_json(exam):
+    """
+    One page of the student list, for the students page.
+    Query parameters: q (prefix of a name, email, student id or canvas id), sort (name, email, sid or canvas_id),
+    order (asc or desc), after (the cursor of the previous page) and limit.
+    """
+    try:
+        students, cursor, total = search_students(
+            exam, prefix=request.args.get('q'), sort=request.args.get('sort', 'name'),
+            descending=request.args.get('order') == 'desc', after=request.args.get('after'),
+            limit=request.args.get('limit', 100, type=int))
+    except DataValidationError as e:
+        abort(400, str(e))
+    rooms_by_id = exam.rooms_by_id
+    return jsonify({
+        'students': [student_to_json(exam, student, rooms_by_id) for student in students],
+        'next': cursor,
+        'total': total,
+    })
+
+
+@app.route('/<exam:exam>/students/typeahead/')
+def students_typeahead(exam):
+    """
+    The students best matching q anywhere in their name, email, student id or canvas id, with their seat,
+    for looking students up during check-in. Query parameters: q and limit.
+    """
+    try:
+        students = typeahead_students(exam, request.args.get('q', ''), limit=request.args.get('limit', 10, type=int))
+    except DataValidationError as e:
+        abort(400, str(e))
+    rooms_by_id = exam.rooms_by_id
+    return jsonify({'students': [student_to_json(exam, student, rooms_by_id) for student in students]})
 
 
 @app.route('/<exam:exam>/students/export/csv')
@@ -796,25 +851,28 @@ def edit_students(exam):
                 Student.email.in_(emails) & (Student.exam_id == exam.id))
         else:
             students = Student.query.filter_by(exam_id=exam.id)
+        # loading the assignments up front keeps the loop below from autoflushing once per student
+        students = students.options(selectinload(Student.assignment)).all()
         edited = {student.email for student in students}
         did_not_exist = set()
         if not form.use_all_emails.data:
             did_not_exist = set(emails) - edited
         if not edited and not did_not_exist:
             abort(404, "No change has been made.")
+        # every edited student gets the same constraints, so they are checked once
+        new_wants_set = str_set_to_set(form.wants.data)
+        new_avoids_set = str_set_to_set(form.avoids.data)
+        new_room_wants_set = set(form.room_wants.data)
+        new_room_avoids_set = set(form.room_avoids.data)
+        # wants and avoids should not overlap
+        if not new_wants_set.isdisjoint(new_avoids_set) \
+                or not new_room_wants_set.isdisjoint(new_room_avoids_set):
+            flash(
+                "Wants and avoids should not overlap.\n"
+                f"Want: {new_wants_set}\nAvoid: {new_avoids_set}\n"
+                f"Room Want: {new_room_wants_set}\nRoom Avoid: {new_room_avoids_set}", 'error')
+            return render_template('edit_students.html.j2', exam=exam, form=form)
         for student in students:
-            new_wants_set = str_set_to_set(form.wants.data)
-            new_avoids_set = str_set_to_set(form.avoids.data)
-            new_room_wants_set = set(form.room_wants.data)
-            new_room_avoids_set = set(form.room_avoids.data)
-            # wants and avoids should not overlap
-            if not new_wants_set.isdisjoint(new_avoids_set) \
-                    or not new_room_wants_set.isdisjoint(new_room_avoids_set):
-                flash(
-                    "Wants and avoids should not overlap.\n"
-                    f"Want: {new_wants_set}\nAvoid: {new_avoids_set}\n"
-                    f"Room Want: {new_room_wants_set}\nRoom Avoid: {new_room_avoids_set}", 'error')
-                return render_template('edit_students.html.j2', exam=exam, form=form)
             orig_wants_set = set(student.wants)
             orig_avoids_set = set(student.avoids)
             orig_room_wants_set = set(student.room_wants)
@@ -860,8 +918,7 @@ def assign(exam):
     form = AssignForm()
     if form.validate_on_submit():
         def delete_all_assignments_no_sync(e):
-            seat_ids = {seat.id for room in e.rooms for seat in room.seats}
-            SeatAssignment.query.filter(SeatAssignment.seat_id.in_(seat_ids)).delete(synchronize_session=False)
+            e.delete_assignments()
             db.session.commit()
         if 'delete_all' in request.form:
             delete_all_assignments_no_sync(exam)
@@ -869,15 +926,34 @@ def assign(exam):
             return redirect(url_for('students', exam=exam))
         elif 'reassign_all' in request.form:
             delete_all_assignments_no_sync(exam)
+        mode = AssignmentMode(form.mode.data)
+        snapshot = None
+        # the incremental mode loads only what it needs, and checks feasibility itself
+        if mode != AssignmentMode.INCREMENTAL:
+            snapshot = ExamSnapshot.load(exam)
+            report = analyze_feasibility(exam, snapshot)
+            if not report.is_feasible:
+                flash(f"Assignment not attempted. {report}", 'error')
+                return redirect(url_for('assign', exam=exam, check=1))
         try:
-            assignments = assign_students(exam)
-            db.session.add_all(assignments)
+            seed = form.seed.data if form.seed.data is not None else random.randrange(2 ** 31)
+            spacing = form.spacing.data if form.spacing.data is not None else 2.0
+            assignments = assign_students(exam, mode=mode, snapshot=snapshot, seed=seed,
+                                          spacing=spacing, fill=FillStrategy(form.fill.data))
+            db.session.bulk_insert_mappings(SeatAssignment, [
+                {'student_id': student_id, 'seat_id': seat_id, 'exam_id': exam.id}
+                for student_id, seat_id in assignments])
             db.session.commit()
-            flash(f"Successfully assigned {len(assignments)} students.", 'success')
+            flash(f"Successfully assigned {len(assignments)} students (seed: {seed}).", 'success')
         except SeatAssignmentError as e:
             flash(str(e), 'error')
         return redirect(url_for('students', exam=exam))
-    return render_template('assign.html.j2', exam=exam, form=form)
+    # the analysis solves a max-flow over the whole exam, so it only runs on demand
+    report, rooms_by_id = None, {}
+    if request.args.get('check'):
+        report = analyze_feasibility(exam)
+        rooms_by_id = {room.id: room for room in exam.rooms}
+    return render_template('assign.html.j2', exam=exam, form=form, report=report, rooms_by_id=rooms_by_id)
 
 
 @app.route('/<exam_student:exam_student>/assign/', methods=['GET', 'POST'])
@@ -9,7 +9,8 @@ from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
 
 from server import app as flask_app
-from server.models import db as sqlalchemy_db
+from server.models import Exam, Room, Seat, Student, db as sqlalchemy_db
+from server.services.core.snapshot import ExamSnapshot
 from tests.fixtures import seed_db
 
 
@@ -105,3 +106,58 @@ def seeded_db(app):
         yield sqlalchemy_db
 
         sqlalchemy_db.session.expunge_all()
+
+
+@pytest.fixture()
+def staff_client(app, client, seeded_db, monkeypatch):
+    """
+    A client logged in as a staff member of the offering of the seeded exam, posting forms without CSRF tokens.
+    """
+    from server.models import User
+    monkeypatch.setitem(app.config, 'WTF_CSRF_ENABLED', False)
+    user = User.query.get(1)
+    # the fixture lists the offering as a plain string
+    user.staff_offerings = {'1234567'}
+    seeded_db.session.commit()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user.id)
+    return client
+
+
+@pytest.fixture()
+def exam169(seeded_db):
+    exam = Exam.query.get(1)
+    assert exam is not None
+    yield exam
+
+
+def make_room(room_id, seat_attributes):
+    room = Room(id=room_id, name=f'room{room_id}', display_name=f'Room {room_id}')
+    room.seats = [Seat(id=room_id * 1000 + i, attributes=set(attributes), fixed=False)
+                  for i, attributes in enumerate(seat_attributes)]
+    return room
+
+
+def make_grid_room(room_id, rows, columns):
+    room = Room(id=room_id, name=f'room{room_id}', display_name=f'Room {room_id}')
+    room.seats = [Seat(id=room_id * 1000 + y * columns + x, row=str(y), seat=str(x), name=f'{y}-{x}',
+                       x=float(x), y=float(y), attributes=set(), fixed=True)
+                  for y in range(rows) for x in range(columns)]
+    return room
+
+
+def make_student(student_id, wants=(), avoids=(), room_wants=(), room_avoids=(), prefers=(), section=None):
+    return Student(id=student_id, canvas_id=str(student_id), name=f'Student {student_id}',
+                   wants=set(wants), avoids=set(avoids), room_wants=set(room_wants), room_avoids=set(room_avoids),
+                   prefers=set(prefers), section=section)
+
+
+def make_exam(rooms, students):
+    exam = Exam(id=1, name='exam', display_name='Exam')
+    exam.rooms = rooms
+    exam.students = students
+    return exam
+
+
+def make_snapshot(rooms, students):
+    return ExamSnapshot.from_objects(students, [seat for room in rooms for seat in room.seats])
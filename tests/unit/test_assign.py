@@ -0,0 +1,431 @@
+import random
+from collections import Counter
+
+from server.forms import AssignForm
+from server.models import PreferenceClass, Seat, Student, StudentPreference, backfill_normalized_tables, \
+    seat_attributes
+from server.services.core.assign import FeasibilityMatrix, Preference, SeatAvailabilityIndex, assign_single_student, \
+    assign_students, assign_students_greedily, get_preference_from_student, is_seat_valid_for_preference
+from server.services.core.optimize import assign_students_optimized, score_assignment
+from server.services.core.snapshot import ExamSnapshot
+from server.typings.enum import AssignmentMode, FillStrategy
+from server.typings.exception import NotEnoughSeatError, SeatOverrideError
+from server.utils.spatial import SeatGrid
+from tests.conftest import make_exam, make_grid_room, make_room, make_snapshot, make_student
+import pytest
+
+
+def run_assign(rooms, students, mode=AssignmentMode.GREEDY, seed=None, **kwargs):
+    return assign_students(make_exam(rooms, students), mode=mode, snapshot=make_snapshot(rooms, students), seed=seed,
+                           **kwargs)
+
+
+def assert_valid_assignments(assignments, students, seats):
+    students_by_id = {s.id: s for s in students}
+    seats_by_id = {s.id: s for s in seats}
+    assert {student_id for student_id, _ in assignments} == set(students_by_id)
+    assert len({seat_id for _, seat_id in assignments}) == len(assignments)
+    for student_id, seat_id in assignments:
+        assert is_seat_valid_for_preference(seats_by_id[seat_id], get_preference_from_student(students_by_id[student_id]))
+
+
+def test_preference_is_normalized():
+    a = Preference({'Lefty'}, {'AISLE'}, {'1'}, set())
+    b = Preference({'lefty'}, {'aisle'}, {1}, set())
+    assert a == b
+    assert hash(a) == hash(b)
+    assert a.room_wants == {1}
+
+
+def test_seat_valid_for_preference_case_insensitive():
+    room = make_room(7, [['Lefty', 'Aisle']])
+    seat = room.seats[0]
+    assert is_seat_valid_for_preference(seat, Preference({'LEFTY'}, set(), set(), set()))
+    assert not is_seat_valid_for_preference(seat, Preference(set(), {'aisle'}, set(), set()))
+    assert is_seat_valid_for_preference(seat, Preference(set(), set(), {'7'}, set()))
+    assert not is_seat_valid_for_preference(seat, Preference(set(), set(), {'8'}, set()))
+    assert not is_seat_valid_for_preference(seat, Preference(set(), set(), set(), {'7'}))
+
+
+def test_feasibility_matrix_matches_preference_checks():
+    signatures = [(frozenset(attrs), room_id) for attrs in [(), ('lefty',), ('lefty', 'aisle'), ('aisle',)]
+                  for room_id in (1, 2, 3)]
+    preferences = [Preference(set(), set(), set(), set()),
+                   Preference({'lefty'}, set(), set(), set()),
+                   Preference({'lefty'}, {'aisle'}, {'1', '2'}, set()),
+                   Preference(set(), {'lefty'}, set(), {'3'}),
+                   Preference({'nonexistent'}, set(), set(), set())]
+    matrix = FeasibilityMatrix(preferences, signatures)
+    for preference in preferences:
+        expected = [s for s in signatures if preference.is_satisfied_by(s)]
+        assert matrix.feasible_signatures(preference) == expected
+        assert matrix.count(preference) == len(expected)
+
+
+def test_seat_signature_follows_attribute_changes(exam169):
+    seat = Seat.query.get(1)
+    assert seat.signature == (frozenset({'lefty'}), 1)
+    seat.attributes = {'Righty'}
+    assert seat.signature == (frozenset({'righty'}), 1)
+
+
+def test_snapshot_loads_unassigned_students_and_seats(exam169):
+    snapshot = ExamSnapshot.load(exam169)
+    assert {s.id for s in snapshot.students} == {s.id for s in exam169.unassigned_students}
+    assert {s.id for s in snapshot.seats} == {s.id for s in exam169.unassigned_seats}
+    lefty_seats = [s for s in snapshot.seats if 'lefty' in s.signature[0]]
+    assert len({id(s.signature) for s in lefty_seats}) == 1  # equal signatures are interned
+    assert {s.id for s, _ in snapshot.occupied_seats} == \
+        {s.assignment.seat.id for s in exam169.students if s.assignment and s.assignment.seat.x is not None}
+
+
+def test_unassigned_seat_and_student_queries(exam169):
+    assert {s.id for s in exam169.unassigned_seats} == {2, 3, 4, 5, 6, 7}
+    assert {s.id for s in exam169.unassigned_students} == {2, 3}
+    assert exam169.unassigned_seat_count() == 6
+    assert exam169.unassigned_student_count() == 2
+    assert {s.id for s in exam169.unassigned_seats_query(attributes=['LEFTY'])} == {3, 5, 7}
+    assert {s.id for s in exam169.unassigned_seats_query(avoid_attributes=['lefty'])} == {2, 4, 6}
+    assert exam169.unassigned_seat_count(attributes=['lef']) == 0
+    assert exam169.unassigned_seat_count(room_ids=['1']) == 6
+    assert exam169.unassigned_seat_count(avoid_room_ids=[1]) == 0
+
+
+def single_seat_id(db, exam, student_id, seat_id=None, ignore_restrictions=False):
+    seat = Seat.query.get(seat_id) if seat_id else None
+    try:
+        return assign_single_student(exam, Student.query.get(student_id), seat, ignore_restrictions).seat.id
+    finally:
+        db.session.rollback()
+
+
+def test_assign_single_student_picks_valid_free_seat(seeded_db, exam169):
+    for _ in range(10):
+        assert single_seat_id(seeded_db, exam169, 2) in {3, 5, 7}
+        assert single_seat_id(seeded_db, exam169, 3) in {2, 4, 6}
+    assert single_seat_id(seeded_db, exam169, 3, ignore_restrictions=True) in {2, 3, 4, 5, 6, 7}
+
+
+def test_assign_single_student_checks_chosen_seat(seeded_db, exam169):
+    assert single_seat_id(seeded_db, exam169, 2, 3) == 3
+    with pytest.raises(SeatOverrideError):
+        single_seat_id(seeded_db, exam169, 2, 2)  # does not meet the preference
+    with pytest.raises(SeatOverrideError):
+        single_seat_id(seeded_db, exam169, 2, 1, ignore_restrictions=True)  # taken
+    assert single_seat_id(seeded_db, exam169, 2, 2, ignore_restrictions=True) == 2
+
+
+def test_assign_single_student_room_preferences(exam169):
+    student = Student.query.get(2)
+    student.room_avoids = {'1'}
+    with pytest.raises(NotEnoughSeatError):
+        assign_single_student(exam169, student)
+
+
+def test_assign_students_seeded_exam(exam169):
+    unassigned_students, unassigned_seats = exam169.unassigned_students, exam169.unassigned_seats
+    assignments = assign_students(exam169)
+    assert_valid_assignments(assignments, unassigned_students, unassigned_seats)
+
+
+def test_assign_students_most_constrained_first():
+    room = make_room(1, [['lefty'], ['righty'], ['righty']])
+    students = [make_student(1), make_student(2), make_student(3, wants=['Lefty'])]
+    for _ in range(20):
+        assignments = run_assign([room], students)
+        assert_valid_assignments(assignments, students, room.seats)
+
+
+def test_assign_students_room_preferences():
+    rooms = [make_room(1, [[]] * 5), make_room(2, [[]] * 5)]
+    students = [make_student(i, room_wants=['1']) for i in range(5)] + \
+        [make_student(i, room_avoids=['1']) for i in range(5, 10)]
+    assignments = run_assign(rooms, students)
+    assert_valid_assignments(assignments, students, [seat for room in rooms for seat in room.seats])
+
+
+def test_assign_students_not_enough_seats():
+    room = make_room(1, [['lefty'], ['righty']])
+    students = [make_student(1, wants=['lefty']), make_student(2, wants=['lefty'])]
+    with pytest.raises(NotEnoughSeatError):
+        run_assign([room], students)
+
+
+def test_assign_students_large_exam():
+    rooms = [make_room(r, [['lefty'] if i % 10 == 0 else ['aisle'] if i % 7 == 0 else [] for i in range(200)])
+             for r in range(1, 11)]
+    students = [make_student(i, wants=['lefty'] if i % 20 == 0 else [],
+                             room_avoids=['3'] if i % 3 == 0 else []) for i in range(1800)]
+    assignments = run_assign(rooms, students)
+    assert_valid_assignments(assignments, students, [seat for room in rooms for seat in room.seats])
+
+
+def test_assign_students_matching_mode_finds_tight_assignment():
+    # every seat is needed, and 'lefty' students must not take the only seat 'aisle' students can use
+    room = make_room(1, [['lefty', 'aisle'], ['lefty'], ['lefty'], ['aisle']] + [[]] * 3)
+    students = [make_student(1, wants=['aisle']), make_student(2, wants=['aisle']),
+                make_student(3, wants=['lefty']), make_student(4, wants=['lefty'])] + \
+        [make_student(i) for i in range(5, 8)]
+    for _ in range(20):
+        assignments = run_assign([room], students, mode=AssignmentMode.MATCHING)
+        assert_valid_assignments(assignments, students, room.seats)
+
+
+def test_assign_students_matching_mode_not_enough_seats():
+    room = make_room(1, [['lefty'], ['righty'], []])
+    students = [make_student(1, wants=['lefty']), make_student(2, wants=['lefty']), make_student(3)]
+    with pytest.raises(NotEnoughSeatError):
+        run_assign([room], students, mode=AssignmentMode.MATCHING)
+
+
+def test_assign_students_matching_mode_large_exam():
+    rooms = [make_room(r, [['lefty'] if i % 10 == 0 else ['aisle'] if i % 7 == 0 else [] for i in range(200)])
+             for r in range(1, 11)]
+    students = [make_student(i, wants=['lefty'] if i % 10 == 0 else [],
+                             room_avoids=['3'] if i % 3 == 0 else []) for i in range(2000)]
+    assignments = run_assign(rooms, students, mode=AssignmentMode.MATCHING)
+    assert_valid_assignments(assignments, students, [seat for room in rooms for seat in room.seats])
+
+
+def test_preference_soft_wants_do_not_restrict_seats():
+    preference = Preference(set(), set(), set(), set(), {'Aisle', 'front'})
+    assert preference.is_satisfied_by((frozenset(), 1))
+    assert preference.satisfaction((frozenset({'aisle', 'front', 'lefty'}), 1)) == 2
+    assert preference != Preference(set(), set(), set(), set())
+
+
+def test_assign_students_soft_preference_mode_meets_soft_wants():
+    rooms = [make_room(1, [['aisle'] if i % 4 == 0 else [] for i in range(40)]),
+             make_room(2, [['aisle', 'front'] if i % 5 == 0 else ['lefty'] if i % 3 == 0 else [] for i in range(40)])]
+    students = [make_student(i, prefers=['aisle']) for i in range(10)] + \
+        [make_student(i, prefers=['aisle', 'front']) for i in range(10, 18)] + \
+        [make_student(i, wants=['lefty'], prefers=['front']) for i in range(18, 22)] + \
+        [make_student(i) for i in range(22, 60)]
+    seats = [seat for room in rooms for seat in room.seats]
+    for seed in range(5):
+        assignments = run_assign(rooms, students, mode=AssignmentMode.SOFT_PREFERENCE, seed=seed)
+        assert_valid_assignments(assignments, students, seats)
+        signatures = {seat.id: seat.signature for seat in seats}
+        preferences = {student.id: get_preference_from_student(student) for student in students}
+        # 10 'aisle' seats and 8 'aisle, front' seats are enough for every soft want but the 'lefty' students' ones
+        assert sum(preferences[student_id].satisfaction(signatures[seat_id])
+                   for student_id, seat_id in assignments) == 10 + 8 * 2
+
+
+def test_assign_students_soft_preference_mode_respects_hard_constraints():
+    room = make_room(1, [['aisle'], ['lefty'], []])
+    students = [make_student(1, prefers=['aisle']), make_student(2, wants=['aisle']), make_student(3)]
+    assignments = run_assign([room], students, mode=AssignmentMode.SOFT_PREFERENCE)
+    assert_valid_assignments(assignments, students, room.seats)
+
+
+def test_seat_grid_neighbors():
+    rooms = [make_grid_room(1, 3, 3), make_grid_room(2, 3, 3)]
+    snapshot = make_snapshot(rooms, [])
+    center = next(seat for seat in snapshot.seats if seat.id == 1004)
+    assert {seat.id for seat in SeatGrid(snapshot.seats, 1.1).neighbors(center)} == {1001, 1003, 1005, 1007}
+    assert SeatGrid(snapshot.seats, 0.0).neighbors(center) == []
+    assert {seat.id for seat in SeatGrid(snapshot.seats, 1.5).neighbors(center)} == \
+        {1000, 1001, 1002, 1003, 1005, 1006, 1007, 1008}
+
+
+def test_assign_students_spaced_mode():
+    rooms = [make_grid_room(1, 10, 10)]
+    students = [make_student(i) for i in range(25)]
+    for seed in range(5):
+        assignments = run_assign(rooms, students, mode=AssignmentMode.SPACED, seed=seed, spacing=1.1)
+        assert_valid_assignments(assignments, students, rooms[0].seats)
+        positions = {seat.id: (seat.x, seat.y) for seat in rooms[0].seats}
+        taken = [positions[seat_id] for _, seat_id in assignments]
+        for i, (x1, y1) in enumerate(taken):
+            for x2, y2 in taken[i + 1:]:
+                assert abs(x1 - x2) + abs(y1 - y2) > 1
+
+
+def test_assign_students_spaced_mode_not_enough_seats():
+    rooms = [make_grid_room(1, 1, 4)]
+    students = [make_student(i) for i in range(3)]
+    with pytest.raises(NotEnoughSeatError):
+        run_assign(rooms, students, mode=AssignmentMode.SPACED, spacing=1.1)
+
+
+def test_assign_students_separate_sections_mode():
+    rooms = [make_grid_room(1, 8, 10)]
+    students = [make_student(i, section=f'lab{i % 3}') for i in range(18)] + [make_student(i) for i in range(18, 40)]
+    sections = {student.id: student.section for student in students}
+    positions = {seat.id: (seat.x, seat.y) for seat in rooms[0].seats}
+    for seed in range(5):
+        assignments = run_assign(rooms, students, mode=AssignmentMode.SEPARATE_SECTIONS, seed=seed, spacing=1.5)
+        assert_valid_assignments(assignments, students, rooms[0].seats)
+        for i, (student1, seat1) in enumerate(assignments):
+            for student2, seat2 in assignments[i + 1:]:
+                if sections[student1] is not None and sections[student1] == sections[student2]:
+                    (x1, y1), (x2, y2) = positions[seat1], positions[seat2]
+                    assert max(abs(x1 - x2), abs(y1 - y2)) > 1
+
+
+def test_assign_students_pack_fill():
+    rooms = [make_room(r, [[]] * 10) for r in (3, 1, 2)]
+    students = [make_student(i) for i in range(15)] + [make_student(15, room_wants=['3'])]
+    assignments = run_assign(rooms, students, fill=FillStrategy.PACK)
+    assert_valid_assignments(assignments, students, [seat for room in rooms for seat in room.seats])
+    rooms_used = sorted(seat_id // 1000 for _, seat_id in assignments)
+    assert rooms_used == [1] * 10 + [2] * 5 + [3]
+
+
+def test_pack_fill_ranks_rooms_missing_from_room_order_last():
+    rooms = [make_room(r, [[]] * 2) for r in (1, 2, 3)]
+    students = [make_student(i) for i in range(4)]
+    snapshot = make_snapshot(rooms, students)
+    index = SeatAvailabilityIndex(snapshot.students, snapshot.seats, random.Random(0), fill=FillStrategy.PACK,
+                                  room_order=[3])
+    assignments = assign_students_greedily(None, index)
+    assert sorted(seat_id // 1000 for _, seat_id in assignments) == [1, 1, 3, 3]
+
+
+def test_assign_students_balance_fill():
+    rooms = [make_room(1, [[]] * 100), make_room(2, [[]] * 50), make_room(3, [['lefty']] * 50)]
+    students = [make_student(i) for i in range(100)]
+    assignments = run_assign(rooms, students, fill=FillStrategy.BALANCE)
+    assert_valid_assignments(assignments, students, [seat for room in rooms for seat in room.seats])
+    per_room = Counter(seat_id // 1000 for _, seat_id in assignments)
+    assert per_room == {1: 50, 2: 25, 3: 25}
+
+
+def test_assign_students_front_first_fill():
+    room = make_grid_room(1, 10, 12)
+    students = [make_student(i) for i in range(30)]
+    assignments = run_assign([room], students, fill=FillStrategy.FRONT_FIRST)
+    assert_valid_assignments(assignments, students, room.seats)
+    rows = {seat.id: seat.row for seat in room.seats}
+    assert sorted(rows[seat_id] for _, seat_id in assignments) == ['0'] * 12 + ['1'] * 12 + ['2'] * 6
+
+
+def test_assign_students_same_seed_same_result():
+    rooms = [make_room(r, [['lefty'] if i % 4 == 0 else [] for i in range(20)]) for r in range(1, 4)]
+    students = [make_student(i, wants=['lefty'] if i % 5 == 0 else []) for i in range(50)]
+    assert run_assign(rooms, students, seed=42) == run_assign(rooms, students, seed=42)
+
+
+def test_assign_students_optimize_mode():
+    # a random pick can take the 'aisle' seat that the 'aisle' student needs
+    rooms = [make_room(1, [['lefty', 'aisle'], ['lefty'], []]), make_room(2, [[]] * 6)]
+    students = [make_student(1, wants=['lefty']), make_student(2, wants=['aisle'])] + \
+        [make_student(i) for i in range(3, 8)]
+    assignments = run_assign(rooms, students, mode=AssignmentMode.OPTIMIZE, seed=7)
+    assert_valid_assignments(assignments, students, [seat for room in rooms for seat in room.seats])
+    assert assignments == run_assign(rooms, students, mode=AssignmentMode.OPTIMIZE, seed=7)
+
+
+def test_assign_students_optimized_runs_in_process_or_on_a_pool():
+    rooms = [make_room(1, [['lefty', 'aisle'], ['lefty'], []]), make_room(2, [[]] * 6)]
+    students = [make_student(1, wants=['lefty']), make_student(2, wants=['aisle'])] + \
+        [make_student(i) for i in range(3, 8)]
+    exam, snapshot = make_exam(rooms, students), make_snapshot(rooms, students)
+    assert assign_students_optimized(exam, snapshot, seed=7, runs=4, processes=1) == \
+        assign_students_optimized(exam, snapshot, seed=7, runs=4, processes=2)
+
+
+def test_assign_students_optimize_mode_applies_fill():
+    rooms = [make_room(1, [[]] * 4), make_room(2, [[]] * 4)]
+    students = [make_student(i) for i in range(4)]
+    assignments = run_assign(rooms, students, mode=AssignmentMode.OPTIMIZE, seed=3, fill=FillStrategy.PACK)
+    assert sorted(seat_id for _, seat_id in assignments) == [1000, 1001, 1002, 1003]
+
+
+@pytest.mark.parametrize('data, valid', [
+    ({'mode': 'optimize', 'fill': 'pack', 'spacing': '2.0'}, True),
+    ({'mode': 'optimize', 'fill': 'random', 'spacing': '3'}, False),
+    ({'mode': 'spaced', 'fill': 'pack', 'spacing': '3'}, True),
+    ({'mode': 'matching', 'fill': 'pack', 'spacing': '2.0'}, False),
+])
+def test_assign_form_rejects_options_the_mode_ignores(app, data, valid):
+    with app.test_request_context(method='POST', data=data):
+        assert AssignForm(meta={'csrf': False}).validate() == valid
+
+
+def test_score_assignment_prefers_balanced_rooms():
+    rooms = [make_room(1, [[]] * 4), make_room(2, [[]] * 4)]
+    students = [make_student(i) for i in range(4)]
+    snapshot = make_snapshot(rooms, students)
+    lopsided = [(i, 1000 + i) for i in range(4)]
+    balanced = [(0, 1000), (1, 1001), (2, 2000), (3, 2001)]
+    assert score_assignment(snapshot, balanced) > score_assignment(snapshot, lopsided)
+
+
+def test_score_assignment_counts_soft_preferences():
+    rooms = [make_room(1, [['aisle'], []]), make_room(2, [[], []])]
+    students = [make_student(0, prefers=['aisle']), make_student(1)]
+    snapshot = make_snapshot(rooms, students)
+    assert score_assignment(snapshot, [(0, 1000), (1, 2000)]) > score_assignment(snapshot, [(0, 1001), (1, 2000)])
+
+
+def test_snapshot_reads_preferences_by_class(seeded_db, exam169):
+    exam169.students.append(Student(canvas_id='legacy', email='legacy@berkeley.edu', name='Legacy',
+                                    wants={'lefty'}, avoids=set(), room_wants=set(), room_avoids=set()))
+    seeded_db.session.commit()
+    seeded_db.session.execute(Student.__table__.update().where(Student.canvas_id == 'legacy')
+                              .values(preference_class_id=None))
+    seeded_db.session.commit()
+    snapshot = ExamSnapshot.load_students(exam169)
+    by_id = {student.id: student.preference for student in snapshot.students}
+    assert by_id == {student.id: get_preference_from_student(student) for student in exam169.unassigned_students}
+
+
+def test_attribute_links_follow_attribute_changes(seeded_db, exam169):
+    seat = Seat.query.get(2)
+    assert [a.name for a in seat.attribute_refs] == ['righty']
+    seat.attributes = {'Lefty', 'Aisle'}
+    seeded_db.session.commit()
+    assert sorted(a.name for a in seat.attribute_refs) == ['aisle', 'lefty']
+    assert exam169.unassigned_seat_count(attributes=['lefty'], avoid_attributes=['aisle']) == 3
+    student = Student.query.get(3)
+    assert sorted((link.kind, link.attribute.name) for link in student.preference_links) == \
+        [('avoid', 'broken'), ('avoid', 'lefty'), ('want', 'righty')]
+
+
+def test_backfill_normalized_tables(seeded_db, exam169):
+    seeded_db.session.execute(seat_attributes.delete())
+    seeded_db.session.execute(StudentPreference.__table__.delete())
+    seeded_db.session.execute(Student.__table__.update().values(preference_class_id=None))
+    seeded_db.session.commit()
+    seeded_db.session.expire_all()
+    assert exam169.unassigned_seat_count(attributes=['lefty']) == 0
+    assert backfill_normalized_tables(seeded_db.session, batch_size=2) == (7, 3)
+    assert exam169.unassigned_seat_count(attributes=['lefty']) == 3
+    assert len(Student.query.get(2).preference_links) == 1
+    assert Student.query.get(2).preference_class is not None
+
+
+def test_students_with_equal_constraints_share_preference_class(seeded_db, exam169):
+    students = [Student(exam_id=exam169.id, canvas_id=f'c{i}', email=f'c{i}@berkeley.edu', name=f'C {i}',
+                        wants={'Lefty'} if i % 2 else {'lefty'}, avoids=set(), room_wants=set(), room_avoids=set())
+                for i in range(4)]
+    seeded_db.session.add_all(students)
+    seeded_db.session.commit()
+    assert len({student.preference_class_id for student in students}) == 1
+    assert students[0].preference_class.wants == {'lefty'}
+    classes = PreferenceClass.query.count()
+    students[0].wants = {'righty'}
+    seeded_db.session.commit()
+    assert students[0].preference_class_id != students[1].preference_class_id
+    assert students[0].preference_class.wants == {'righty'}
+    assert PreferenceClass.query.count() == classes + 1
+
+
+def test_students_with_seats_query_loads_in_constant_queries(seeded_db, exam169):
+    from sqlalchemy import event
+    statements = []
+
+    def count(*args):
+        statements.append(args)
+    students = exam169.students_with_seats_query()
+    event.listen(seeded_db.engine, 'before_cursor_execute', count)
+    try:
+        labels = [(s.assignment.seat.room.display_name, s.assignment.seat.name) if s.assignment else None
+                  for s in students.all()]
+    finally:
+        event.remove(seeded_db.engine, 'before_cursor_execute', count)
+    assert labels.count(None) == 2
+    assert len(statements) <= 2
+    assert set(exam169.rooms_by_id) == {'1'}
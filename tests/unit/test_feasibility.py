@@ -0,0 +1,40 @@
+from server.models import Exam
+from server.services.core.feasibility import analyze_feasibility
+from tests.conftest import make_exam, make_room, make_snapshot, make_student
+import pytest
+
+
+def test_feasible_exam():
+    room = make_room(1, [['lefty'], ['righty'], []])
+    students = [make_student(1, wants=['lefty']), make_student(2), make_student(3)]
+    report = analyze_feasibility(make_exam([room], students), make_snapshot([room], students))
+    assert report.is_feasible
+    assert report.over_subscriptions == []
+
+
+def test_single_class_over_subscribed():
+    room = make_room(1, [['lefty'], [], [], []])
+    students = [make_student(i, wants=['lefty']) for i in range(3)] + [make_student(3)]
+    report = analyze_feasibility(make_exam([room], students), make_snapshot([room], students))
+    assert not report.is_feasible
+    assert report.assignable_count == 2
+    [over_subscription] = report.over_subscriptions
+    assert [p.wants for p in over_subscription.preferences] == [{'lefty'}]
+    assert (over_subscription.student_count, over_subscription.seat_count, over_subscription.shortfall) == (3, 1, 2)
+
+
+def test_union_of_classes_over_subscribed():
+    # each class alone fits, but together 'lefty' and 'aisle' students compete for 3 seats
+    rooms = [make_room(1, [['lefty'], ['lefty', 'aisle'], ['aisle']]), make_room(2, [[]] * 5)]
+    students = [make_student(1, wants=['lefty']), make_student(2, wants=['lefty']),
+                make_student(3, wants=['aisle']), make_student(4, wants=['aisle']), make_student(5)]
+    report = analyze_feasibility(make_exam(rooms, students), make_snapshot(rooms, students))
+    assert not report.is_feasible
+    [over_subscription] = report.over_subscriptions
+    assert {frozenset(p.wants) for p in over_subscription.preferences} == {frozenset({'lefty'}), frozenset({'aisle'})}
+    assert over_subscription.shortfall == 1
+
+
+def test_seeded_exam(seeded_db):
+    report = analyze_feasibility(Exam.query.get(1))
+    assert report.is_feasible
@@ -0,0 +1,79 @@
+from server.models import Room, Seat, SeatAssignment, Student
+from server.services.core.assign import get_preference_from_student, is_seat_valid_for_preference
+from server.services.core.incremental import FreeSeatIndex, assign_students_incrementally
+from server.typings.exception import NotEnoughSeatError
+import pytest
+
+
+def add_late_students(db, exam, count, wants=()):
+    students = [Student(exam_id=exam.id, canvas_id=f'late{i}', email=f'late{i}@berkeley.edu', name=f'Late {i}',
+                        wants=set(wants), avoids=set(), room_wants=set(), room_avoids=set())
+                for i in range(count)]
+    db.session.add_all(students)
+    db.session.commit()
+    return students
+
+
+def save_assignments(db, exam, assignments):
+    db.session.bulk_insert_mappings(SeatAssignment, [
+        {'student_id': student_id, 'seat_id': seat_id, 'exam_id': exam.id} for student_id, seat_id in assignments])
+    db.session.commit()
+
+
+def test_free_seat_index_counts_by_signature(exam169):
+    index = FreeSeatIndex.load(exam169)
+    assert index.counts == {(frozenset({'lefty'}), 1): 3, (frozenset({'righty'}), 1): 3}
+
+
+def test_assign_students_incrementally_keeps_existing_assignments(seeded_db, exam169):
+    assignments = assign_students_incrementally(exam169, seed=1)
+    assert {student_id for student_id, _ in assignments} == {2, 3}
+    for student_id, seat_id in assignments:
+        assert is_seat_valid_for_preference(Seat.query.get(seat_id),
+                                            get_preference_from_student(Student.query.get(student_id)))
+    assert 1 not in {seat_id for _, seat_id in assignments}
+    assert assignments == assign_students_incrementally(exam169, seed=1)
+
+
+def test_assign_students_incrementally_only_given_students(seeded_db, exam169):
+    late = add_late_students(seeded_db, exam169, 2)
+    assignments = assign_students_incrementally(exam169, [s.id for s in late])
+    assert {student_id for student_id, _ in assignments} == {s.id for s in late}
+
+
+def test_assign_students_incrementally_not_enough_seats(seeded_db, exam169):
+    add_late_students(seeded_db, exam169, 3, wants=['lefty'])
+    with pytest.raises(NotEnoughSeatError):
+        assign_students_incrementally(exam169)
+
+
+def test_update_movable_seats_keeps_assigned_seats(seeded_db, exam169):
+    room = Room.query.get(1)
+    save_assignments(seeded_db, exam169, [(2, 7)])
+    room.update_movable_seats([Seat(fixed=False, attributes={'Lefty'}), Seat(fixed=False, attributes={'Aisle'})])
+    seeded_db.session.commit()
+    assert Student.query.get(2).assignment.seat_id == 7
+    assert sorted(sorted(seat.attributes) for seat in room.movable_seats) == [['Aisle'], ['Lefty']]
+    assert len(room.fixed_seats) == 4
+
+
+def test_exam_id_is_copied_to_new_seats_and_assignments(seeded_db, exam169):
+    room = Room(exam_id=exam169.id, name='new', display_name='New')
+    room.seats = [Seat(name='N1', attributes=set()), Seat(name='N2', attributes=set())]
+    seeded_db.session.add(room)
+    student = Student.query.get(2)
+    student.assignment = SeatAssignment(student=student, seat=room.seats[0])
+    seeded_db.session.commit()
+    assert {seat.exam_id for seat in room.seats} == {exam169.id}
+    assert student.assignment.exam_id == exam169.id
+    assert exam169.assignment_count() == 2
+    assert exam169.assignment_count(emailed=True) == 0
+
+
+def test_delete_assignments_of_exam(seeded_db, exam169):
+    save_assignments(seeded_db, exam169, assign_students_incrementally(exam169, seed=1))
+    assert exam169.assignment_count() == 3
+    assert exam169.delete_assignments() == 3
+    seeded_db.session.commit()
+    assert exam169.assignment_count() == 0
+    assert exam169.unassigned_student_count() == 3
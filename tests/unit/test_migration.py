@@ -0,0 +1,153 @@
+"""
+Tests of the backfillnormalized command, on a database created before the normalized tables.
+"""
+from sqlalchemy import select, sql
+
+from server.models import Exam, PreferenceClass, Room, Seat, SeatAssignment, Student, StudentPreference, db, \
+    seat_attributes
+from server.services.core.student import StudentImportConfig, prepare_students
+from server.services.core.upsert import upsert_students
+import pytest
+
+# the tables as they were before the series, without the columns added since
+_BASELINE_TABLES = {
+    'seats': """
+        CREATE TABLE seats (
+            id INTEGER PRIMARY KEY,
+            room_id INTEGER NOT NULL REFERENCES rooms (id) ON DELETE CASCADE,
+            fixed BOOLEAN NOT NULL,
+            name VARCHAR(255),
+            row VARCHAR(255),
+            seat VARCHAR(255),
+            x FLOAT,
+            y FLOAT,
+            attributes TEXT NOT NULL
+        )""",
+    'students': """
+        CREATE TABLE students (
+            id INTEGER PRIMARY KEY,
+            exam_id INTEGER NOT NULL REFERENCES exams (id) ON DELETE CASCADE,
+            canvas_id VARCHAR(255) NOT NULL,
+            email VARCHAR(255) NOT NULL,
+            name VARCHAR(255) NOT NULL,
+            sid VARCHAR(255),
+            wants TEXT NOT NULL,
+            avoids TEXT NOT NULL,
+            room_wants TEXT NOT NULL,
+            room_avoids TEXT NOT NULL
+        )""",
+    'seat_assignments': """
+        CREATE TABLE seat_assignments (
+            student_id INTEGER NOT NULL REFERENCES students (id) ON DELETE CASCADE,
+            seat_id INTEGER NOT NULL REFERENCES seats (id) ON DELETE CASCADE,
+            emailed BOOLEAN NOT NULL,
+            PRIMARY KEY (student_id, seat_id)
+        )""",
+}
+_UNCHANGED_TABLES = ('users', 'offerings', 'exams', 'rooms')
+
+
+@pytest.fixture
+def baseline_db(seeded_db):
+    """
+    The seeded database, rebuilt with the tables as they were before the normalized tables.
+    """
+    with db.engine.begin() as connection:
+        rows = {}
+        for name in _UNCHANGED_TABLES + tuple(_BASELINE_TABLES):
+            rows[name] = [dict(row._mapping) for row in connection.execute(db.metadata.tables[name].select())]
+    db.session.remove()
+    db.drop_all()
+    with db.engine.begin() as connection:
+        for name in _UNCHANGED_TABLES:
+            db.metadata.tables[name].create(connection)
+        for name, ddl in _BASELINE_TABLES.items():
+            connection.exec_driver_sql(ddl)
+        for name in _UNCHANGED_TABLES + tuple(_BASELINE_TABLES):
+            model_table = db.metadata.tables[name]
+            columns = [info['name'] for info in db.inspect(connection).get_columns(name)]
+            # only the baseline columns, with the column types of the models
+            baseline_table = sql.table(name, *[sql.column(column, model_table.c[column].type) for column in columns])
+            if rows[name]:
+                connection.execute(baseline_table.insert(),
+                                   [{column: row[column] for column in columns} for row in rows[name]])
+    yield db
+
+
+def test_backfill_normalized_upgrades_baseline_database(baseline_db, runner):
+    result = runner.invoke(args=['backfillnormalized'])
+    assert result.exit_code == 0, result.output
+    assert 'seats.exam_id' in result.output and 'students.prefers' in result.output
+
+    for seat in Seat.query:
+        assert seat.exam_id == Room.query.get(seat.room_id).exam_id
+        assert {attribute.name for attribute in seat.attribute_refs} == {attr.lower() for attr in seat.attributes}
+    assert db.session.execute(select(seat_attributes)).all()
+    for assignment in SeatAssignment.query:
+        assert assignment.exam_id == Student.query.get(assignment.student_id).exam_id
+
+    for student in Student.query:
+        assert student.prefers == set()
+        links = {(link.kind, link.attribute.name) for link in StudentPreference.query.filter_by(student_id=student.id)}
+        assert links == {(kind, attr.lower()) for kind, attrs in (('want', student.wants), ('avoid', student.avoids))
+                         for attr in attrs}
+        canonical = PreferenceClass.canonical(student.wants, student.avoids, student.room_wants, student.room_avoids,
+                                              student.prefers)
+        assert student.preference_class.key == PreferenceClass.key_for(canonical)
+
+    exam = Exam.query.get(1)
+    lefty_seats = {seat.id for seat in Seat.query.filter(Seat.exam_id == exam.id, Seat.has_attribute('lefty'))}
+    assert lefty_seats == {seat.id for seat in Seat.query if 'lefty' in {attr.lower() for attr in seat.attributes}}
+    assert lefty_seats
+
+    # running it again changes nothing
+    result = runner.invoke(args=['backfillnormalized'])
+    assert result.exit_code == 0, result.output
+    assert 'Added 0 columns.' in result.output
+
+
+def index_names():
+    return set(db.session.execute(sql.text("SELECT name FROM sqlite_master WHERE type = 'index'")).scalars())
+
+
+def test_backfill_normalized_replaces_non_unique_canvas_id_index(baseline_db, runner):
+    # as created by earlier versions, under the name of the unique index of later ones
+    baseline_db.session.execute(sql.text('CREATE INDEX ix_students_exam_id_canvas_id ON students (exam_id, canvas_id)'))
+    baseline_db.session.commit()
+    result = runner.invoke(args=['backfillnormalized'])
+    assert result.exit_code == 0, result.output
+    assert 'uq_students_exam_id_canvas_id' in index_names()
+    assert 'ix_students_exam_id_canvas_id' not in index_names()
+
+    # the upsert of imports needs the unique index as its conflict target
+    exam = Exam.query.get(1)
+    config = StudentImportConfig()
+    new_students, updated_students, _, _ = prepare_students(exam, ['email', 'name', 'canvas id'], [
+        {'email': 'new@berkeley.edu', 'name': 'New', 'canvas id': 'new'},
+        {'email': 'sharon@berkeley.edu', 'name': 'Sharon L', 'canvas id': '345678'},
+    ], config=config)
+    upsert_students(db.session, exam, new_students, updated_students, config=config)
+    db.session.commit()
+    assert Student.query.filter_by(exam_id=exam.id, canvas_id='new').count() == 1
+    assert Student.query.filter_by(exam_id=exam.id, canvas_id='345678').one().name == 'Sharon L'
+
+
+def test_backfill_normalized_reports_duplicate_canvas_ids(baseline_db, runner):
+    baseline_db.session.execute(sql.text(
+        'INSERT INTO students (exam_id, canvas_id, email, name, wants, avoids, room_wants, room_avoids) '
+        "SELECT exam_id, canvas_id, email, name, wants, avoids, room_wants, room_avoids FROM students WHERE id = 1"))
+    baseline_db.session.commit()
+    canvas_id = Student.query.with_entities(Student.canvas_id).filter_by(id=1).scalar()
+    result = runner.invoke(args=['backfillnormalized'])
+    assert result.exit_code != 0
+    assert f'exam 1 canvas id {canvas_id} (2 rows)' in result.output and 'Merge or delete' in result.output
+    # nothing is changed
+    assert 'uq_students_exam_id_canvas_id' not in index_names()
+    assert 'prefers' not in {column['name'] for column in db.inspect(db.engine).get_columns('students')}
+
+    # once the duplicates are resolved, the upgrade goes through
+    baseline_db.session.execute(sql.text("DELETE FROM students WHERE id = (SELECT max(id) FROM students)"))
+    baseline_db.session.commit()
+    result = runner.invoke(args=['backfillnormalized'])
+    assert result.exit_code == 0, result.output
+    assert 'uq_students_exam_id_canvas_id' in index_names()
@@ -0,0 +1,111 @@
+"""
+Query plan regression tests: the hot queries of the app are run through EXPLAIN,
+and fail if the database would answer them with a full scan of a table that should be reached by index.
+
+SQLite plans are always checked, on the seeded test database.
+PostgreSQL plans are checked too when TEST_POSTGRES_URL points to a scratch database;
+sequential scans are disabled there, since on tiny tables they would otherwise always win.
+"""
+import json
+import os
+
+from sqlalchemy import create_engine
+
+from server.models import STUDENT_SORT_KEYS, Room, Seat, Student, db
+from server.services.core.search import prefix_filter
+import pytest
+
+
+def hot_queries(exam):
+    """
+    The hot access paths, with the tables each must reach through an index.
+    """
+    return {
+        'student by canvas id': (Student.query.filter_by(exam_id=exam.id, canvas_id='1'), {'students'}),
+        'seat by room and name': (Seat.query.filter_by(room_id=1, name='A1'), {'seats'}),
+        'room of exam': (Room.query.filter_by(exam_id=exam.id, id=1), {'rooms'}),
+        'unemailed assignments': (exam.assignments_query(emailed=False), {'seat_assignments'}),
+        'assignment count': (exam.assignments_query().with_entities(db.func.count()), {'seat_assignments'}),
+        'unassigned seats': (exam.unassigned_seats_query(), {'seats', 'seat_assignments'}),
+        'unassigned students': (exam.unassigned_students_query(), {'students', 'seat_assignments'}),
+        'wanted seats': (exam.unassigned_seats_query(attributes=['lefty']), {'seats', 'seat_assignments'}),
+        'student page': (Student.query.filter(Student.exam_id == exam.id).order_by(STUDENT_SORT_KEYS['email'], Student.id)
+                         .limit(100), {'students'}),
+        'student prefix search': (Student.query.filter(Student.exam_id == exam.id, prefix_filter('lav')), {'students'}),
+    }
+
+
+HOT_QUERY_NAMES = ['student by canvas id', 'seat by room and name', 'room of exam', 'unemailed assignments',
+                   'assignment count', 'unassigned seats', 'unassigned students', 'wanted seats', 'student page',
+                   'student prefix search']
+
+
+def compile_query(query, dialect):
+    return str(query.statement.compile(dialect=dialect, compile_kwargs={'literal_binds': True}))
+
+
+def sqlite_full_scans(connection, query):
+    """
+    Return the tables that SQLite would scan in full to answer the query.
+    """
+    rows = connection.exec_driver_sql('EXPLAIN QUERY PLAN ' + compile_query(query, connection.dialect))
+    scanned = set()
+    for *_, detail in rows:
+        words = detail.split()
+        # "SCAN t [USING ... INDEX i]" reads every row of t or of its index; "SEARCH t USING ..." does not
+        if words[0] == 'SCAN':
+            scanned.add(words[1])
+    return scanned
+
+
+def postgres_full_scans(connection, query):
+    """
+    Return the tables that PostgreSQL would scan sequentially to answer the query.
+    """
+    plan = connection.exec_driver_sql('EXPLAIN (FORMAT JSON) ' + compile_query(query, connection.dialect)).scalar()
+    if isinstance(plan, str):
+        plan = json.loads(plan)
+    scanned, nodes = set(), [plan[0]['Plan']]
+    while nodes:
+        node = nodes.pop()
+        if node['Node Type'] == 'Seq Scan':
+            scanned.add(node['Relation Name'])
+        nodes.extend(node.get('Plans', ()))
+    return scanned
+
+
+def test_composite_indexes_exist():
+    indexes = {index.name: [column.name for column in index.columns]
+               for table in db.metadata.tables.values() for index in table.indexes}
+    assert indexes['uq_students_exam_id_canvas_id'] == ['exam_id', 'canvas_id']
+    assert indexes['ix_seats_room_id_name'] == ['room_id', 'name']
+    assert indexes['ix_rooms_exam_id_id'] == ['exam_id', 'id']
+    assert indexes['ix_seat_assignments_exam_id_emailed'] == ['exam_id', 'emailed']
+
+
+@pytest.mark.parametrize('name', HOT_QUERY_NAMES)
+def test_sqlite_hot_query_uses_index(seeded_db, exam169, name):
+    query, indexed_tables = hot_queries(exam169)[name]
+    with seeded_db.engine.connect() as connection:
+        assert not sqlite_full_scans(connection, query) & indexed_tables
+
+
+def test_sqlite_full_scan_is_detected(seeded_db):
+    with seeded_db.engine.connect() as connection:
+        assert sqlite_full_scans(connection, Student.query.filter_by(name='Nobody')) == {'students'}
+
+
+@pytest.mark.skipif(not os.environ.get('TEST_POSTGRES_URL'), reason='TEST_POSTGRES_URL is not set')
+def test_postgres_hot_queries_use_indexes(seeded_db, exam169):
+    engine = create_engine(os.environ['TEST_POSTGRES_URL'])
+    db.metadata.drop_all(engine)
+    db.metadata.create_all(engine)
+    try:
+        with engine.connect() as connection:
+            connection.exec_driver_sql('SET enable_seqscan = off')
+            regressions = {name: postgres_full_scans(connection, query) & indexed_tables
+                           for name, (query, indexed_tables) in hot_queries(exam169).items()}
+        assert not any(regressions.values()), regressions
+    finally:
+        db.metadata.drop_all(engine)
+        engine.dispose()
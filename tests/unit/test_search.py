@@ -0,0 +1,90 @@
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.schema import CreateIndex
+
+from server.models import STUDENT_SORT_KEYS, Student
+from server.services.core.search import prefix_filter, search_students, typeahead_students
+from server.typings.exception import DataValidationError
+import pytest
+
+
+def add_students(db, exam, count):
+    db.session.add_all([Student(exam_id=exam.id, canvas_id=f'9{i:03}', email=f'S{i}@berkeley.edu', name=f'Student {i % 7}',
+                                sid=None if i % 3 else f'30{i:03}', wants=set(), avoids=set(), room_wants=set(),
+                                room_avoids=set())
+                        for i in range(count)])
+    db.session.commit()
+
+
+def all_pages(exam, **kwargs):
+    students, cursor = [], None
+    while True:
+        page, cursor, total = search_students(exam, after=cursor, limit=4, **kwargs)
+        students.extend(page)
+        if cursor is None:
+            return students, total
+
+
+@pytest.mark.parametrize('sort', ['name', 'email', 'sid', 'canvas_id'])
+@pytest.mark.parametrize('descending', [False, True])
+def test_search_students_pages_cover_every_student_once(seeded_db, exam169, sort, descending):
+    add_students(seeded_db, exam169, 20)
+    students, total = all_pages(exam169, sort=sort, descending=descending)
+    assert total == 23
+    assert sorted(s.id for s in students) == sorted(s.id for s in exam169.students)
+    keys = [((getattr(s, sort) or '').lower(), s.id) for s in students]
+    assert keys == sorted(keys, reverse=descending)
+
+
+def test_search_students_by_prefix(seeded_db, exam169):
+    add_students(seeded_db, exam169, 20)
+    assert {s.name for s in all_pages(exam169, prefix='student 3')[0]} == {'Student 3'}
+    emails = {s.email for s in all_pages(exam169, prefix='s1')[0]}
+    assert emails == {'S1@berkeley.edu'} | {f'S{i}@berkeley.edu' for i in range(10, 20)}
+    assert [s.canvas_id for s in all_pages(exam169, prefix='9019')[0]] == ['9019']
+    assert [s.sid for s in all_pages(exam169, prefix='30018')[0]] == ['30018']
+    assert all_pages(exam169, prefix='nobody') == ([], 0)
+
+
+def test_search_students_by_prefix_in_code_point_order(seeded_db, exam169):
+    names = ['ab-c', 'ab c', 'Abz', 'ab\U0001f600', 'Ábc', 'a-b', 'ac']
+    seeded_db.session.add_all([Student(exam_id=exam169.id, canvas_id=f'8{i}', email=f'x{i}@berkeley.edu', name=name,
+                                       wants=set(), avoids=set(), room_wants=set(), room_avoids=set())
+                               for i, name in enumerate(names)])
+    seeded_db.session.commit()
+    assert {s.name for s in all_pages(exam169, prefix='ab')[0]} == {'ab-c', 'ab c', 'Abz', 'ab\U0001f600'}
+
+    # PostgreSQL compares in the collation of the database otherwise, where the prefix ranges are not exact
+    keys = len(STUDENT_SORT_KEYS)
+    assert str(prefix_filter('ab').compile(dialect=postgresql.dialect())).count(' COLLATE "C" ') == 2 * keys
+    indexes = [str(CreateIndex(index).compile(dialect=postgresql.dialect())) for index in Student.__table__.indexes]
+    # the canvas id one is not a model index, see _POSTGRES_STUDENT_SORT_DDL
+    assert sum('COLLATE "C"' in index for index in indexes) == keys - 1
+
+
+def test_search_students_rejects_bad_parameters(seeded_db, exam169):
+    with pytest.raises(DataValidationError):
+        search_students(exam169, sort='wants')
+    with pytest.raises(DataValidationError):
+        search_students(exam169, limit=0)
+    with pytest.raises(DataValidationError):
+        search_students(exam169, after='not a cursor')
+
+
+def test_typeahead_students_matches_substrings(seeded_db, exam169):
+    add_students(seeded_db, exam169, 20)
+    assert [s.name for s in typeahead_students(exam169, 'vender')] == ['Lavender Angela']
+    assert [s.canvas_id for s in typeahead_students(exam169, '019')] == ['9019']
+    assert {s.name for s in typeahead_students(exam169, 'ent 4', limit=50)} == {'Student 4'}
+    assert [s.name for s in typeahead_students(exam169, 'sh')] == ['Sharon Lovera']
+    assert typeahead_students(exam169, 'nobody') == []
+
+
+def test_typeahead_students_follows_updates(seeded_db, exam169):
+    student = Student.query.get(2)
+    student.name = 'Renamed Person'
+    seeded_db.session.commit()
+    assert [s.id for s in typeahead_students(exam169, 'renamed')] == [2]
+    assert typeahead_students(exam169, 'lovera') == []
+    seeded_db.session.delete(student)
+    seeded_db.session.commit()
+    assert typeahead_students(exam169, 'renamed') == []
@@ -0,0 +1,154 @@
+"""
+Tests of the COPY staging import.
+
+On SQLite, import_students_with_staging falls back to prepare_students, which is always tested.
+When TEST_POSTGRES_URL points to a scratch PostgreSQL database, the seeded database is copied there,
+and the staging import is checked to leave it as the Python import leaves the SQLite one.
+"""
+import os
+
+from sqlalchemy import Integer, create_engine
+from sqlalchemy.orm import Session
+
+from server.models import Exam, PreferenceClass, Seat, Student, db
+from server.services.core.staging import ImportedStudent, import_students_with_staging
+from server.services.core.student import StudentImportConfig
+from server.typings.enum import AssignmentImportStrategy, MissingRowImportStrategy, NewRowImportStrategy, \
+    UpdatedRowImportStrategy
+import pytest
+
+
+HEADERS = ['canvas id', 'email', 'name', 'student id', 'emailed', 'seat id', 'room name', 'seat name', 'lefty', 'righty']
+
+
+def import_rows(exam):
+    room_name = exam.rooms[0].name_and_start_at_time_display()
+    return [
+        {'canvas id': 'n1', 'email': 'n1@berkeley.edu', 'name': 'New 1', 'seat id': '4', 'emailed': 'true',
+         'righty': 'true'},
+        # the lefty seat of Jimmy Xu no longer fits, and seat 2 is taken before the next row asks for it
+        {'canvas id': '234567', 'email': 'jx@berkeley.edu', 'name': 'Jimmy Xu', 'seat id': '2', 'lefty': 'false'},
+        # a blank name is kept from the existing student only when student info is merged
+        {'canvas id': '345678', 'email': 'sharon@berkeley.edu', 'name': '', 'righty': 'prefer'},
+        {'canvas id': 'n2', 'email': 'n2@berkeley.edu', 'name': 'New 2', 'room name': room_name, 'seat name': 'A2'},
+        {'canvas id': 'n3', 'email': 'n3@berkeley.edu', 'name': 'New 3', 'room name': room_name,
+         'seat name': 'Movable Seat (righty)', 'righty': 'true'},
+        {'canvas id': '', 'email': 'nobody@berkeley.edu', 'name': 'No Canvas Id'},
+        # merged with the existing preferences of Lavender Angela, which keep their case
+        {'canvas id': '456789', 'email': 'angelaz8@berkeley.edu', 'name': 'Lavender Angela', 'lefty': 'true'},
+    ]
+
+
+CONFIGS = {
+    'default': StudentImportConfig(),
+    'merge and delete missing': StudentImportConfig(
+        updated_student_info_import_strategy=UpdatedRowImportStrategy.MERGE,
+        updated_preference_import_strategy=UpdatedRowImportStrategy.MERGE,
+        missing_student_import_strategy=MissingRowImportStrategy.DELETE),
+    'force, keep preferences, no new rows': StudentImportConfig(
+        assignment_import_strategy=AssignmentImportStrategy.FORCE,
+        updated_preference_import_strategy=UpdatedRowImportStrategy.IGNORE,
+        new_student_import_strategy=NewRowImportStrategy.IGNORE),
+    'no assignments': StudentImportConfig(revalidate_existing_assignments=False,
+                                          assignment_import_strategy=AssignmentImportStrategy.IGNORE),
+}
+
+
+def exam_state(session, exam_id):
+    """
+    Every student of the exam, with their constraints (lower-cased), links, preference class and seat.
+    """
+    def lower(values):
+        return tuple(sorted(value.lower() for value in values or ()))
+    state = {}
+    for student in session.query(Student).filter(Student.exam_id == exam_id):
+        canonical = PreferenceClass.canonical(student.wants, student.avoids, student.room_wants, student.room_avoids,
+                                              student.prefers)
+        assert student.preference_class.key == PreferenceClass.key_for(canonical)
+        assignment = student.assignment
+        state[student.canvas_id] = (
+            student.name, student.email, student.sid, canonical,
+            sorted((link.kind, link.attribute.name) for link in student.preference_links),
+            (assignment.seat_id, assignment.emailed, assignment.exam_id) if assignment else None,
+            lower(student.wants))
+    return state
+
+
+def sorted_report(report):
+    new_students, updated_students, invalid_rows, removed_ids = report
+    return sorted(new_students), sorted(updated_students), invalid_rows, sorted(removed_ids)
+
+
+def test_staging_import_falls_back_to_python_import(seeded_db, exam169):
+    new_students, updated_students, invalid_rows, removed_ids = import_students_with_staging(
+        seeded_db.session, exam169, HEADERS, iter(import_rows(exam169)))
+    assert sorted(new_students) == [ImportedStudent('n1', 'New 1'), ImportedStudent('n2', 'New 2'),
+                                    ImportedStudent('n3', 'New 3')]
+    assert [student.canvas_id for student in updated_students] == ['234567', '345678', '456789']
+    assert [row['name'] for row in invalid_rows] == ['No Canvas Id'] and removed_ids == []
+    state = exam_state(seeded_db.session, exam169.id)
+    assert state['n1'][5] == (4, True, exam169.id)
+    assert state['234567'][5] == (2, False, exam169.id)
+    assert state['n2'][5] is None
+    assert state['n3'][5] == (6, False, exam169.id)
+
+
+@pytest.fixture
+def postgres_session(seeded_db):
+    """
+    A session on a copy of the seeded database in the PostgreSQL database at TEST_POSTGRES_URL.
+    """
+    engine = create_engine(os.environ['TEST_POSTGRES_URL'])
+    db.metadata.drop_all(engine)
+    db.metadata.create_all(engine)
+    with seeded_db.engine.connect() as source, engine.begin() as target:
+        for table in db.metadata.sorted_tables:
+            rows = [dict(row._mapping) for row in source.execute(table.select())]
+            if rows:
+                target.execute(table.insert(), rows)
+            if 'id' in table.c and table.c.id.primary_key and isinstance(table.c.id.type, Integer):
+                target.exec_driver_sql(f"SELECT setval(pg_get_serial_sequence('{table.name}', 'id'), "
+                                       f"coalesce(max(id), 0) + 1, false) FROM {table.name}")
+    session = Session(engine)
+    try:
+        yield session
+    finally:
+        session.close()
+        db.metadata.drop_all(engine)
+        engine.dispose()
+
+
+@pytest.mark.skipif(not os.environ.get('TEST_POSTGRES_URL'), reason='TEST_POSTGRES_URL is not set')
+@pytest.mark.parametrize('config_name', list(CONFIGS))
+def test_postgres_staging_import_matches_python_import(seeded_db, exam169, postgres_session, config_name):
+    config = CONFIGS[config_name]
+    postgres_exam = postgres_session.get(Exam, exam169.id)
+    staged = import_students_with_staging(postgres_session, postgres_exam, HEADERS, iter(import_rows(postgres_exam)),
+                                          config=config)
+    expected = import_students_with_staging(seeded_db.session, exam169, HEADERS, iter(import_rows(exam169)),
+                                            config=config)
+    assert sorted_report(staged) == sorted_report(expected)
+    assert exam_state(postgres_session, exam169.id) == exam_state(seeded_db.session, exam169.id)
+
+
+@pytest.mark.skipif(not os.environ.get('TEST_POSTGRES_URL'), reason='TEST_POSTGRES_URL is not set')
+def test_postgres_staging_import_falls_back_to_the_next_named_seat(seeded_db, exam169, postgres_session):
+    room_name = exam169.rooms[0].name_and_start_at_time_display()
+    rows = [
+        {'canvas id': 'x1', 'email': 'x1@berkeley.edu', 'name': 'X 1', 'seat id': '100'},
+        # both seats are named B9: seat 100 is taken, so this row gets seat 101
+        {'canvas id': 'x2', 'email': 'x2@berkeley.edu', 'name': 'X 2', 'room name': room_name, 'seat name': 'B9'},
+        # and this one gets no seat, although it was the only row to ask for seat 101 first
+        {'canvas id': 'x3', 'email': 'x3@berkeley.edu', 'name': 'X 3', 'seat id': '101'},
+    ]
+    for session in (seeded_db.session, postgres_session):
+        session.add_all([Seat(id=seat_id, exam_id=exam169.id, room_id=exam169.rooms[0].id, name='B9', row='B',
+                              seat='9', attributes=set(), fixed=True) for seat_id in (100, 101)])
+        session.commit()
+    postgres_exam = postgres_session.get(Exam, exam169.id)
+    import_students_with_staging(postgres_session, postgres_exam, HEADERS, iter(rows))
+    import_students_with_staging(seeded_db.session, exam169, HEADERS, iter(rows))
+    state = exam_state(postgres_session, exam169.id)
+    assert [state[canvas_id][5] for canvas_id in ('x1', 'x2', 'x3')] == \
+        [(100, False, exam169.id), (101, False, exam169.id), None]
+    assert state == exam_state(seeded_db.session, exam169.id)
@@ -2,7 +2,9 @@ from random import seed
 from requests import head
 from server.models import Seat, SeatAssignment, User, Offering, Exam, Room, Student
 from server.services.core.data import prepare_students
-from server.services.core.student import StudentImportConfig, room_id_to_attr
+from server.services.core.student import ExamImportIndex, StudentHeaderSchema, StudentImportConfig, \
+    import_students_in_chunks, room_id_to_attr
+from server.services.csv import iter_csv
 from server.typings.enum import AssignmentImportStrategy, MissingRowImportStrategy, NewRowImportStrategy, \
     UpdatedRowImportStrategy
 from server.typings.exception import DataValidationError
@@ -149,6 +151,41 @@ def test_update_student_preference_default_config(exam169):
     assert updated_students[0].avoids == {'new_avoid_attr'}
 
 
+def test_update_student_soft_preference_default_config(exam169):
+    headers = ['email', 'name', 'canvas id', 'New_Prefer_Attr', 'New_Avoid_Attr']
+    first_student_canvas_id = exam169.students[0].canvas_id
+    updated_student = {
+        'canvas id': first_student_canvas_id,
+        'New_Prefer_Attr': 'Prefer',
+        'New_Avoid_Attr': 'false'
+    }
+    rows = [updated_student]
+    new_students, updated_students, invalid_students, students_ids_to_remove = \
+        prepare_students(exam169, headers, rows)
+    assert len(updated_students) == 1
+    assert len(invalid_students) == 0
+    assert updated_students[0].prefers == {'new_prefer_attr'}
+    assert updated_students[0].wants == set()
+    assert updated_students[0].avoids == {'new_avoid_attr'}
+
+
+def test_update_student_soft_preference_merge_conflict(seeded_db, exam169):
+    headers = ['email', 'name', 'canvas id', 'old_avoid_attr']
+    first_student = exam169.students[0]
+    first_student.avoids = {'old_avoid_attr'}
+    seeded_db.session.commit()
+    updated_student = {
+        'canvas id': first_student.canvas_id,
+        'old_avoid_attr': 'prefer',
+    }
+    rows = [updated_student]
+    new_students, updated_students, invalid_students, students_ids_to_remove = \
+        prepare_students(exam169, headers, rows,
+                         config=StudentImportConfig(updated_preference_import_strategy=UpdatedRowImportStrategy.MERGE))
+    assert len(updated_students) == 0
+    assert len(invalid_students) == 1
+
+
 def test_update_student_preference_with_room_default_config(exam169):
     headers = ['email', 'name', 'canvas id', 'Room:1']
     first_student_canvas_id = exam169.students[0].canvas_id
@@ -583,3 +620,108 @@ def test_no_revalidate_existing_assignments_while_giving_conflicting_prefs(seede
     assert len(students_ids_to_remove) == 0
     assert updated_students[0].room_avoids == {str(first_seat.room.id)}
     assert updated_students[0].assignment.seat.id == first_seat.id
+
+
+def test_import_queries_do_not_grow_with_rows(seeded_db, exam169):
+    from sqlalchemy import event
+    room = exam169.rooms[0]
+    seats = sorted((seat for seat in room.seats if not seat.assignment), key=lambda seat: seat.id)
+    headers = ['email', 'name', 'canvas id', 'room name', 'seat name', 'seat id']
+    rows = [{'email': f'new{i}@example.com', 'name': f'New {i}', 'canvas id': f'new{i}',
+             'room name': room.name_and_start_at_time_display(), 'seat name': seats[i].name} for i in range(2)]
+    rows += [{'email': s.email, 'name': s.name, 'canvas id': s.canvas_id, 'seat id': str(seats[2 + i].id)}
+             for i, s in enumerate(exam169.students[1:])]
+    seeded_db.session.expire_all()
+    statements = []
+
+    def count(*args):
+        statements.append(args)
+    event.listen(seeded_db.engine, 'before_cursor_execute', count)
+    try:
+        new_students, updated_students, invalid_students, _ = \
+            prepare_students(exam169, headers, rows,
+                             config=StudentImportConfig(assignment_import_strategy=AssignmentImportStrategy.FORCE))
+    finally:
+        event.remove(seeded_db.engine, 'before_cursor_execute', count)
+    assert len(new_students) == 2 and len(updated_students) == 2 and not invalid_students
+    assert [s.assignment.seat.id for s in new_students + updated_students] == [seat.id for seat in seats[:4]]
+    assert len(statements) <= 6
+
+
+def test_student_header_schema_classifies_columns_once():
+    schemas = {}
+    rows = [{'canvas id': str(i), 'email': 'a@b.c', 'Lefty': 'TRUE', 'aisle': 'prefer', 'room:3': 'false'}
+            for i in range(3)]
+    for row in rows:
+        schema = StudentHeaderSchema.for_row(schemas, row)
+        values = schema.values(row)
+        assert values[schema.canvas_id] == row['canvas id']
+        assert values[schema.name] is None
+        assert schema.preferences(values) == ({'lefty'}, set(), {'aisle'}, set(), {'3'})
+    assert len(schemas) == 1
+    assert schema.rooms == [(4, '3')]
+
+
+def test_iter_csv_decodes_rows_lazily():
+    import io
+    headers, rows = iter_csv(io.BytesIO('Canvas ID,Email,Name\n1,a@b.c,Zoë\n2,d@e.f,Ann\n'.encode('utf-8')))
+    assert headers == ['canvas id', 'email', 'name']
+    assert next(rows) == {'canvas id': '1', 'email': 'a@b.c', 'name': 'Zoë'}
+    assert [row['name'] for row in rows] == ['Ann']
+
+
+def test_import_students_in_chunks(seeded_db, exam169):
+    seat = exam169.unassigned_seats[0]
+    headers = ['email', 'name', 'canvas id', 'seat id']
+    kept = exam169.students[1]
+    rows = [{'email': f'new{i}@example.com', 'name': f'New {i}', 'canvas id': f'new{i}'} for i in range(5)]
+    rows += [{'email': kept.email, 'name': 'Renamed', 'canvas id': kept.canvas_id, 'seat id': str(seat.id)},
+             {'email': 'x@example.com', 'name': 'No Canvas Id', 'canvas id': ''}]
+    kept_id, kept_canvas_id, seat_id = kept.id, kept.canvas_id, seat.id
+    report = import_students_in_chunks(seeded_db.session, exam169, headers, iter(rows), chunk_size=2,
+                                       config=StudentImportConfig(
+                                           missing_student_import_strategy=MissingRowImportStrategy.DELETE))
+    assert (report.new, report.updated, report.invalid, report.removed) == (5, 1, 1, 2)
+    assert report.updated_names == ['Renamed']
+    assert report.invalid_rows == [rows[-1]]
+    # the students of every chunk were released
+    assert not [instance for instance in seeded_db.session if isinstance(instance, (Student, SeatAssignment))]
+    students = Student.query.filter_by(exam_id=exam169.id).all()
+    assert sorted(s.canvas_id for s in students) == sorted([f'new{i}' for i in range(5)] + [kept_canvas_id])
+    renamed = Student.query.get(kept_id)
+    assert renamed.name == 'Renamed'
+    assert renamed.assignment.seat_id == seat_id
+
+
+def test_import_students_in_chunks_loads_seats_once(seeded_db, exam169, monkeypatch):
+    seat = exam169.unassigned_seats[0]
+    moved = exam169.students[0]
+    freed = moved.assignment.seat
+    headers = ['email', 'name', 'canvas id', 'seat id']
+    # the first chunk frees a seat that the last chunk assigns again
+    rows = [{'email': moved.email, 'name': moved.name, 'canvas id': moved.canvas_id, 'seat id': str(seat.id)}]
+    rows += [{'email': f'new{i}@example.com', 'name': f'New {i}', 'canvas id': f'new{i}'} for i in range(3)]
+    rows.append({'email': 'last@example.com', 'name': 'Last', 'canvas id': 'last', 'seat id': str(freed.id)})
+    moved_id, seat_id, freed_id = moved.id, seat.id, freed.id
+    loads = []
+    load_seats = ExamImportIndex.load_seats
+    monkeypatch.setattr(ExamImportIndex, 'load_seats',
+                        lambda self, exam: loads.append(exam) or load_seats(self, exam))
+    report = import_students_in_chunks(
+        seeded_db.session, exam169, headers, iter(rows), chunk_size=1,
+        config=StudentImportConfig(assignment_import_strategy=AssignmentImportStrategy.FORCE))
+    assert (report.new, report.updated, report.invalid) == (4, 1, 0)
+    assert loads == [exam169]
+    assert Student.query.get(moved_id).assignment.seat_id == seat_id
+    assert Student.query.filter_by(canvas_id='last').one().assignment.seat_id == freed_id
+    assert SeatAssignment.query.count() == 2
+
+
+def test_import_students_in_chunks_is_all_or_nothing(seeded_db, exam169):
+    headers = ['email', 'name', 'canvas id', 'seat id']
+    rows = [{'email': f'new{i}@example.com', 'name': f'New {i}', 'canvas id': f'new{i}'} for i in range(3)]
+    rows.append({'email': 'bad@example.com', 'name': 'Bad Seat', 'canvas id': 'bad', 'seat id': 'not a number'})
+    with pytest.raises(ValueError):
+        import_students_in_chunks(seeded_db.session, exam169, headers, iter(rows), chunk_size=2)
+    seeded_db.session.rollback()
+    assert Student.query.filter(Student.canvas_id.like('new%')).count() == 0
@@ -0,0 +1,90 @@
+import io
+
+from flask import url_for
+
+from server.models import Student
+import pytest
+
+
+def exam_url(app, endpoint, exam, **kwargs):
+    with app.test_request_context():
+        return url_for(endpoint, exam=exam, **kwargs)
+
+
+def test_manual_import_applies_form_strategies(app, staff_client, exam169):
+    response = staff_client.post(exam_url(app, 'import_students_from_manual_input', exam169), data={
+        'text': 'canvas id,email,name,lefty\n345678,,Sharon L,false\n999999,new@berkeley.edu,New Student,true',
+        'revalidate_existing_assignments': 'y',
+        'assignment_import_strategy': 'revalidate',
+        'updated_student_info_import_strategy': 'merge',
+        'updated_preference_import_strategy': 'ignore',
+        'new_student_import_strategy': 'ignore',
+        'missing_student_import_strategy': 'delete',
+    })
+    assert response.status_code == 302
+    # the new row is ignored, the preferences are kept, and the students missing from the input are deleted
+    students = Student.query.filter_by(exam_id=exam169.id).all()
+    assert [(s.canvas_id, s.name, s.email, s.wants) for s in students] == \
+        [('345678', 'Sharon L', 'sharon@berkeley.edu', {'Lefty'})]
+
+
+@pytest.mark.parametrize('backend, in_chunks', [('orm', False), ('orm', True), ('staging', False)])
+def test_csv_import_reports_every_backend(app, staff_client, exam169, monkeypatch, backend, in_chunks):
+    monkeypatch.setitem(app.config, 'STUDENT_IMPORT_BACKEND', backend)
+    monkeypatch.setitem(app.config, 'STUDENT_IMPORT_CHUNK_SIZE', 1)
+    csv = b'canvas id,email,name\n345678,sharon@berkeley.edu,Sharon L\n999999,new@berkeley.edu,New Student\n,,\n'
+    data = {'file': (io.BytesIO(csv), 'students.csv'), 'revalidate_existing_assignments': 'y',
+            'assignment_import_strategy': 'revalidate', 'updated_student_info_import_strategy': 'merge',
+            'updated_preference_import_strategy': 'overwrite', 'new_student_import_strategy': 'append',
+            'missing_student_import_strategy': 'ignore'}
+    if in_chunks:
+        data['import_in_chunks'] = 'y'
+    response = staff_client.post(exam_url(app, 'import_students_from_csv_upload', exam169), data=data,
+                                 content_type='multipart/form-data', follow_redirects=True)
+    assert b'1 new students, 1 updated students 1 invalid students. 0 students removed.' in response.data
+    assert Student.query.filter_by(exam_id=exam169.id, canvas_id='999999').one().name == 'New Student'
+    assert Student.query.get(2).name == 'Sharon L'
+
+
+def test_bulk_edit_syncs_links_in_constant_queries(app, staff_client, seeded_db, exam169):
+    from sqlalchemy import event
+    url = exam_url(app, 'edit_students', exam169)
+
+    def edit_statements(count):
+        students = [Student(exam_id=exam169.id, canvas_id=f'e{count}-{i}', email=f'e{count}-{i}@berkeley.edu',
+                            name=f'E {i}', wants={'lefty'}, avoids=set(), room_wants=set(), room_avoids=set())
+                    for i in range(count)]
+        seeded_db.session.add_all(students)
+        seeded_db.session.commit()
+        emails = [student.email for student in students]
+        seeded_db.session.expire_all()
+        statements = []
+
+        def record(*args):
+            statements.append(args)
+        event.listen(seeded_db.engine, 'before_cursor_execute', record)
+        try:
+            response = staff_client.post(url, data={
+                'emails': ','.join(emails), 'wants': 'righty', 'avoids': '', 'submit': 'make edits'})
+        finally:
+            event.remove(seeded_db.engine, 'before_cursor_execute', record)
+        assert response.status_code == 200
+        students = Student.query.filter(Student.email.in_(emails)).all()
+        assert all({(link.kind, link.attribute.name) for link in student.preference_links} == {('want', 'righty')}
+                   for student in students)
+        return len(statements)
+    # the first edit also creates the preference class
+    edit_statements(1)
+    assert edit_statements(20) == edit_statements(3)
+
+
+def test_students_page_search_suggests_typeahead_matches(app, staff_client, exam169):
+    typeahead_url = exam_url(app, 'students_typeahead', exam169)
+    page = staff_client.get(exam_url(app, 'students', exam169)).get_data(as_text=True)
+    assert f'data-typeahead-url="{typeahead_url}"' in page
+    response = staff_client.get(typeahead_url, query_string={'q': 'vender'})
+    student = Student.query.filter_by(exam_id=exam169.id, canvas_id='456789').one()
+    with app.test_request_context():
+        student_url = url_for('student', exam_student=(exam169, student))
+    assert [(s['name'], s['urls']['student']) for s in response.get_json()['students']] == \
+        [('Lavender Angela', student_url)]
@@ -0,0 +1,136 @@
+from sqlalchemy import event
+
+from server.models import Exam, PreferenceClass, SeatAssignment, Student, StudentPreference
+from server.services.core import upsert
+from server.services.core.student import StudentImportConfig, prepare_students
+from server.services.core.upsert import upsert_students
+from server.typings.enum import UpdatedRowImportStrategy
+
+
+HEADERS = ['email', 'name', 'canvas id', 'seat id', 'lefty', 'righty']
+
+
+def import_rows(db, exam, rows, config=StudentImportConfig()):
+    new_students, updated_students, invalid_students, _ = prepare_students(exam, HEADERS, rows, config=config)
+    assert not invalid_students
+    upsert_students(db.session, exam, new_students, updated_students, config=config)
+    db.session.commit()
+    db.session.expire_all()
+
+
+def links_of(student):
+    return {(link.kind, link.attribute.name) for link in StudentPreference.query.filter_by(student_id=student.id)}
+
+
+def test_upsert_students_writes_new_and_updated_students(seeded_db, exam169):
+    import_rows(seeded_db, exam169, [
+        {'email': 'new@berkeley.edu', 'name': 'New Student', 'canvas id': 'new', 'seat id': '4', 'righty': 'true'},
+        {'email': 'jx@berkeley.edu', 'name': 'Jimmy Xu', 'canvas id': '234567', 'seat id': '2', 'lefty': 'false'},
+        {'email': 'sharon@berkeley.edu', 'name': 'Sharon L', 'canvas id': '345678', 'lefty': 'true'},
+    ])
+    new = Student.query.filter_by(exam_id=exam169.id, canvas_id='new').one()
+    assert new.wants == {'righty'} and new.assignment.seat_id == 4 and new.assignment.exam_id == exam169.id
+    assert links_of(new) == {('want', 'righty')}
+    assert new.preference_class.key == PreferenceClass.key_for(PreferenceClass.canonical({'righty'}, (), (), (), ()))
+    jimmy = Student.query.get(1)
+    # the lefty seat no longer fits, so the assignment is replaced by the imported one
+    assert jimmy.avoids == {'lefty'} and jimmy.assignment.seat_id == 2
+    assert links_of(jimmy) == {('avoid', 'lefty')}
+    assert Student.query.get(2).name == 'Sharon L'
+    assert Student.query.filter_by(exam_id=exam169.id).count() == 4
+
+
+def test_upsert_students_statements_do_not_grow_with_rows(seeded_db, exam169):
+    rows = [{'email': f'n{i}@berkeley.edu', 'name': f'N {i}', 'canvas id': f'n{i}', 'lefty': 'true' if i % 2 else ''}
+            for i in range(300)]
+    config = StudentImportConfig()
+    new_students, updated_students, _, _ = prepare_students(exam169, HEADERS, rows, config=config)
+    statements = []
+
+    def count(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+    event.listen(seeded_db.engine, 'before_cursor_execute', count)
+    try:
+        upsert_students(seeded_db.session, exam169, new_students, updated_students, config=config)
+        seeded_db.session.commit()
+    finally:
+        event.remove(seeded_db.engine, 'before_cursor_execute', count)
+    assert Student.query.filter_by(exam_id=exam169.id).count() == 303
+    assert len(statements) <= 10
+
+
+def test_upsert_students_keeps_ignored_columns_on_conflict(seeded_db, exam169):
+    config = StudentImportConfig(updated_student_info_import_strategy=UpdatedRowImportStrategy.IGNORE)
+    new_students, _, _, _ = prepare_students(exam169, HEADERS, [
+        {'email': 'late@berkeley.edu', 'name': 'Late', 'canvas id': 'late', 'righty': 'true'}])
+    # the same canvas id is imported by someone else in the meantime
+    seeded_db.session.execute(Student.__table__.insert(), {
+        'exam_id': exam169.id, 'canvas_id': 'late', 'email': 'first@berkeley.edu', 'name': 'First',
+        'wants': set(), 'avoids': set(), 'room_wants': set(), 'room_avoids': set(), 'prefers': set()})
+    seeded_db.session.commit()
+    upsert_students(seeded_db.session, exam169, new_students, [], config=config)
+    seeded_db.session.commit()
+    student = Student.query.filter_by(exam_id=exam169.id, canvas_id='late').one()
+    assert (student.name, student.email, student.wants) == ('First', 'first@berkeley.edu', {'righty'})
+
+
+def test_upsert_students_without_native_upsert(seeded_db, exam169, monkeypatch):
+    monkeypatch.setattr(upsert, '_UPSERT_INSERTS', {})
+    import_rows(seeded_db, exam169, [
+        {'email': 'new@berkeley.edu', 'name': 'New Student', 'canvas id': 'new', 'righty': 'true'},
+        {'email': 'sharon@berkeley.edu', 'name': 'Sharon L', 'canvas id': '345678', 'seat id': '3'},
+    ])
+    assert Student.query.filter_by(exam_id=exam169.id, canvas_id='new').one().wants == {'righty'}
+    sharon = Student.query.get(2)
+    assert sharon.name == 'Sharon L' and sharon.assignment.seat_id == 3
+    assert SeatAssignment.query.filter_by(exam_id=exam169.id).count() == 2
+
+
+def test_upsert_students_keeps_other_pending_changes(seeded_db, exam169):
+    exam169.display_name = 'Renamed Midterm'
+    import_rows(seeded_db, exam169, [
+        {'email': 'sharon@berkeley.edu', 'name': 'Sharon L', 'canvas id': '345678', 'seat id': '3'},
+    ])
+    assert Exam.query.get(1).display_name == 'Renamed Midterm'
+    assert Student.query.get(2).name == 'Sharon L'
+
+
+def test_upsert_students_after_autoflush(seeded_db, exam169):
+    config = StudentImportConfig()
+    new_students, updated_students, _, _ = prepare_students(exam169, HEADERS, [
+        {'email': 'new@berkeley.edu', 'name': 'New Student', 'canvas id': 'new', 'seat id': '4', 'righty': 'true'},
+        {'email': 'jx@berkeley.edu', 'name': 'Jimmy Xu', 'canvas id': '234567', 'seat id': '2', 'lefty': 'false'},
+        {'email': 'sharon@berkeley.edu', 'name': 'Sharon L', 'canvas id': '345678', 'lefty': 'true'},
+    ], config=config)
+    # as an autoflush would, which resets the attribute history of the prepared students
+    seeded_db.session.flush()
+    upsert_students(seeded_db.session, exam169, new_students, updated_students, config=config)
+    seeded_db.session.commit()
+    seeded_db.session.expire_all()
+    new = Student.query.filter_by(exam_id=exam169.id, canvas_id='new').one()
+    assert new.assignment.seat_id == 4 and links_of(new) == {('want', 'righty')}
+    jimmy = Student.query.get(1)
+    assert jimmy.avoids == {'lefty'} and jimmy.assignment.seat_id == 2 and links_of(jimmy) == {('avoid', 'lefty')}
+    assert Student.query.get(2).name == 'Sharon L'
+    assert SeatAssignment.query.filter_by(exam_id=exam169.id).count() == 2
+
+
+def test_upsert_students_merges_repeated_canvas_ids(seeded_db, exam169):
+    config = StudentImportConfig()
+    new_students, updated_students, invalid_students, _ = prepare_students(exam169, HEADERS, [
+        {'email': 'a@berkeley.edu', 'name': 'A', 'canvas id': '999', 'seat id': '4', 'righty': 'true'},
+        {'email': 'sharon@berkeley.edu', 'name': 'Sharon L', 'canvas id': '345678'},
+        {'email': '', 'name': 'B', 'canvas id': '999', 'righty': 'true'},
+        {'email': 'sharon@berkeley.edu', 'name': 'Sharon M', 'canvas id': '345678'},
+    ], config=config)
+    # later rows of a canvas id merge into the student of the first one, as into an existing student
+    assert [student.name for student in new_students] == ['B']
+    assert [student.name for student in updated_students] == ['Sharon M']
+    assert not invalid_students
+    upsert_students(seeded_db.session, exam169, new_students, updated_students, config=config)
+    seeded_db.session.commit()
+    seeded_db.session.expire_all()
+    student = Student.query.filter_by(exam_id=exam169.id, canvas_id='999').one()
+    assert (student.name, student.email, student.wants) == ('B', 'a@berkeley.edu', {'righty'})
+    assert student.assignment.seat_id == 4
+    assert Student.query.get(2).name == 'Sharon M'